@@ -0,0 +1,149 @@
+import threading
+import time
+
+from django.conf import settings
+
+from core.metrics import db_call
+
+# Least number of seconds between two reloads of the whole index. Saves in
+# this process update it right away; this bounds how long a code created by
+# another worker can look invalid here, and how often wrong codes can make
+# the index hit the database
+DEFAULT_REFRESH = 10
+# InterviewSession.access_code max_length; anything longer can't match
+MAX_CODE_LENGTH = 10
+
+
+class AccessCodeIndex:
+    """Process-wide access code -> session id map used by join_session.
+
+    Every session's code is loaded in one query on first use, and
+    InterviewSession.save() and delete() keep the map current from then on,
+    so a wrong code, or one that can't be a code at all, is answered from
+    memory. Only sessions written by another process go unseen: a code the
+    map doesn't know reloads it, but at most once every `refresh` seconds
+    however many wrong codes arrive. A code another process has since moved
+    or deleted is caught by the view, which fetches the session by id *and*
+    code and then discard()s the code.
+
+    Views resolve codes on the event loop while sessions are saved in worker
+    threads, so the map is guarded by a lock.
+    """
+
+    def __init__(self, refresh=None):
+        self.refresh = refresh if refresh is not None else getattr(settings, 'ACCESS_CODE_REFRESH', DEFAULT_REFRESH)
+        self.codes = None  # code -> session id, None until loaded
+        self.sessions = {}  # session id -> code
+        self.lock = threading.Lock()
+        self.loaded_at = 0.0
+        # Changes made while a reload is reading the table, replayed onto
+        # its result so a save that raced with it isn't lost
+        self.loading = 0
+        self.changes = []
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def lookup(self, code):
+        """Return (found, session id) without touching the database."""
+        with self.lock:
+            session_id = self.codes.get(code) if self.codes is not None else None
+            if session_id is not None:
+                self.hits += 1
+                return True, session_id
+            self.misses += 1
+            return False, None
+
+    def update(self, session_id, code):
+        """Point `code` at the session; None drops the session's code."""
+        with self.lock:
+            if self.loading:
+                self.changes.append((session_id, code))
+            if self.codes is not None:
+                self._apply(self.codes, self.sessions, session_id, code)
+
+    def discard(self, code):
+        """Forget a code found to be stale."""
+        with self.lock:
+            session_id = self.codes.pop(code, None) if self.codes is not None else None
+            if session_id is not None and self.sessions.get(session_id) == code:
+                del self.sessions[session_id]
+
+    def clear(self):
+        with self.lock:
+            self.codes = None
+            self.sessions = {}
+            self.changes = []
+            self.loaded_at = 0.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.codes or ()),
+                'loads': self.loads,
+            }
+
+    @staticmethod
+    def _apply(codes, sessions, session_id, code):
+        old = sessions.pop(session_id, None)
+        if old is not None and codes.get(old) == session_id:
+            del codes[old]
+        if code is not None:
+            codes[code] = session_id
+            sessions[session_id] = code
+
+    def _reload_due(self):
+        # Claims the reload, so a burst of wrong codes triggers only one
+        with self.lock:
+            now = time.monotonic()
+            if self.codes is not None and now < self.loaded_at + self.refresh:
+                return False
+            self.loaded_at = now
+            self.loading += 1
+            return True
+
+    async def _reload(self):
+        """Replace the map with every session's code, read in one query."""
+        # _reload_due() has counted this load in self.loading
+        with self.lock:
+            start = len(self.changes)
+        try:
+            rows = await self._load()
+        except Exception:
+            with self.lock:
+                self.loading -= 1
+                if not self.loading:
+                    self.changes = []
+            raise
+        codes, sessions = {}, {}
+        for code, session_id in rows:
+            self._apply(codes, sessions, session_id, code)
+        with self.lock:
+            for session_id, code in self.changes[start:]:
+                self._apply(codes, sessions, session_id, code)
+            self.codes, self.sessions = codes, sessions
+            self.loads += 1
+            self.loading -= 1
+            if not self.loading:
+                self.changes = []
+
+    async def resolve(self, code):
+        """Id of the session with this access code, or None."""
+        if not code or len(code) > MAX_CODE_LENGTH:
+            return None
+        found, session_id = self.lookup(code)
+        if not found and self._reload_due():
+            await self._reload()
+            with self.lock:
+                session_id = self.codes.get(code)
+        return session_id
+
+    @db_call('access_code_index_load')
+    def _load(self):
+        from core.models import InterviewSession
+        return list(InterviewSession.objects.order_by().values_list('access_code', 'id'))
+
+
+access_code_index = AccessCodeIndex()
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+from django.utils import timezone
+
+from core import frames
+from core.serializer import dumps
+
+from src.server import server
+
+logger = logging.getLogger(__name__)
+
+TICK_SECONDS = 5
+
+
+class RoomClock:
+    """Sends the server time to every socket in a room on one shared ticker.
+
+    A room's ticker starts when its first local socket joins and is cancelled
+    when the last one leaves or the room's session ends, so each tick costs
+    one message per participant and idle processes hold no tasks.
+    """
+
+    def __init__(self, interval=TICK_SECONDS):
+        self.interval = interval
+        self.members = {}  # room id -> set of consumers
+        self.tasks = {}  # room id -> ticker task
+
+    def join(self, room_id, consumer):
+        self.members.setdefault(room_id, set()).add(consumer)
+        if room_id not in self.tasks:
+            self.tasks[room_id] = asyncio.create_task(self._tick(room_id))
+
+    def leave(self, room_id, consumer):
+        members = self.members.get(room_id)
+        if members is None:
+            return
+        members.discard(consumer)
+        if not members:
+            self._stop(room_id)
+
+    def stop(self, room_id):
+        """Stop a room's ticker. Returns the sockets that were in the room."""
+        members = self.members.get(room_id, set())
+        self._stop(room_id)
+        return members
+
+    def _stop(self, room_id):
+        self.members.pop(room_id, None)
+        task = self.tasks.pop(room_id, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+
+    async def _tick(self, room_id):
+        while True:
+            now = timezone.now()
+            if not await server.room_is_open(room_id, now):
+                self._stop(room_id)
+                return
+
+            message = {
+                'type': 'global_time',
+                'timestamp': int(now.timestamp()),
+            }
+            members = list(self.members.get(room_id, ()))
+            # The binary form only when one of them reads it
+            data = frames.encode(message, room=room_id) if any(c.binary for c in members) else None
+            text = dumps(message)
+            for consumer in members:
+                try:
+                    await consumer.send_encoded(text, data, ('global_time',))
+                except Exception as e:
+                    logger.warning("Error sending global time: %s", e, extra={'room': room_id})
+            await asyncio.sleep(self.interval)
+
+
+room_clock = RoomClock()
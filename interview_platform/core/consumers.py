@@ -1,28 +1,63 @@
 # This allows real-time text updates in the shared editor!
 # websocket logic
 
-import json
-import asyncio
+import logging
+
 from src.server import server
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from datetime import datetime, timedelta
+from datetime import timedelta
+from json import JSONDecodeError
 from django.utils import timezone
-from core.models import InterviewSession
+from core.models import InterviewSession, RoomOp, SessionParticipant
+from core import frames, metrics
+from core.clock import room_clock
+from core.lobby import LOBBY_GROUP
+from core.metrics import db_call
+from core.outbox import room_outbox
+from core.persistence import room_store
+from core.sendqueue import SLOW_CLIENT_CLOSE_CODE, SendQueue
+from core.serializer import dumps, loads
+from core.session_cache import session_cache
+from core.sweeper import session_sweeper
+from src.editor import OperationError
+from src.whiteboard import WhiteboardError
+
+logger = logging.getLogger(__name__)
 
 user_channels = {}
 
+# Close codes clients don't reconnect after: no session behind the room,
+# turned away from a full room, and the session is over
+ROOM_NOT_FOUND_CLOSE_CODE = 4004
+ROOM_FULL_CLOSE_CODE = 4009
+SESSION_ENDED_CLOSE_CODE = 4010
+
 class WSConsumer(AsyncWebsocketConsumer):
 	async def connect(self):
 		self.user_id = self.scope["user"].id if self.scope["user"].is_authenticated else "anon"
 		self.room_name = None
+		# Binary frames (core/frames.py) once the client asks for them on join
+		self.binary = False
+		# Room frames up to this sequence number are covered by the join reply
+		self.seen_seq = 0
+		# Everything sent to this client goes through a bounded queue, so a
+		# slow link never holds up the rest of the room
+		self.outbound = SendQueue(self.write_frame, self.resync_frame, self.close_from_queue)
+		# Running sessions' rooms come back before this socket can join one
+		await room_store.ensure_warm(server)
+		session_sweeper.start()
+		metrics.watch_event_loop()
+		metrics.WS_CONNECTIONS.inc()
 		await self.accept()
-		
-		# Start background task to broadcast global time
-		asyncio.create_task(self.broadcast_time())
 
 	async def disconnect(self, close_code):
-		print(f"WebSocket disconnected with code: {close_code}")
+		logger.debug("WebSocket disconnected", extra={'code': close_code})
+		self.outbound.stop()
+		if self.room_name:
+			room_id = self.room_name.replace('room_', '')
+			room_clock.leave(room_id, self)
+			await self.channel_layer.group_discard(self.room_name, self.channel_name)
+			await self.set_presence(room_id, False)
 		# Get the user ID from the scope
 		u = self.scope.get('user_id')
 		
@@ -32,18 +67,63 @@ class WSConsumer(AsyncWebsocketConsumer):
 		
 		# Only try to remove user if it exists
 		try:
-			server.remove_user(u)
+			await server.leave_room(u)
 		except Exception as e:
-			print(f"Error removing user: {str(e)}")
-		# await self.channel_layer.group_discard("users", self.channel_name)
+			logger.warning("Error removing user: %s", e)
 
-	async def receive(self, text_data):
+	async def receive(self, text_data=None, bytes_data=None):
 		try:
-			data = json.loads(text_data)
+			if bytes_data is not None:
+				metrics.WS_MESSAGE_BYTES.observe(len(bytes_data), 'in', 'binary')
+				data, _, _ = frames.decode(bytes_data)
+			else:
+				metrics.WS_MESSAGE_BYTES.observe(len(text_data), 'in', 'text')
+				data = loads(text_data)
+			metrics.WS_MESSAGES_IN.inc(metrics.inbound_type(data))
 			
-			# Handle join request
+			# Handle join request. A reconnecting client adds where it got
+			# to, {'resume': {'seq': n, 'epoch': e}}, and gets just the frames
+			# it missed when the room still has them all
 			if 'join' in data:
-				self.room_name = f"room_{data['join']}"
+				room_id = str(data['join'])
+				self.binary = bool(data.get('binary'))
+				resume = data.get('resume')
+				if not (isinstance(resume, dict) and isinstance(resume.get('seq'), int)):
+					resume = None
+				if self.room_name:
+					old_room_id = self.room_name.replace('room_', '')
+					room_clock.leave(old_room_id, self)
+					await self.channel_layer.group_discard(self.room_name, self.channel_name)
+					await server.leave_room(self.scope.get('user_id'))
+					await self.set_presence(old_room_id, False)
+					self.room_name = None
+				
+				# Admission: the room server counts the room's connections and
+				# takes a place in one step, against the session's limit from
+				# the cache, so a full room turns sockets away before they are
+				# added to the group and cost anything on every broadcast
+				meta = await session_cache.get(room_id)
+				if meta is None:
+					# Rooms only exist for sessions: they are torn down and
+					# their persisted ops dropped when the session ends, a room
+					# for any other id would never be
+					metrics.WS_REJECTED.inc('room_not_found')
+					await self.reject({'type': 'room_not_found', 'room': room_id}, ROOM_NOT_FOUND_CLOSE_CODE)
+					return
+				if meta.status() == "expired":
+					# Don't bring a torn down room back (see core/sweeper.py)
+					metrics.WS_REJECTED.inc('session_ended')
+					await self.reject({'type': 'session_ended', 'room': room_id}, SESSION_ENDED_CLOSE_CODE)
+					return
+				limit = meta.max_participants
+				user_id = await server.join_room(room_id, limit, meta.end_time, self.binary)
+				if user_id is None:
+					logger.info("Room is full, turning a connection away", extra={'room': room_id, 'limit': limit})
+					metrics.WS_REJECTED.inc('room_full')
+					await self.reject({'type': 'room_full', 'max_participants': limit}, ROOM_FULL_CLOSE_CODE)
+					return
+				self.scope['user_id'] = user_id
+				self.room_name = f"room_{room_id}"
 				
 				# Join room group
 				await self.channel_layer.group_add(
@@ -51,10 +131,52 @@ class WSConsumer(AsyncWebsocketConsumer):
 					self.channel_name
 				)
 				
-				# Send back join confirmation
-				await self.send(text_data=json.dumps({
-					'join': self.user_id
-				}))
+				# Taken after joining the group, so no broadcast falls in
+				# between. The log position comes first: every frame up to it
+				# is then part of the state read below
+				if resume:
+					epoch, seq, missed = await server.replay(room_id, resume['seq'], resume.get('epoch'))
+				else:
+					epoch, seq, missed = await server.replay(room_id)
+				self.seen_seq = seq
+				
+				# Send back join confirmation with a per-connection id, so the
+				# client can recognise its own ops when they are broadcast back,
+				# together with the current document and whiteboard, or just
+				# the frames a resuming client missed: a (re)joining client is
+				# usable after this one message
+				reply = {
+					'join': self.scope['user_id'],
+					'binary': self.binary,
+					'epoch': epoch,
+					'seq': seq,
+				}
+				if missed is not None:
+					metrics.WS_RESUMES.inc('replayed')
+					reply.update(resumed=True, events=missed)
+				else:
+					if resume:
+						metrics.WS_RESUMES.inc('snapshot')
+					snapshot = await server.room_state(room_id) or {
+						'editor': {'text': '', 'rev': 0},
+						'whiteboard': {'ops': [], 'rev': 0},
+					}
+					reply.update(editor=snapshot['editor'], whiteboard=snapshot['whiteboard'])
+				
+				# Receive the room's shared global_time ticks
+				room_clock.join(room_id, self)
+				await self.send_message(reply)
+				await self.set_presence(room_id, True)
+			
+			# Handle editor operations
+			elif data.get('type') == 'txt_op':
+				if self.room_name:
+					await self.apply_txt_op(data)
+			
+			# Handle whiteboard strokes
+			elif data.get('type') == 'wb_ops':
+				if self.room_name:
+					await self.apply_wb_ops(data)
 			
 			# Handle timer start request
 			elif data.get('type') == 'start_timer':
@@ -68,7 +190,9 @@ class WSConsumer(AsyncWebsocketConsumer):
 						
 						# Broadcast timer update to room
 						if end_time:
-							await self.channel_layer.group_send(
+							await server.update_end_time(str(room_id), end_time)
+							session_sweeper.schedule(end_time, int(room_id))
+							await room_outbox.send(
 								f"room_{room_id}",
 								{
 									'type': 'timer_update',
@@ -76,7 +200,7 @@ class WSConsumer(AsyncWebsocketConsumer):
 								}
 							)
 					except Exception as e:
-						print(f"Error updating database session end time: {e}")
+						logger.warning("Error updating database session end time: %s", e, extra={'room': room_id})
 			
 			# Handle get_timer request
 			elif data.get('type') == 'get_timer':
@@ -85,18 +209,18 @@ class WSConsumer(AsyncWebsocketConsumer):
 					try:
 						end_time = await self.get_session_end_time(room_id)
 						if end_time:
-							await self.send(text_data=json.dumps({
+							await self.send_message({
 								'type': 'timer_update',
 								'end_time': end_time.isoformat()
-							}))
+							})
 					except Exception as e:
-						print(f"Error getting session end time: {e}")
+						logger.warning("Error getting session end time: %s", e, extra={'room': room_id})
 			
-			# Handle other message types (text update, whiteboard update, etc.)
-			elif 'type' in data:
+			# Relay whole-state updates from older clients
+			elif data.get('type') in ('txt_update', 'wb_buffer'):
 				# Broadcast to room group
 				if self.room_name:
-					await self.channel_layer.group_send(
+					await room_outbox.send(
 						self.room_name,
 						{
 							'type': data['type'],
@@ -104,32 +228,153 @@ class WSConsumer(AsyncWebsocketConsumer):
 						}
 					)
 		
-		except json.JSONDecodeError:
-			print("Received invalid JSON")
-		except Exception as e:
-			print(f"Error processing message: {e}")
+		except JSONDecodeError:
+			metrics.WS_MESSAGES_IN.inc('invalid')
+			logger.info("Received invalid JSON")
+		except frames.FrameError as e:
+			metrics.WS_MESSAGES_IN.inc('invalid')
+			logger.info("Received invalid binary frame: %s", e)
+		except Exception:
+			logger.exception("Error processing message")
+
+	async def apply_txt_op(self, data):
+		"""Apply an editor op against the room document and broadcast the delta."""
+		room_id = self.room_name.replace('room_', '')
+		try:
+			result = await server.apply_text(room_id, data.get('rev'), data.get('ops'))
+		except (OperationError, TypeError) as e:
+			logger.info("Rejected editor op, resyncing client: %s", e, extra={'room': room_id})
+			snapshot = await server.text_snapshot(room_id)
+			if snapshot:
+				await self.send_message({
+					'type': 'txt_snapshot',
+					**snapshot
+				})
+			return
+		if result is None:
+			return
+		rev, ops = result
+		await self.persist(room_id, RoomOp.TEXT, rev, ops)
+
+		await room_outbox.send(
+			self.room_name,
+			{
+				'type': 'txt_op',
+				'uid': self.scope.get('user_id'),
+				'rev': rev,
+				'ops': ops
+			}
+		)
+
+	async def apply_wb_ops(self, data):
+		"""Append a batch of whiteboard strokes to the room log and relay it."""
+		room_id = self.room_name.replace('room_', '')
+		try:
+			result = await server.apply_whiteboard(room_id, data.get('ops'))
+		except WhiteboardError as e:
+			# The sender has drawn it already: redraw its board from the room
+			# log, with the reason (e.g. the board is full)
+			logger.info("Rejected whiteboard ops, resyncing client: %s", e, extra={'room': room_id})
+			snapshot = await server.whiteboard_snapshot(room_id)
+			if snapshot:
+				await self.send_message({
+					'type': 'wb_snapshot',
+					'error': str(e),
+					**snapshot
+				})
+			return
+		if result is None:
+			return
+		rev, ops = result
+		await self.persist(room_id, RoomOp.WHITEBOARD, rev, ops)
+
+		await room_outbox.send(
+			self.room_name,
+			{
+				'type': 'wb_ops',
+				'uid': self.scope.get('user_id'),
+				'rev': rev,
+				'ops': ops
+			}
+		)
+
+	async def persist(self, room_id, kind, rev, ops):
+		"""Log an applied op so the room survives a restart (see core/persistence.py)."""
+		if room_store.record(room_id, kind, rev, ops):
+			state = await server.room_state(room_id)
+			if state is not None:
+				room_store.snapshot(room_id, state)
+
+	def encode(self, message):
+		if self.binary:
+			return frames.encode(message, room=self.room_name.replace('room_', ''))
+		return dumps(message)
+
+	async def send_message(self, message):
+		"""Send a message to this client only, in the format it asked for."""
+		encoded = self.encode(message)
+		await self.send_encoded(encoded, encoded, (message['type'],) if 'type' in message else ())
+
+	async def send_encoded(self, text, data, kinds=()):
+		"""Forward a message encoded once for everyone: JSON text or binary frame.
+
+		Room frames only have a binary form while the room has binary
+		clients; without one the text goes out, which those clients read too.
+		"""
+		for kind in kinds or ('reply',):
+			metrics.WS_MESSAGES_OUT.inc(kind)
+		self.outbound.push(data if self.binary and data is not None else text, kinds)
+
+	async def write_frame(self, payload):
+		if isinstance(payload, bytes):
+			metrics.WS_MESSAGE_BYTES.observe(len(payload), 'out', 'binary')
+			await self.send(bytes_data=payload)
+		else:
+			metrics.WS_MESSAGE_BYTES.observe(len(payload), 'out', 'text')
+			await self.send(text_data=payload)
+
+	async def resync_frame(self):
+		# The client fell too far behind: one frame with the room's current state
+		if not self.room_name:
+			return None
+		state = await server.room_state(self.room_name.replace('room_', ''))
+		if state is None:
+			return None
+		return self.encode({'type': 'batch', 'events': [
+			{'type': 'txt_snapshot', **state['editor']},
+			{'type': 'wb_snapshot', **state['whiteboard']},
+		]})
+
+	async def reject(self, message, code):
+		# Straight to the socket: nothing is queued for a connection outside
+		# a room. As JSON text, which every client reads, binary or not
+		await self.send(text_data=dumps(message))
+		await self.close(code=code)
+
+	async def close_from_queue(self, code):
+		if code == SLOW_CLIENT_CLOSE_CODE:
+			logger.info("Closing WebSocket of a client that can't keep up", extra={'room': self.room_name})
+		await self.close(code=code)
+
+	async def end_session(self, text, data):
+		"""The room's session is over: say so and close once it's sent."""
+		await self.send_encoded(text, data, ('session_ended',))
+		# disconnect() then cleans up as for any other close
+		self.outbound.end(SESSION_ENDED_CLOSE_CODE)
 
 	# Handlers for different message types
-	async def txt_update(self, event):
-		await self.send(text_data=json.dumps({
-			'type': 'txt_update',
-			'data': event['data']
-		}))
-	
-	async def wb_buffer(self, event):
-		await self.send(text_data=json.dumps({
-			'type': 'wb_buffer',
-			'data': event['data']
-		}))
-	
-	async def timer_update(self, event):
-		await self.send(text_data=json.dumps({
-			'type': 'timer_update',
-			'end_time': event['end_time']
-		}))
-
-	# Database access methods using sync_to_async
-	@database_sync_to_async
+	async def room_message(self, event):
+		# Room events arrive already encoded (see core/outbox.py)
+		if 0 < event.get('seq', 0) <= self.seen_seq:
+			# Published before this client joined, its join reply covers it
+			return
+		if 'timer_update' in event['kinds']:
+			# The session was saved on whichever worker handled start_timer
+			session_cache.invalidate(self.room_name.replace('room_', ''))
+		await self.send_encoded(event['text'], event['bytes'], event['kinds'])
+
+	# Database access methods, run in a thread (and timed, see core/metrics.py)
+	@db_call('update_session_end_time')
 	def update_session_end_time(self, room_id, duration):
 		try:
 			session = InterviewSession.objects.get(id=room_id)
@@ -138,41 +383,46 @@ class WSConsumer(AsyncWebsocketConsumer):
 			session.save()
 			return end_time
 		except InterviewSession.DoesNotExist:
-			print(f"InterviewSession with ID {room_id} not found")
+			logger.info("InterviewSession not found", extra={'room': room_id})
 			return None
 		except Exception as e:
-			print(f"Error updating session end time: {e}")
+			logger.warning("Error updating session end time: %s", e, extra={'room': room_id})
 			return None
 	
-	@database_sync_to_async
-	def get_session_end_time(self, room_id):
+	async def set_presence(self, room_id, present):
+		"""Keep SessionParticipant.is_present in step with open connections."""
+		user = self.scope["user"]
+		if not user.is_authenticated:
+			return
+		# Counted by the room server across workers: only the first
+		# connection in and the last one out anywhere change the row
+		count = await server.track_presence(room_id, user.pk, 1 if present else -1)
+		if count == (1 if present else 0):
+			await self.update_presence(room_id, user.pk, present)
+
+	@db_call('update_presence')
+	def update_presence(self, room_id, user_pk, present):
 		try:
-			session = InterviewSession.objects.get(id=room_id)
-			return session.end_time
-		except InterviewSession.DoesNotExist:
-			print(f"InterviewSession with ID {room_id} not found")
-			return None
+			SessionParticipant.objects.filter(session_id=room_id, user_id=user_pk).update(is_present=present)
 		except Exception as e:
-			print(f"Error getting session end time: {e}")
-			return None
+			logger.warning("Error updating participant presence: %s", e, extra={'room': room_id})
 
-	async def broadcast_time(self):
-		"""Broadcast global time to all clients periodically."""
-		while True:
-			if self.room_name:
-				# Send the current time to all clients in the room
-				await self.channel_layer.group_send(
-					self.room_name,
-					{
-						'type': 'global_time',
-						'timestamp': int(timezone.now().timestamp()),
-					}
-				)
-			await asyncio.sleep(5)  # Update every 5 seconds
-
-	async def global_time(self, event):
-		"""Send global time to the client"""
-		await self.send(text_data=json.dumps({
-			'type': 'global_time',
-			'timestamp': event['timestamp'],
-		}))
+	async def get_session_end_time(self, room_id):
+		# Served from the process-wide cache, the DB is only read on a miss
+		meta = await session_cache.get(room_id)
+		return meta.end_time if meta else None
+
+
+class LobbyConsumer(AsyncWebsocketConsumer):
+	"""Pushes session list changes to open home pages."""
+	async def connect(self):
+		session_sweeper.start()
+		await self.channel_layer.group_add(LOBBY_GROUP, self.channel_name)
+		await self.accept()
+
+	async def disconnect(self, close_code):
+		await self.channel_layer.group_discard(LOBBY_GROUP, self.channel_name)
+
+	async def lobby_event(self, event):
+		# Encoded once by notify_lobby for every open home page
+		await self.send(text_data=event['text'])
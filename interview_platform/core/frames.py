@@ -0,0 +1,96 @@
+import struct
+import zlib
+
+from core.serializer import dumps, loads
+
+# Binary WebSocket frames, for clients that ask for them on join
+# ({'join': room, 'binary': true}); everyone else keeps getting JSON text.
+#
+#   byte 0     version (1)
+#   byte 1     flags (FLAG_DEFLATE: payload is zlib-compressed)
+#   byte 2     message type, index into TYPES
+#   byte 3     length of the room id
+#   bytes 4-7  sequence number, big endian (0 when the message has none)
+#   room id (UTF-8), then the payload
+#
+# A message's 'seq' (room frames are numbered, see core/outbox.py) travels
+# in the header. The payload is the rest of the message minus its 'type' as
+# JSON; type 0 carries a whole JSON message (e.g. the join reply).
+VERSION = 1
+FLAG_DEFLATE = 1
+HEADER = struct.Struct('!BBBBI')
+
+TYPES = [
+    None, 'txt_snapshot', 'txt_op', 'wb_snapshot', 'wb_ops', 'batch',
+    'txt_update', 'wb_buffer', 'timer_update', 'global_time',
+]
+TYPE_CODES = {name: code for code, name in enumerate(TYPES) if name}
+
+# Payloads smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 512
+# Largest payload accepted from a client once inflated
+MAX_PAYLOAD_BYTES = 16 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    """Raised for a binary frame that can't be decoded."""
+
+
+def encode(message, room='', seq=0):
+    """Encode a message dict as a binary frame."""
+    seq = message.get('seq', seq)
+    code = TYPE_CODES.get(message.get('type'), 0)
+    skip = ('type', 'seq') if code else ('seq',)
+    payload = dumps({k: v for k, v in message.items() if k not in skip}).encode()
+
+    flags = 0
+    if len(payload) >= COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(payload, 6)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= FLAG_DEFLATE
+
+    room = room.encode()
+    if len(room) > 255:
+        raise FrameError("room id too long")
+    return HEADER.pack(VERSION, flags, code, len(room), seq & 0xFFFFFFFF) + room + payload
+
+
+def decode(data):
+    """Decode a binary frame into (message, room, seq)."""
+    if len(data) < HEADER.size:
+        raise FrameError("frame too short")
+    version, flags, code, room_length, seq = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise FrameError(f"unsupported frame version {version}")
+    if code >= len(TYPES):
+        raise FrameError(f"unknown message type {code}")
+    start = HEADER.size + room_length
+    try:
+        room = bytes(data[HEADER.size:start]).decode()
+    except UnicodeDecodeError:
+        raise FrameError("room id is not UTF-8")
+    payload = bytes(data[start:])
+
+    if flags & FLAG_DEFLATE:
+        inflater = zlib.decompressobj()
+        try:
+            payload = inflater.decompress(payload, MAX_PAYLOAD_BYTES)
+        except zlib.error as e:
+            raise FrameError(f"bad compressed payload: {e}")
+        if inflater.unconsumed_tail:
+            raise FrameError("payload too large")
+
+    kind = TYPES[code]
+    try:
+        message = loads(payload)
+    except ValueError as e:
+        raise FrameError(f"bad JSON payload: {e}")
+    if not isinstance(message, dict):
+        raise FrameError("payload is not an object")
+    if kind:
+        message['type'] = kind
+    if seq:
+        message['seq'] = seq
+    return message, room, seq
+
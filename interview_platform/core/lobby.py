@@ -0,0 +1,52 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.template.loader import render_to_string
+
+from core import metrics
+from core.serializer import dumps
+
+logger = logging.getLogger(__name__)
+
+# Channel group of every open home page
+LOBBY_GROUP = "lobby"
+
+
+def lobby_event(event, session):
+    """Channel-layer message announcing a session change to the lobby."""
+    return {
+        'type': 'lobby_event',
+        # Encoded here, once, and forwarded as-is by every LobbyConsumer
+        'text': dumps({
+            'event': event,
+            'id': session.id,
+            'html': render_to_string('core/partials/session_item.html', {
+                'session': session,
+                'expired': event == 'session_expired',
+            }),
+        }),
+    }
+
+
+async def anotify_lobby(event, sessions):
+    """notify_lobby() for async code (async views, model helpers)."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        for session in sessions:
+            message = lobby_event(event, session)
+            with metrics.GROUP_SEND_SECONDS.time('lobby'):
+                await channel_layer.group_send(LOBBY_GROUP, message)
+    except Exception as e:
+        logger.warning("Error notifying lobby of %s: %s", event, e)
+
+
+def notify_lobby(event, sessions):
+    """Push session_created / session_activated / session_expired to the lobby.
+
+    Called from sync code (views, model status transitions); failures are
+    logged and never break the caller.
+    """
+    async_to_sync(anotify_lobby)(event, sessions)
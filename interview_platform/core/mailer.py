@@ -0,0 +1,135 @@
+import logging
+import queue
+import threading
+import time
+
+from django.core.mail import get_connection
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from core.models import EmailDelivery
+
+logger = logging.getLogger(__name__)
+
+# Messages sent over one backend connection before it is closed again
+BATCH_SIZE = 50
+# How long the worker waits for more messages before sending a partial batch
+LINGER_SECONDS = 0.2
+MAX_ATTEMPTS = 4
+BACKOFF_SECONDS = 1.0  # doubled after every failed attempt
+
+
+class MailQueue:
+    """Sends email on a background thread so views never block on SMTP.
+
+    Each message gets an EmailDelivery row when it is queued. The worker
+    sends queued messages in batches over a single backend connection,
+    retries the ones that failed with exponential backoff and records
+    the outcome on their rows.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, messages, session=None):
+        """Queue EmailMessages (one recipient each) and return their deliveries.
+
+        Messages are handed to the worker once the current transaction
+        commits, so a rolled back view sends nothing.
+        """
+        deliveries = EmailDelivery.objects.bulk_create([
+            EmailDelivery(session=session, recipient=message.to[0], subject=message.subject)
+            for message in messages
+        ])
+        items = [(delivery.id, message) for delivery, message in zip(deliveries, messages)]
+        transaction.on_commit(lambda: self._put(items))
+        return deliveries
+
+    def drain(self):
+        """Block until everything queued so far has been handled."""
+        self.queue.join()
+
+    def _put(self, items):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+                self.thread.start()
+        for item in items:
+            self.queue.put(item)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=LINGER_SECONDS))
+                except queue.Empty:
+                    break
+            try:
+                self._deliver(batch)
+            except Exception:
+                logger.exception("Error delivering email batch")
+            finally:
+                close_old_connections()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _deliver(self, batch):
+        pending = batch
+        errors = {}
+        for attempt in range(1, self.max_attempts + 1):
+            if attempt > 1:
+                time.sleep(self.backoff * 2 ** (attempt - 2))
+            sent, failed = self._send_batch(pending, errors)
+            if sent:
+                EmailDelivery.objects.filter(id__in=sent).update(
+                    status=EmailDelivery.SENT, attempts=attempt, sent_at=timezone.now()
+                )
+                logger.info("Email sent to %d recipient(s)", len(sent))
+            pending = failed
+            if not pending:
+                return
+
+        for delivery_id, _ in pending:
+            EmailDelivery.objects.filter(id=delivery_id).update(
+                status=EmailDelivery.FAILED, attempts=self.max_attempts, last_error=errors[delivery_id]
+            )
+        logger.error("Email delivery failed for %d recipient(s)", len(pending))
+
+    def _send_batch(self, batch, errors):
+        """Send a batch over one connection; returns (sent ids, failed items)."""
+        sent, failed = [], []
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as e:
+            for delivery_id, _ in batch:
+                errors[delivery_id] = str(e)
+            return sent, list(batch)
+        try:
+            # One send_messages() call per message, over the one connection
+            # opened above: SMTP sends messages one at a time either way, but
+            # a single call for the batch only returns how many went out and
+            # stops at the first error without saying which ones did, so a
+            # failure couldn't be pinned on its row or retried alone
+            for delivery_id, message in batch:
+                try:
+                    connection.send_messages([message])
+                    sent.append(delivery_id)
+                except Exception as e:
+                    errors[delivery_id] = str(e)
+                    failed.append((delivery_id, message))
+        finally:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        return sent, failed
+
+
+mail_queue = MailQueue()
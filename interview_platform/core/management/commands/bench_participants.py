@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Post create_session with candidate panels of growing size inside a "
+        "transaction that is rolled back afterwards, and report the query count "
+        "and time of each. Fails if the query count grows with the panel size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,30,100', help="Comma separated panel sizes")
+        parser.add_argument('--existing', type=float, default=0.5, help="Share of candidates that already have a user")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        client = Client(SERVER_NAME='localhost')
+        counts = {}
+
+        self.stdout.write(f"Database: {connection.vendor}")
+        with transaction.atomic():
+            # Warm up (creates the admin user)
+            client.post(reverse('create_session'), {'title': "Warm up", 'candidate_emails': ''})
+            for size in sizes:
+                emails = self.seed_candidates(size, options['existing'])
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = client.post(reverse('create_session'), {
+                        'title': f"Panel of {size}",
+                        'candidate_emails': ', '.join(emails),
+                    })
+                    elapsed = (time.perf_counter() - started) * 1000
+                if response.status_code >= 400:
+                    raise CommandError(f"create_session returned {response.status_code}")
+                counts[size] = len(queries)
+                self.stdout.write(f"{size:>5} candidates  {len(queries):>3} queries  {elapsed:8.2f} ms")
+            transaction.set_rollback(True)
+
+        if max(counts.values()) > counts[sizes[0]]:
+            raise CommandError(f"Query count depends on the panel size: {counts}")
+        self.stdout.write(self.style.SUCCESS("Query count is constant in the number of candidates"))
+
+    def seed_candidates(self, size, existing):
+        prefix = f"bench{size}-{time.monotonic_ns()}"
+        emails = [f"{prefix}-{i}@example.com" for i in range(size)]
+        User.objects.bulk_create([
+            User(username=email.split('@')[0], email=email)
+            for email in emails[:int(size * existing)]
+        ])
+        return emails
@@ -0,0 +1,108 @@
+import statistics
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from core.models import InterviewSession, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a large number of interview sessions inside a transaction that is "
+        "rolled back afterwards, then time home_view, join_session and room_view "
+        "against the configured database and fail if any exceeds the latency budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=100_000)
+        parser.add_argument('--active', type=int, default=20, help="How many of them are running now")
+        parser.add_argument('--repeat', type=int, default=30)
+        parser.add_argument('--budget-ms', type=float, default=150.0, help="p95 budget per view")
+        parser.add_argument('--explain', action='store_true', help="Print the query plans of the home page queries")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Database: {connection.vendor}")
+        with transaction.atomic():
+            active = self.seed(options['sessions'], options['active'])
+            if options['explain']:
+                self.explain()
+            results = self.measure(active, options['repeat'])
+            transaction.set_rollback(True)
+
+        over_budget = []
+        for name, timings in results.items():
+            p50 = statistics.median(timings)
+            p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+            self.stdout.write(f"{name:<14} p50 {p50:7.2f} ms   p95 {p95:7.2f} ms")
+            if p95 > options['budget_ms']:
+                over_budget.append(name)
+
+        if over_budget:
+            raise CommandError(f"Over the {options['budget_ms']} ms budget: {', '.join(over_budget)}")
+        self.stdout.write(self.style.SUCCESS("All views within budget"))
+
+    def seed(self, count, active_count):
+        creator, _ = User.objects.get_or_create(username='bench', defaults={'email': 'bench@example.com'})
+        now = timezone.now()
+        sessions = []
+        for i in range(count):
+            if i < active_count:
+                start = now - timedelta(minutes=1)
+            else:
+                start = now - timedelta(minutes=20 + i)
+            sessions.append(InterviewSession(
+                title=f"Bench session {i}",
+                start_time=start,
+                end_time=start + timedelta(minutes=15),
+                date_created=start,
+                is_active=i < active_count,
+                access_code=uuid.uuid4().hex[:10].upper(),
+                created_by=creator,
+            ))
+        started = time.perf_counter()
+        InterviewSession.objects.bulk_create(sessions, batch_size=5000)
+        self.stdout.write(f"Seeded {count} sessions in {time.perf_counter() - started:.1f}s")
+        return sessions[0] if active_count else sessions[-1]
+
+    def explain(self):
+        now = timezone.now()
+        querysets = {
+            'expire flags': InterviewSession.objects.filter(is_active=True, end_time__lt=now).order_by(),
+            'activate flags': InterviewSession.objects.filter(
+                is_active=False, start_time__lte=now, end_time__gte=now
+            ).order_by(),
+            'active list': InterviewSession.objects.filter(
+                is_active=True, start_time__lte=now, end_time__gte=now
+            ).order_by('-start_time'),
+            'recent expired': InterviewSession.objects.filter(end_time__lt=now).order_by('-end_time')[:5],
+        }
+        for name, queryset in querysets.items():
+            self.stdout.write(f"-- {name}\n{queryset.explain()}")
+
+    def measure(self, session, repeat):
+        client = Client(SERVER_NAME='localhost')
+        # (request, expected status): the views redirect home on errors, so
+        # anything but the page itself means the sample timed the wrong path
+        requests = {
+            'home_view': (lambda: client.get(reverse('home')), 200),
+            'join_session': (lambda: client.post(reverse('join_session'), {'access_code': session.access_code}), 200),
+            'room_view': (lambda: client.get(reverse('room', args=[session.id])), 200),
+        }
+        results = {}
+        for name, (request, expected) in requests.items():
+            request()  # warm up
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = request()
+                timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != expected:
+                    raise CommandError(f"{name} returned {response.status_code}, expected {expected}")
+            results[name] = timings
+        return results
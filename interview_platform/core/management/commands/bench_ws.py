@@ -0,0 +1,520 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import time
+import urllib.request
+import uuid
+from datetime import timedelta
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from core import frames
+from core.models import InterviewSession, User
+from core.persistence import room_store
+from core.serializer import dumps, loads
+
+# Every message the participants send carries its send time (microseconds
+# since the epoch) and the sender's index, so whoever receives it can work out
+# the fan-out latency without sharing anything with the sender, even from
+# another process.
+MARK = re.compile(r'\[(\d+):(\d+)\]')
+KINDS = ('txt_op', 'wb_ops', 'txt_update', 'wb_buffer', 'start_timer')
+# Time left after the traffic stops for the last broadcasts to arrive
+DRAIN_SECONDS = 1.0
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+def quantiles(values):
+    if not values:
+        return None
+    if len(values) == 1:
+        return {'count': 1, 'p50': values[0], 'p95': values[0], 'p99': values[0]}
+    cuts = statistics.quantiles(values, n=100)
+    return {
+        'count': len(values),
+        'p50': round(statistics.median(values), 3),
+        'p95': round(cuts[94], 3),
+        'p99': round(cuts[98], 3),
+    }
+
+
+class Participant:
+    """One simulated browser in a room: sends traffic, times what it receives."""
+
+    def __init__(self, room, index, options, latencies, timers):
+        self.room = room
+        self.index = index
+        self.options = options
+        self.latencies = latencies  # message type -> [ms]
+        self.timers = timers  # room -> send time of its pending start_timer
+        self.uid = None
+        self.rev = 0
+        self.sent = 0
+        self.received = 0
+        self.update_padding = 'x' * options['update_bytes']
+        self.buffer_padding = os.urandom(options['buffer_bytes'])
+
+    def join_message(self):
+        return {'join': self.room, 'binary': self.options['binary']}
+
+    def message(self, kind):
+        sent = now_us()
+        if kind == 'txt_op':
+            return {'type': 'txt_op', 'rev': self.rev, 'ops': [{'p': 0, 'i': f"[{sent}:{self.index}]"}]}
+        if kind == 'wb_ops':
+            return {'type': 'wb_ops', 'ops': [
+                {'t': 'stroke', 'pts': [sent, self.index, 0, 0], 'color': '#000', 'width': 2},
+            ]}
+        if kind == 'txt_update':
+            return {'type': 'txt_update', 'data': f"[{sent}:{self.index}]{self.update_padding}"}
+        if kind == 'wb_buffer':
+            image = sent.to_bytes(8, 'big') + self.index.to_bytes(2, 'big') + self.buffer_padding
+            return {'type': 'wb_buffer', 'data': 'data:image/png;base64,' + base64.b64encode(image).decode()}
+        self.timers[self.room] = sent
+        return {'type': 'start_timer', 'room': self.room, 'duration': 3600}
+
+    def record(self, kind, sent, sender, now):
+        if sender != self.index:
+            self.latencies.setdefault(kind, []).append((now - sent) / 1000)
+
+    def receive(self, raw):
+        now = now_us()
+        message = frames.decode(raw)[0] if isinstance(raw, bytes) else loads(raw)
+        events = message['events'] if message.get('type') == 'batch' else [message]
+        for event in events:
+            self.received += 1
+            kind = event.get('type')
+            if 'join' in event:
+                self.uid = event['join']
+                self.rev = event['editor']['rev']
+            elif kind == 'txt_op':
+                self.rev = max(self.rev, event['rev'])
+                for op in event['ops']:
+                    for sent, sender in MARK.findall(op.get('i', '')):
+                        self.record(kind, int(sent), int(sender), now)
+            elif kind == 'txt_snapshot':
+                self.rev = event['rev']
+            elif kind == 'wb_ops':
+                for op in event['ops']:
+                    if op['t'] == 'stroke':
+                        self.record(kind, op['pts'][0], op['pts'][1], now)
+            elif kind == 'txt_update':
+                match = MARK.match(event['data'])
+                if match:
+                    self.record(kind, int(match.group(1)), int(match.group(2)), now)
+            elif kind == 'wb_buffer':
+                header = base64.b64decode(event['data'].partition(',')[2][:16])
+                self.record(kind, int.from_bytes(header[:8], 'big'), int.from_bytes(header[8:10], 'big'), now)
+            elif kind == 'timer_update':
+                sent = self.timers.get(self.room)
+                if sent is not None:
+                    self.record('start_timer', sent, -1, now)
+
+    async def drive(self, send, until):
+        """Send each kind of traffic at its configured rate until `until`."""
+        async def stream(kind, rate):
+            interval = 1 / rate
+            # Spread the participants out instead of sending in lockstep
+            await asyncio.sleep(random.uniform(0, interval))
+            while time.monotonic() < until:
+                await send(dumps(self.message(kind)))
+                self.sent += 1
+                await asyncio.sleep(interval)
+
+        streams = []
+        for kind in KINDS:
+            rate = self.options[f"{kind}_rate"]
+            # Only the first participant of a room restarts its timer
+            if rate > 0 and (kind != 'start_timer' or self.index == 0):
+                streams.append(stream(kind, rate))
+        await asyncio.gather(*streams)
+
+
+async def run_participants(participants, connect, options):
+    """Connect everyone, run the traffic for the configured duration.
+
+    connect(participant) returns (send, receive, close) coroutines for a
+    connection whose join reply has been read.
+    """
+    connections = [await connect(participant) for participant in participants]
+
+    async def read(participant, receive):
+        while True:
+            raw = await receive()
+            if raw is None:
+                return
+            participant.receive(raw)
+
+    readers = [
+        asyncio.create_task(read(participant, receive))
+        for participant, (_, receive, _) in zip(participants, connections)
+    ]
+    started = time.monotonic()
+    until = started + options['duration']
+    await asyncio.gather(*[
+        participant.drive(send, until)
+        for participant, (send, _, _) in zip(participants, connections)
+    ])
+    await asyncio.sleep(DRAIN_SECONDS)
+    elapsed = time.monotonic() - started
+    for reader in readers:
+        reader.cancel()
+    for _, _, close in connections:
+        await close()
+    return elapsed
+
+
+def client_process(url, rooms, options):
+    """Run the participants of some rooms against a server (in a child process)."""
+    import websockets
+
+    latencies, timers = {}, {}
+    participants = [
+        Participant(room, index, options, latencies, timers)
+        for room in rooms for index in range(options['participants'])
+    ]
+
+    async def connect(participant):
+        socket = await websockets.connect(url, max_size=None)
+        await socket.send(json.dumps(participant.join_message()))
+        participant.receive(await socket.recv())
+
+        async def receive():
+            try:
+                return await socket.recv()
+            except websockets.ConnectionClosed:
+                return None
+        return socket.send, receive, socket.close
+
+    elapsed = asyncio.run(run_participants(participants, connect, options))
+    return {
+        'latencies': latencies,
+        'sent': sum(p.sent for p in participants),
+        'received': sum(p.received for p in participants),
+        'elapsed': elapsed,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "WebSocket load test: N rooms x M participants sending editor ops, "
+        "whiteboard strokes, whole-state updates and timer restarts at set rates. "
+        "Reports throughput, p50/p95/p99 fan-out latency per message type, memory "
+        "per socket and event loop lag, and writes them as JSON to compare runs "
+        "between commits. Runs the consumer in-process by default; with --url it "
+        "drives a running server from several client processes (needs `websockets`)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--participants', type=int, default=5, help="Per room")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds of traffic")
+        parser.add_argument('--txt-op-rate', type=float, default=2.0, help="Editor ops per participant per second")
+        parser.add_argument('--wb-ops-rate', type=float, default=5.0, help="Strokes per participant per second")
+        parser.add_argument('--txt-update-rate', type=float, default=0.0, help="Whole-document updates per participant per second")
+        parser.add_argument('--wb-buffer-rate', type=float, default=0.2, help="Whole-canvas images per participant per second")
+        parser.add_argument('--start-timer-rate', type=float, default=0.1, help="Timer restarts per room per second")
+        parser.add_argument('--update-bytes', type=int, default=2000, help="Size of a whole-document update")
+        parser.add_argument('--buffer-bytes', type=int, default=20000, help="Size of a whole-canvas image")
+        parser.add_argument('--binary', action='store_true', help="Ask for binary frames")
+        parser.add_argument('--url', help="ws:// URL of a running server, e.g. ws://127.0.0.1:8000/ws/")
+        parser.add_argument('--processes', type=int, default=4, help="Client processes with --url")
+        parser.add_argument('--metrics-token', default='', help="Bearer token for the server's /metrics")
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--compare', help="Results JSON of an earlier run to compare against")
+        parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed regression against --compare")
+
+    def handle(self, *args, **options):
+        sessions = self.create_sessions(options['rooms'], options['participants'])
+        rooms = [str(session.id) for session in sessions]
+        try:
+            if options['url']:
+                run = self.run_remote(rooms, options)
+            else:
+                run = asyncio.run(self.run_local(rooms, options))
+        finally:
+            for session in sessions:
+                session.delete()
+                room_store.forget(str(session.id))
+            room_store.drain()
+
+        results = self.summarise(run, options)
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['compare']:
+            self.compare(results, options['compare'], options['tolerance'])
+
+    def create_sessions(self, count, participants):
+        creator, _ = User.objects.get_or_create(username='bench', defaults={'email': 'bench@example.com'})
+        now = timezone.now()
+        return [
+            InterviewSession.objects.create(
+                title=f"WebSocket bench {i}",
+                start_time=now - timedelta(minutes=1),
+                end_time=now + timedelta(hours=1),
+                is_active=True,
+                max_participants=participants,
+                access_code=uuid.uuid4().hex[:10].upper(),
+                created_by=creator,
+            )
+            for i in range(count)
+        ]
+
+    async def run_local(self, rooms, options):
+        from channels.testing import WebsocketCommunicator
+        from django.contrib.auth.models import AnonymousUser
+
+        from core import metrics
+        from core.consumers import WSConsumer
+
+        latencies, timers = {}, {}
+        participants = [
+            Participant(room, index, options, latencies, timers)
+            for room in rooms for index in range(options['participants'])
+        ]
+
+        async def connect(participant):
+            communicator = WebsocketCommunicator(WSConsumer.as_asgi(), "/ws/")
+            communicator.scope['user'] = AnonymousUser()
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError("Could not connect")
+            await communicator.send_to(text_data=dumps(participant.join_message()))
+
+            async def receive():
+                output = await communicator.output_queue.get()
+                if output['type'] != 'websocket.send':
+                    return None
+                return output.get('bytes') or output.get('text')
+
+            participant.receive(await receive())
+
+            async def send(text):
+                await communicator.send_to(text_data=text)
+            return send, receive, communicator.disconnect
+
+        metrics.watch_event_loop()
+        before = self.parse_metrics(metrics.render())
+        elapsed = await run_participants(participants, self.measure_connect(connect, metrics.render), options)
+        after = self.parse_metrics(metrics.render())
+        return {
+            'mode': 'in-process',
+            'latencies': latencies,
+            'sent': sum(p.sent for p in participants),
+            'received': sum(p.received for p in participants),
+            'elapsed': elapsed,
+            'memory': self.connect_memory,
+            'lag': self.histogram_delta(before, after, 'event_loop_lag_seconds'),
+        }
+
+    def measure_connect(self, connect, scrape):
+        # Wraps connect() to note resident memory before the first and after
+        # the last connection, i.e. what the open sockets cost
+        state = {'connected': 0}
+        self.connect_memory = None
+
+        async def measured(participant):
+            if state['connected'] == 0:
+                state['before'] = self.parse_metrics(scrape()).get('process_resident_memory_bytes', 0)
+            connection = await connect(participant)
+            state['connected'] += 1
+            if state['connected'] == participant.options['rooms'] * participant.options['participants']:
+                grown = self.parse_metrics(scrape()).get('process_resident_memory_bytes', 0) - state['before']
+                self.connect_memory = {'sockets': state['connected'], 'bytes_per_socket': grown / state['connected']}
+            return connection
+        return measured
+
+    def run_remote(self, rooms, options):
+        try:
+            import websockets  # noqa: F401
+        except ImportError:
+            raise CommandError("--url needs the `websockets` package")
+
+        metrics_url = re.sub(r'^ws', 'http', options['url'].split('/ws/')[0].rstrip('/')) + '/metrics'
+        before = self.scrape(metrics_url, options['metrics_token'])
+        processes = max(1, min(options['processes'], len(rooms)))
+        chunks = [rooms[i::processes] for i in range(processes)]
+
+        # Connections are made by the children; memory is read from the
+        # server's /metrics once they are all in, so sample it while they run.
+        # The children don't use the database, don't let them inherit it.
+        connections.close_all()
+        with get_context('fork').Pool(processes) as pool:
+            pending = pool.starmap_async(client_process, [(options['url'], chunk, options) for chunk in chunks])
+            connected = self.wait_for_sockets(metrics_url, options, before)
+            runs = pending.get()
+        after = self.scrape(metrics_url, options['metrics_token'])
+
+        latencies = {}
+        for run in runs:
+            for kind, values in run['latencies'].items():
+                latencies.setdefault(kind, []).extend(values)
+        memory = None
+        if connected and before:
+            sockets = connected.get('ws_sockets', 0) - before.get('ws_sockets', 0)
+            grown = connected.get('process_resident_memory_bytes', 0) - before.get('process_resident_memory_bytes', 0)
+            if sockets > 0:
+                memory = {'sockets': int(sockets), 'bytes_per_socket': grown / sockets}
+        return {
+            'mode': f"{options['url']} x {processes} processes",
+            'latencies': latencies,
+            'sent': sum(run['sent'] for run in runs),
+            'received': sum(run['received'] for run in runs),
+            'elapsed': max(run['elapsed'] for run in runs),
+            'memory': memory,
+            'lag': self.histogram_delta(before, after, 'event_loop_lag_seconds') if before and after else None,
+        }
+
+    def wait_for_sockets(self, metrics_url, options, before):
+        if not before:
+            return None
+        expected = before.get('ws_sockets', 0) + options['rooms'] * options['participants']
+        deadline = time.monotonic() + min(options['duration'], 30)
+        while time.monotonic() < deadline:
+            current = self.scrape(metrics_url, options['metrics_token'])
+            if current and current.get('ws_sockets', 0) >= expected:
+                return current
+            time.sleep(0.1)
+        return None
+
+    def scrape(self, url, token):
+        request = urllib.request.Request(url)
+        if token:
+            request.add_header('Authorization', f"Bearer {token}")
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return self.parse_metrics(response.read().decode())
+        except OSError as e:
+            self.stderr.write(f"Could not read {url}: {e}")
+            return None
+
+    def parse_metrics(self, text):
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                name, _, value = line.rpartition(' ')
+                samples[name] = float(value)
+        return samples
+
+    def histogram_delta(self, before, after, name):
+        """Quantiles (ms) of what a histogram observed between two scrapes."""
+        prefix = f'{name}_bucket{{le="'
+        buckets = []
+        for key, value in after.items():
+            if key.startswith(prefix):
+                bound = key[len(prefix):-2]
+                buckets.append((float('inf') if bound == '+Inf' else float(bound), value - before.get(key, 0)))
+        buckets.sort()
+        count = buckets[-1][1] if buckets else 0
+        if not count:
+            return None
+
+        def quantile(q):
+            rank, lower, seen = q * count, 0.0, 0
+            for bound, cumulative in buckets:
+                if cumulative >= rank:
+                    if bound == float('inf'):
+                        return lower * 1000
+                    # Linear within the bucket, like Prometheus' histogram_quantile
+                    inside = cumulative - seen
+                    return (lower + (bound - lower) * ((rank - seen) / inside if inside else 1)) * 1000
+                lower, seen = bound, cumulative
+            return lower * 1000
+
+        total = after.get(f'{name}_sum', 0) - before.get(f'{name}_sum', 0)
+        return {
+            'count': int(count),
+            'mean': round(total / count * 1000, 3),
+            'p50': round(quantile(0.5), 3),
+            'p95': round(quantile(0.95), 3),
+            'p99': round(quantile(0.99), 3),
+        }
+
+    def summarise(self, run, options):
+        all_latencies = [value for values in run['latencies'].values() for value in values]
+        config = {key: options[key] for key in (
+            'rooms', 'participants', 'duration', 'binary', 'update_bytes', 'buffer_bytes',
+        )}
+        config.update({f"{kind}_rate": options[f"{kind}_rate"] for kind in KINDS})
+        return {
+            'commit': self.commit(),
+            'time': timezone.now().isoformat(),
+            'mode': run['mode'],
+            'config': config,
+            'throughput': {
+                'sent_per_s': round(run['sent'] / run['elapsed'], 1),
+                'delivered_per_s': round(run['received'] / run['elapsed'], 1),
+            },
+            'latency_ms': {
+                'all': quantiles(all_latencies),
+                **{kind: quantiles(values) for kind, values in sorted(run['latencies'].items())},
+            },
+            'memory': run['memory'],
+            'event_loop_lag_ms': run['lag'],
+        }
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, results):
+        config = results['config']
+        self.stdout.write(
+            f"{results['mode']}: {config['rooms']} rooms x {config['participants']} participants "
+            f"for {config['duration']}s (commit {results['commit']})"
+        )
+        throughput = results['throughput']
+        self.stdout.write(f"sent {throughput['sent_per_s']}/s   delivered {throughput['delivered_per_s']}/s")
+        for kind, stats in results['latency_ms'].items():
+            if stats:
+                self.stdout.write(
+                    f"{kind:<12} p50 {stats['p50']:8.2f} ms   p95 {stats['p95']:8.2f} ms   "
+                    f"p99 {stats['p99']:8.2f} ms   ({stats['count']})"
+                )
+        if results['memory']:
+            memory = results['memory']
+            self.stdout.write(f"memory       {memory['bytes_per_socket'] / 1024:.1f} KiB per socket ({memory['sockets']} sockets)")
+        lag = results['event_loop_lag_ms']
+        if lag:
+            self.stdout.write(f"loop lag     p50 {lag['p50']:8.2f} ms   p95 {lag['p95']:8.2f} ms   p99 {lag['p99']:8.2f} ms")
+
+    def compare(self, results, path, tolerance):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = []
+        for kind, stats in results['latency_ms'].items():
+            old = baseline.get('latency_ms', {}).get(kind)
+            if stats and old:
+                change = stats['p95'] / old['p95'] - 1 if old['p95'] else 0
+                self.stdout.write(f"{kind:<12} p95 {old['p95']:8.2f} -> {stats['p95']:8.2f} ms ({change:+.0%})")
+                if change > tolerance:
+                    regressions.append(f"{kind} p95")
+        old = baseline.get('throughput', {}).get('delivered_per_s')
+        if old:
+            change = results['throughput']['delivered_per_s'] / old - 1
+            self.stdout.write(f"delivered/s  {old} -> {results['throughput']['delivered_per_s']} ({change:+.0%})")
+            if change < -tolerance:
+                regressions.append("delivered/s")
+        if regressions:
+            raise CommandError(f"Regressed against {baseline.get('commit') or path}: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS(f"Within {tolerance:.0%} of {baseline.get('commit') or path}"))
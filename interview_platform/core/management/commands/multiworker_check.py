@@ -0,0 +1,207 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.models import InterviewSession, User
+from core.persistence import room_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Start several Daphne workers sharing one Redis (or a local fakeredis "
+        "stand-in), connect one participant of the same room to each worker and "
+        "check that editor and whiteboard ops fan out and converge across them, "
+        "and that a dropped client can resume on another worker. "
+        "Needs the `websockets` package, and `fakeredis` unless --redis-url is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=3)
+        parser.add_argument('--base-port', type=int, default=8100)
+        parser.add_argument('--redis-url', help="Use this Redis instead of starting a local stand-in")
+        parser.add_argument('--redis-port', type=int, default=6390, help="Port for the local stand-in")
+        parser.add_argument('--timeout', type=float, default=10.0)
+
+    def handle(self, *args, **options):
+        try:
+            import websockets  # noqa: F401
+        except ImportError:
+            raise CommandError("multiworker_check needs the `websockets` package")
+
+        redis_url = options['redis_url'] or self.start_stand_in(options['redis_port'])
+        ports = [options['base_port'] + i for i in range(options['workers'])]
+        # Sockets only join rooms of real sessions; the workers read it from
+        # the same database. Room for everyone plus the late joiner and the
+        # resuming client
+        session = self.create_session(len(ports) + 2)
+        room_id = str(session.id)
+        workers = []
+        try:
+            for port in ports:
+                workers.append(self.start_worker(port, redis_url))
+            for port in ports:
+                self.wait_for_port(port, options['timeout'])
+            self.stdout.write(f"{len(ports)} workers up on ports {ports}, Redis at {redis_url}")
+            asyncio.run(self.check_room(ports, room_id, options['timeout']))
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+            session.delete()
+            room_store.forget(room_id)
+            room_store.drain()
+
+        self.stdout.write(self.style.SUCCESS("Room state converged across all workers"))
+
+    def create_session(self, participants):
+        creator, _ = User.objects.get_or_create(username='bench', defaults={'email': 'bench@example.com'})
+        now = timezone.now()
+        return InterviewSession.objects.create(
+            title="Multi-worker check",
+            start_time=now - timedelta(minutes=1),
+            end_time=now + timedelta(hours=1),
+            max_participants=participants,
+            access_code=uuid.uuid4().hex[:10].upper(),
+            created_by=creator,
+        )
+
+    def start_stand_in(self, port):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError("Install `fakeredis` (with `lupa`) or pass --redis-url")
+        import redis
+        from redis.lock import Lock
+
+        stand_in = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        threading.Thread(target=stand_in.serve_forever, daemon=True).start()
+        url = f"redis://127.0.0.1:{port}/0"
+
+        from src.redis_server import RECORD_FRAME
+
+        # The stand-in drops the connection instead of replying NOSCRIPT, so
+        # register the room lock's and the frame log's scripts before any
+        # worker runs EVALSHA
+        client = redis.Redis.from_url(url)
+        for script in (Lock.LUA_RELEASE_SCRIPT, Lock.LUA_EXTEND_SCRIPT, Lock.LUA_REACQUIRE_SCRIPT, RECORD_FRAME):
+            client.script_load(script)
+        return url
+
+    def start_worker(self, port, redis_url):
+        return subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port),
+             'interview_platform.asgi:application'],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'REDIS_URL': redis_url},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def wait_for_port(self, port, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise CommandError(f"Worker on port {port} did not start")
+
+    async def check_room(self, ports, room_id, timeout):
+        import websockets
+
+        clients = []
+        for port in ports:
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}/ws/")
+            await ws.send(json.dumps({'join': room_id}))
+            uid = None
+            while uid is None:
+                uid = json.loads(await asyncio.wait_for(ws.recv(), timeout)).get('join')
+            clients.append((ws, uid))
+
+        try:
+            # Every participant types concurrently against revision 0
+            for i, (ws, _) in enumerate(clients):
+                await ws.send(json.dumps({'type': 'txt_op', 'rev': 0, 'ops': [{'p': 0, 'i': f"<{i}>"}]}))
+            await clients[0][0].send(json.dumps({
+                'type': 'wb_ops',
+                'ops': [{'t': 'stroke', 'pts': [0, 0, 10, 10], 'color': '#000', 'width': 2}],
+            }))
+
+            # Each one has to see all ops, in the same server order
+            orders = []
+            for ws, _ in clients:
+                orders.append(await self.collect_ops(ws, len(clients), timeout))
+            if any(order != orders[0] for order in orders):
+                raise CommandError(f"Workers delivered ops in different orders: {orders}")
+
+            # A late joiner on any worker gets the converged document
+            ws = await websockets.connect(f"ws://127.0.0.1:{ports[-1]}/ws/")
+            await ws.send(json.dumps({'join': room_id}))
+            message = {}
+            while 'join' not in message:
+                message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+            text = message['editor']['text']
+            board = message['whiteboard']['ops']
+            await ws.close()
+
+            # Dropped on one worker, resumed on another: only the missed op
+            # comes back, numbered by the room's shared log
+            missed = await self.resume_elsewhere(ports, room_id, clients[0][0], message, timeout)
+        finally:
+            for ws, _ in clients:
+                await ws.close()
+
+        expected = {f"<{i}>" for i in range(len(clients))}
+        if len(text) != sum(len(part) for part in expected) or not all(part in text for part in expected):
+            raise CommandError(f"Late joiner got {text!r}, expected all of {sorted(expected)}")
+        if len(board) != 1:
+            raise CommandError(f"Late joiner got whiteboard {board!r}")
+        self.stdout.write(f"Converged document: {text!r}")
+        self.stdout.write(f"Resumed on another worker with {missed}")
+
+    async def collect_ops(self, ws, count, timeout):
+        revisions = []
+        while len(revisions) < count:
+            message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+            # Room events may arrive coalesced into one batch frame
+            events = message['events'] if message.get('type') == 'batch' else [message]
+            for event in events:
+                if event.get('type') == 'txt_op':
+                    revisions.append((event['rev'], event['uid']))
+        return revisions
+
+    async def resume_elsewhere(self, ports, room_id, writer, joined, timeout):
+        import websockets
+
+        await writer.send(json.dumps({'type': 'txt_op', 'rev': 0, 'ops': [{'p': 0, 'i': "!"}]}))
+        await asyncio.sleep(0.5)
+        ws = await websockets.connect(f"ws://127.0.0.1:{ports[0]}/ws/")
+        await ws.send(json.dumps({
+            'join': room_id,
+            'resume': {'seq': joined['seq'], 'epoch': joined['epoch']},
+        }))
+        message = {}
+        while 'join' not in message:
+            message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+        await ws.close()
+        if not message.get('resumed'):
+            raise CommandError(f"Resume fell back to a snapshot: {message}")
+        events = []
+        for frame in message['events']:
+            events += frame['events'] if frame['type'] == 'batch' else [frame]
+        if [event['type'] for event in events] != ['txt_op'] or message['seq'] != joined['seq'] + len(message['events']):
+            raise CommandError(f"Resume replayed {message['events']} from seq {joined['seq']}")
+        return [(frame['seq'], frame['type']) for frame in message['events']]
@@ -0,0 +1,174 @@
+import asyncio
+import statistics
+import time
+import uuid
+from datetime import timedelta
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django.utils import timezone
+
+from core import frames
+from core.consumers import WSConsumer
+from core.models import InterviewSession, User
+from core.persistence import room_store
+from core.sendqueue import SendQueue
+from core.serializer import loads
+
+
+class SlowConsumer(WSConsumer):
+    """A participant on a slow link: every frame takes `delay` to go out."""
+    delay = 0.05
+
+    async def send(self, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        await super().send(*args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate a busy room in-process: one participant draws a steady stream "
+        "of strokes that the others receive, first with fast participants only, "
+        "then with one participant on a slow link added. Reports the fast "
+        "participants' delivery latency in both runs and the slow client's "
+        "queue handling, and fails if the slow client slows the others down."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fast', type=int, default=8, help="Fast participants")
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--rate', type=float, default=200.0, help="Strokes per second")
+        parser.add_argument('--slow-delay-ms', type=float, default=100.0, help="Time the slow client takes per frame")
+        parser.add_argument('--budget-ms', type=float, default=50.0, help="p95 latency budget for fast participants")
+        parser.add_argument('--queue-limit', type=int, default=None, help="Override WS_SEND_QUEUE_LIMIT")
+        parser.add_argument('--policy', choices=['coalesce', 'disconnect'], default=None, help="Override WS_SLOW_CLIENT_POLICY")
+        parser.add_argument('--binary', action='store_true', help="Use binary frames")
+
+    def handle(self, *args, **options):
+        SlowConsumer.delay = options['slow_delay_ms'] / 1000
+        overrides = {}
+        if options['queue_limit']:
+            overrides['WS_SEND_QUEUE_LIMIT'] = options['queue_limit']
+        if options['policy']:
+            overrides['WS_SLOW_CLIENT_POLICY'] = options['policy']
+        # Sockets only join rooms of real sessions, one per run
+        sessions = [self.create_session(options['fast'] + 1) for _ in range(2)]
+        try:
+            with override_settings(**overrides):
+                baseline = asyncio.run(self.run_room(str(sessions[0].id), options, slow=False))
+                loaded = asyncio.run(self.run_room(str(sessions[1].id), options, slow=True))
+        finally:
+            for session in sessions:
+                session.delete()
+            room_store.drain()
+
+        for name, latencies in (('fast only', baseline), ('with slow client', loaded)):
+            p50 = statistics.median(latencies)
+            p95 = statistics.quantiles(latencies, n=20)[-1]
+            self.stdout.write(f"{name:<17} p50 {p50:6.2f} ms   p95 {p95:6.2f} ms   ({len(latencies)} deliveries)")
+        self.stdout.write(f"Send queues: {SendQueue.snapshot()}")
+
+        p95 = statistics.quantiles(loaded, n=20)[-1]
+        if p95 > options['budget_ms']:
+            raise CommandError(f"Fast participants' p95 latency {p95:.2f} ms is over the {options['budget_ms']} ms budget")
+        self.stdout.write(self.style.SUCCESS("Fast participants were not held up by the slow one"))
+
+    def create_session(self, participants):
+        creator, _ = User.objects.get_or_create(username='bench', defaults={'email': 'bench@example.com'})
+        now = timezone.now()
+        return InterviewSession.objects.create(
+            title="Slow client check",
+            start_time=now - timedelta(minutes=1),
+            end_time=now + timedelta(hours=1),
+            max_participants=participants,
+            access_code=uuid.uuid4().hex[:10].upper(),
+            created_by=creator,
+        )
+
+    async def connect(self, consumer, room_id, binary):
+        communicator = WebsocketCommunicator(consumer.as_asgi(), "/ws/")
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise CommandError("Could not connect")
+        await communicator.send_json_to({'join': room_id, 'binary': binary})
+        return communicator
+
+    async def run_room(self, room_id, options, slow):
+        sent = {}
+        latencies = []
+        slow_stats = {'frames': 0, 'resyncs': 0, 'closed': False, 'peak_depth': 0}
+
+        clients = [await self.connect(WSConsumer, room_id, options['binary']) for _ in range(options['fast'])]
+        slow_client = await self.connect(SlowConsumer, room_id, options['binary']) if slow else None
+        sender = clients[0]
+
+        async def receive_fast(communicator):
+            while True:
+                for message in self.messages(await communicator.output_queue.get()):
+                    if message.get('type') != 'wb_ops':
+                        continue
+                    now = time.perf_counter()
+                    for op in message['ops']:
+                        if op['t'] == 'stroke' and op['pts'][0] in sent:
+                            latencies.append((now - sent[op['pts'][0]]) * 1000)
+
+        async def receive_slow(communicator):
+            while True:
+                output = await communicator.output_queue.get()
+                if output['type'] == 'websocket.close':
+                    slow_stats['closed'] = True
+                    return
+                slow_stats['frames'] += 1
+                for message in self.messages(output):
+                    if message.get('type') == 'txt_snapshot':
+                        slow_stats['resyncs'] += 1
+
+        async def sample_depth():
+            while True:
+                depth = SendQueue.snapshot()['max_depth']
+                slow_stats['peak_depth'] = max(slow_stats['peak_depth'], depth)
+                await asyncio.sleep(0.02)
+
+        readers = [asyncio.create_task(receive_fast(c)) for c in clients[1:]]
+        readers.append(asyncio.create_task(sample_depth()))
+        if slow_client:
+            readers.append(asyncio.create_task(receive_slow(slow_client)))
+
+        try:
+            await asyncio.sleep(0.2)
+            interval = 1 / options['rate']
+            for i in range(options['messages']):
+                sent[i] = time.perf_counter()
+                await sender.send_json_to({
+                    'type': 'wb_ops',
+                    'ops': [{'t': 'stroke', 'pts': [i, 0, i, 1], 'color': '#000', 'width': 2}],
+                })
+                await asyncio.sleep(interval)
+            await asyncio.sleep(0.5)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            for communicator in clients + ([slow_client] if slow_client else []):
+                await communicator.disconnect()
+            room_store.forget(room_id)
+
+        if slow_client:
+            self.stdout.write(
+                f"Slow client: {slow_stats['frames']} frames received, {slow_stats['resyncs']} resyncs, "
+                f"peak queue depth {slow_stats['peak_depth']}, {'closed' if slow_stats['closed'] else 'still connected'}"
+            )
+        if not latencies:
+            raise CommandError("No strokes were delivered")
+        return latencies
+
+    def messages(self, output):
+        if output.get('bytes') is not None:
+            message = frames.decode(output['bytes'])[0]
+        elif output.get('text'):
+            message = loads(output['text'])
+        else:
+            return []
+        return message['events'] if message.get('type') == 'batch' else [message]
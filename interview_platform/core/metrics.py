@@ -0,0 +1,322 @@
+import asyncio
+import bisect
+import functools
+import math
+import os
+import threading
+import time
+
+from channels.db import database_sync_to_async
+
+# Process-wide metrics, served in the Prometheus text format by /metrics
+# (core.views.metrics_view). Recording is a dict update under a lock, so it is
+# fine on every message; anything that is already counted elsewhere (queue
+# depths, cache hits, ...) is read through a callback only when scraped.
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# Message size buckets, in bytes
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# How often the event loop lag is sampled, in seconds
+LOOP_LAG_INTERVAL = 0.1
+
+# Inbound message types worth a label of their own; anything else a client
+# sends is counted as 'other' so clients can't blow up the label set
+INBOUND_TYPES = {'join', 'txt_op', 'wb_ops', 'start_timer', 'get_timer', 'txt_update', 'wb_buffer'}
+
+registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    # Exact digits, like prometheus_client: '{:g}' keeps 6 significant digits
+    # and turns a counter at 1234567 into 1.23457e+06
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format(value)}")
+        return lines
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    """Monotonic count, optionally split by label values."""
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}  # label values -> count
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [('_total', _labels(self.labelnames, labels), value) for labels, value in values]
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets."""
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket (+Inf last), sum]
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *labels):
+        """Context manager observing how long its block takes, in seconds."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                names = self.labelnames + ('le',)
+                samples.append(('_bucket', _labels(names, labels + (bound,)), cumulative))
+            samples.append(('_sum', _labels(self.labelnames, labels), total))
+            samples.append(('_count', _labels(self.labelnames, labels), cumulative))
+        return samples
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Gauge(Metric):
+    """A value read from `read()` at scrape time.
+
+    read() returns a number, or a {label values: number} dict for a labelled
+    gauge. Use type='counter' for totals something else already keeps.
+    """
+
+    def __init__(self, name, help, read, labels=(), type='gauge'):
+        super().__init__(name, help, labels)
+        self.read = read
+        self.type = type
+
+    def samples(self):
+        suffix = '_total' if self.type == 'counter' else ''
+        value = self.read()
+        if not isinstance(value, dict):
+            return [(suffix, '', value)]
+        return [(suffix, _labels(self.labelnames, labels), v) for labels, v in value.items()]
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            # A broken callback shouldn't take the whole page down
+            continue
+    return '\n'.join(lines) + '\n'
+
+
+def db_call(name):
+    """database_sync_to_async that also records the call's latency.
+
+    The time includes waiting for a thread, which is what the event loop
+    actually waits for.
+    """
+    def decorator(func):
+        call = database_sync_to_async(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                DB_CALL_SECONDS.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+
+_loop_watcher = None
+
+
+def watch_event_loop():
+    """Sample the running event loop's lag into LOOP_LAG_SECONDS (no-op once started)."""
+    global _loop_watcher
+    if _loop_watcher is not None and not _loop_watcher.done():
+        return
+    _loop_watcher = asyncio.create_task(_watch_event_loop())
+
+
+async def _watch_event_loop():
+    # A timer due in LOOP_LAG_INTERVAL fires that much late when handlers
+    # hog the loop: everything else on it waits just as long
+    loop = asyncio.get_running_loop()
+    while True:
+        due = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(loop.time() - due, 0))
+
+
+def inbound_type(data):
+    if 'join' in data:
+        return 'join'
+    kind = data.get('type')
+    return kind if kind in INBOUND_TYPES else 'other'
+
+
+WS_MESSAGES_IN = Counter('ws_messages_in', "WebSocket messages received, by type", ['type'])
+WS_MESSAGES_OUT = Counter('ws_messages_out', "WebSocket frames queued for clients, by the event types they carry", ['type'])
+WS_MESSAGE_BYTES = Histogram(
+    'ws_message_bytes', "Size of WebSocket messages, by direction and format",
+    ['direction', 'format'], buckets=SIZE_BUCKETS,
+)
+WS_CONNECTIONS = Counter('ws_connections', "WebSocket connections accepted")
+WS_REJECTED = Counter('ws_rejected', "Room joins turned away, by reason", ['reason'])
+WS_RESUMES = Counter('ws_resumes', "Reconnects asking to resume, by how they caught up", ['outcome'])
+GROUP_SEND_SECONDS = Histogram('channel_group_send_seconds', "Channel layer group_send latency, by group kind", ['group'])
+DB_CALL_SECONDS = Histogram('db_call_seconds', "Database calls made from the event loop, by call", ['call'])
+HTTP_VIEW_SECONDS = Histogram('http_view_seconds', "View latency, by view", ['view'])
+LOOP_LAG_SECONDS = Histogram('event_loop_lag_seconds', "How late the event loop runs a timer")
+
+
+def _resident_memory():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, AttributeError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Not Linux: the peak is the best there is (bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _sockets():
+    from core.sendqueue import SendQueue
+    return len(SendQueue.instances)
+
+
+def _rooms():
+    from core.clock import room_clock
+    return len(room_clock.members)
+
+
+def _send_queues():
+    from core.sendqueue import SendQueue
+    return SendQueue.snapshot()
+
+
+def _session_cache():
+    from core.session_cache import session_cache
+    return session_cache.stats()
+
+
+def _access_codes():
+    from core.access_codes import access_code_index
+    return access_code_index.stats()
+
+
+def _join_throttle():
+    from core.throttle import join_throttle
+    return join_throttle.stats()
+
+
+def _outbox():
+    from core.outbox import room_outbox
+    return room_outbox.stats()
+
+
+def _room_store():
+    from core.persistence import room_store
+    return room_store.queue.qsize()
+
+
+Gauge('process_resident_memory_bytes', "Resident memory of this process", _resident_memory)
+Gauge('ws_sockets', "Open WebSocket connections in this process, in a room or not", _sockets)
+Gauge('ws_rooms', "Rooms with at least one socket in this process", _rooms)
+Gauge('ws_send_queue_frames', "Frames waiting in send queues", lambda: _send_queues()['queued'])
+Gauge('ws_send_queue_max_depth', "Deepest send queue", lambda: _send_queues()['max_depth'])
+Gauge(
+    'ws_send_queue_frames_handled', "Send queue frames by outcome",
+    lambda: {(key,): _send_queues()[key] for key in ('sent', 'superseded', 'dropped')},
+    labels=['outcome'], type='counter',
+)
+Gauge('ws_slow_client_resyncs', "Slow clients resynced from a snapshot", lambda: _send_queues()['resyncs'], type='counter')
+Gauge('ws_slow_client_disconnects', "Slow clients disconnected", lambda: _send_queues()['disconnects'], type='counter')
+Gauge(
+    'session_cache_lookups', "Session metadata cache lookups by result",
+    lambda: {('hit',): _session_cache()['hits'], ('miss',): _session_cache()['misses']},
+    labels=['result'], type='counter',
+)
+Gauge('session_cache_entries', "Session metadata cache entries", lambda: _session_cache()['size'])
+Gauge(
+    'access_code_lookups', "Access code index lookups by result",
+    lambda: {('hit',): _access_codes()['hits'], ('miss',): _access_codes()['misses']},
+    labels=['result'], type='counter',
+)
+Gauge('access_code_entries', "Access codes held by the index", lambda: _access_codes()['size'])
+Gauge('access_code_index_loads', "Reloads of the whole access code index", lambda: _access_codes()['loads'], type='counter')
+Gauge('join_throttled', "Join attempts refused by the per-IP throttle", lambda: _join_throttle()['throttled'], type='counter')
+Gauge('join_throttle_clients', "Client IPs with recent wrong access codes", lambda: _join_throttle()['keys'])
+Gauge('room_outbox_events', "Room events queued for broadcast", lambda: _outbox()['events'], type='counter')
+Gauge('room_outbox_publishes', "Batched room broadcasts published", lambda: _outbox()['publishes'], type='counter')
+Gauge('room_store_pending_writes', "Room ops and snapshots waiting to be persisted", _room_store)
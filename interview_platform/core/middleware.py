@@ -0,0 +1,66 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.utils.decorators import sync_and_async_middleware
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from core.metrics import HTTP_VIEW_SECONDS
+
+
+@sync_and_async_middleware
+def view_metrics(get_response):
+    """Record how long each view takes (core.metrics.HTTP_VIEW_SECONDS)."""
+
+    def record(request, start):
+        # Requests that never reach a view (e.g. static files) aren't counted
+        match = request.resolver_match
+        if match is not None:
+            HTTP_VIEW_SECONDS.observe(time.perf_counter() - start, match.url_name or match.view_name)
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            record(request, start)
+            return response
+        markcoroutinefunction(middleware)
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            record(request, start)
+            return response
+    return middleware
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoiseMiddleware that also runs in async mode.
+
+    WhiteNoise only has a sync __call__, and one sync middleware makes Django
+    run the whole chain in a thread and the async views under it through
+    async_to_sync. Here other requests go straight on to the next handler on
+    the event loop; only serving a file (opening and stat-ing it) is done in
+    a worker thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_session'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='interviewsession',
+            index=models.Index(fields=['end_time', 'start_time'], name='session_window_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interviewsession',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-start_time'], name='session_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='interviewsession',
+            index=models.Index(fields=['created_by', '-start_time'], name='session_creator_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:01
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_emaildelivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(max_length=64, unique=True)),
+                ('text', models.TextField(blank=True)),
+                ('text_rev', models.PositiveIntegerField(default=0)),
+                ('wb_ops', models.JSONField(default=list)),
+                ('wb_rev', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RoomOp',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.CharField(max_length=64)),
+                ('kind', models.CharField(choices=[('txt', 'Editor'), ('wb', 'Whiteboard')], max_length=3)),
+                ('rev', models.PositiveIntegerField()),
+                ('ops', models.JSONField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room_id', 'kind', 'rev'], name='room_op_log_idx')],
+            },
+        ),
+    ]
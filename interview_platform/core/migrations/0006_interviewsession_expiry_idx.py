@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_room_persistence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='interviewsession',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['end_time'], name='session_expiry_idx'),
+        ),
+    ]
@@ -49,6 +49,20 @@ class InterviewSession(models.Model):
         self.is_active = (self.start_time <= now <= self.end_time)
         
         super().save(*args, **kwargs)
+        
+        # Drop the consumers' cached copy so the new times are read back,
+        # and index the (possibly new) code for join_session
+        from core.access_codes import access_code_index
+        from core.session_cache import session_cache
+        session_cache.invalidate(self.id)
+        access_code_index.update(self.id, self.access_code)
+    
+    def delete(self, *args, **kwargs):
+        from core.access_codes import access_code_index
+        from core.session_cache import session_cache
+        session_cache.invalidate(self.id)
+        access_code_index.update(self.id, None)
+        return super().delete(*args, **kwargs)
     
     @property
     def status(self):
@@ -68,6 +82,19 @@ class InterviewSession(models.Model):
         self.is_active = (self.start_time <= now <= self.end_time)
         if old_status != self.is_active:
             self.save(update_fields=['is_active'])
+            from core.lobby import notify_lobby
+            notify_lobby('session_activated' if self.is_active else 'session_expired', [self])
+        return self.is_active
+    
+    async def aupdate_status(self):
+        """update_status() for async views."""
+        now = timezone.now()
+        old_status = self.is_active
+        self.is_active = (self.start_time <= now <= self.end_time)
+        if old_status != self.is_active:
+            await self.asave(update_fields=['is_active'])
+            from core.lobby import anotify_lobby
+            await anotify_lobby('session_activated' if self.is_active else 'session_expired', [self])
         return self.is_active
     
     def is_expired(self):
@@ -75,8 +102,76 @@ class InterviewSession(models.Model):
         now = timezone.now()
         return now > self.end_time
     
+    @classmethod
+    def _stale_statuses(cls, now):
+        """(sessions, is_active, lobby event) for each way is_active can lag the clock.
+
+        Both querysets only touch sessions that haven't ended or are still
+        flagged active (session_expiry_idx, session_window_idx), so the cost
+        doesn't grow with the number of past sessions.
+        """
+        # order_by() drops the default ordering so the indexes can be used
+        return [
+            (cls.objects.filter(is_active=True, end_time__lt=now).order_by(), False, 'session_expired'),
+            (cls.objects.filter(
+                is_active=False, start_time__lte=now, end_time__gte=now
+            ).order_by(), True, 'session_activated'),
+        ]
+    
+    @classmethod
+    def refresh_statuses(cls, now=None):
+        """Bring is_active in line with the clock for every session at once.
+
+        Bulk UPDATEs instead of saving sessions one by one; the lobby is told
+        about sessions whose status actually changed. When several processes
+        race, only the one whose UPDATE flipped the rows announces them.
+        """
+        from core.lobby import notify_lobby
+        for stale, is_active, event in cls._stale_statuses(now or timezone.now()):
+            sessions = list(stale)
+            ids = [s.id for s in sessions]
+            if sessions and cls.objects.filter(id__in=ids, is_active=not is_active).update(is_active=is_active):
+                for session in sessions:
+                    session.is_active = is_active
+                notify_lobby(event, sessions)
+    
+    @classmethod
+    async def arefresh_statuses(cls, now=None):
+        """refresh_statuses() for async views, on the async ORM."""
+        from core.lobby import anotify_lobby
+        for stale, is_active, event in cls._stale_statuses(now or timezone.now()):
+            sessions = [s async for s in stale]
+            ids = [s.id for s in sessions]
+            if sessions and await cls.objects.filter(id__in=ids, is_active=not is_active).aupdate(is_active=is_active):
+                for session in sessions:
+                    session.is_active = is_active
+                await anotify_lobby(event, sessions)
+    
     class Meta:
         ordering = ['-start_time']
+        indexes = [
+            # Active window (start_time <= now <= end_time), recently expired
+            # (end_time < now, newest first) and upcoming transitions
+            models.Index(fields=['end_time', 'start_time'], name='session_window_idx'),
+            # Sessions flagged active, newest first: only a handful of rows, so
+            # the partial index keeps the active list and the expiry UPDATE
+            # cheap (a plain index where partial indexes are unsupported)
+            models.Index(
+                fields=['-start_time'],
+                name='session_active_idx',
+                condition=models.Q(is_active=True),
+            ),
+            # Sessions still flagged active by end time: the expiry scan
+            # (is_active, end_time < now) only walks the running ones instead
+            # of every session that has ever ended
+            models.Index(
+                fields=['end_time'],
+                name='session_expiry_idx',
+                condition=models.Q(is_active=True),
+            ),
+            # A creator's sessions, newest first
+            models.Index(fields=['created_by', '-start_time'], name='session_creator_idx'),
+        ]
 
 
 class SessionParticipant(models.Model):
@@ -91,6 +186,60 @@ class SessionParticipant(models.Model):
         
     def __str__(self):
         return f"{self.user.username} in {self.session}"
+    
+    @classmethod
+    def add_all(cls, session, emails):
+        """Add a user per email to the session, creating the missing users.
+        
+        Runs a fixed number of queries however many emails there are. Call it
+        inside a transaction so a failure leaves no half-added panel. Returns
+        the users in the order of `emails`, duplicates dropped.
+        """
+        emails = list(dict.fromkeys(emails))
+        if not emails:
+            return []
+        
+        users = {}
+        for user in User.objects.filter(email__in=emails).order_by('id'):
+            users.setdefault(user.email, user)
+        missing = [email for email in emails if email not in users]
+        usernames = cls._free_usernames(missing)
+        missing = [User(email=email, username=username) for email, username in zip(missing, usernames)]
+        for user in User.objects.bulk_create(missing):
+            users[user.email] = user
+        
+        participants = [users[email] for email in emails]
+        # Present once they actually connect to the room (see core/consumers.py)
+        cls.objects.bulk_create([cls(session=session, user=user, is_present=False) for user in participants])
+        return participants
+    
+    @staticmethod
+    def _free_usernames(emails):
+        """A username per email, from its local part, that no user has yet.
+        
+        Different addresses can share a local part (alice@a.com and
+        alice@b.com), and an account may already hold it: the later ones get
+        a number appended (alice2, alice3...). Taken names are read in one
+        query.
+        """
+        if not emails:
+            return []
+        max_length = User._meta.get_field('username').max_length
+        # Room for a suffix within the column
+        bases = [email.split('@')[0][:max_length - 4] or 'user' for email in emails]
+        prefixes = models.Q()
+        for base in set(bases):
+            prefixes |= models.Q(username__startswith=base)
+        taken = set(User.objects.filter(prefixes).values_list('username', flat=True))
+        usernames = []
+        for base in bases:
+            username, n = base, 1
+            while username in taken:
+                n += 1
+                username = f"{base}{n}"
+            taken.add(username)
+            usernames.append(username)
+        return usernames
 
 
 class SessionCode(models.Model):
@@ -120,4 +269,63 @@ class Session(models.Model):
             return False
         if self.end_time and self.end_time < timezone.now():
             return False
-        return True
\ No newline at end of file
+        return True
+
+class EmailDelivery(models.Model):
+    """One outgoing email and how its delivery went (see core/mailer.py)."""
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+    
+    session = models.ForeignKey(InterviewSession, on_delete=models.SET_NULL, null=True, blank=True, related_name='email_deliveries')
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.subject} to {self.recipient}: {self.status}"
+
+
+class RoomSnapshot(models.Model):
+    """Compacted editor and whiteboard state of a room (see core/persistence.py)."""
+    room_id = models.CharField(max_length=64, unique=True)
+    text = models.TextField(blank=True)
+    text_rev = models.PositiveIntegerField(default=0)
+    wb_ops = models.JSONField(default=list)
+    wb_rev = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f"Snapshot of room {self.room_id} at {self.text_rev}/{self.wb_rev}"
+
+
+class RoomOp(models.Model):
+    """Editor or whiteboard ops applied to a room after its last snapshot."""
+    TEXT = 'txt'
+    WHITEBOARD = 'wb'
+    KIND_CHOICES = [
+        (TEXT, 'Editor'),
+        (WHITEBOARD, 'Whiteboard'),
+    ]
+    
+    room_id = models.CharField(max_length=64)
+    kind = models.CharField(max_length=3, choices=KIND_CHOICES)
+    rev = models.PositiveIntegerField()
+    ops = models.JSONField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_id', 'kind', 'rev'], name='room_op_log_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} op {self.rev} in room {self.room_id}"
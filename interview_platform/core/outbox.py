@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from core import frames, metrics
+from core.serializer import dumps
+from src.server import server
+
+logger = logging.getLogger(__name__)
+
+# At most one channel-layer publish per room per window; the first event in a
+# quiet room goes out straight away, the ones right behind it wait for the
+# rest of the window and leave together
+DEFAULT_WINDOW_MS = 16
+DEFAULT_MAX_BATCH = 64
+
+# Events carrying a room's whole state: only the latest one in a batch matters
+SNAPSHOT_TYPES = {'txt_update', 'wb_buffer', 'timer_update'}
+
+
+def room_frame(events):
+    """The frame a batch of room events is published as."""
+    return events[0] if len(events) == 1 else {'type': 'batch', 'events': events}
+
+
+def room_message(group, frame, binary=True):
+    """Channel-layer message carrying a room frame already encoded.
+
+    The frame is serialized here, once per publish, as JSON text and, when
+    someone in the room takes them (`binary`), as a binary frame
+    (core/frames.py). Every consumer in the room forwards the one its client
+    speaks, so the encoding cost doesn't grow with the number of participants.
+    """
+    events = frame['events'] if frame['type'] == 'batch' else [frame]
+    return {
+        'type': 'room_message',
+        'text': dumps(frame),
+        'bytes': frames.encode(frame, room=group.replace('room_', '', 1)) if binary else None,
+        'kinds': sorted({event['type'] for event in events}),
+        'seq': frame.get('seq', 0),
+    }
+
+
+class RoomOutbox:
+    """Coalesces the events broadcast to a room into batched publishes.
+
+    Events are published in the order they were sent, one room at a time, as
+    a single room_message (see room_message()) per window. Superseded state
+    snapshots are dropped and back-to-back whiteboard batches from the same
+    user are merged. Every published frame is numbered by the room server,
+    which keeps the latest ones so reconnecting clients can catch up on what
+    they missed (see WSConsumer's join).
+    """
+
+    def __init__(self, window_ms=None, max_batch=None):
+        if window_ms is None:
+            window_ms = getattr(settings, 'WS_COALESCE_WINDOW_MS', DEFAULT_WINDOW_MS)
+        self.window = window_ms / 1000
+        self.max_batch = max_batch or getattr(settings, 'WS_COALESCE_MAX_BATCH', DEFAULT_MAX_BATCH)
+        self.pending = {}  # group -> events waiting for the next publish
+        self.tasks = {}  # group -> publishing task
+        self.events = 0
+        self.publishes = 0
+
+    async def send(self, group, event):
+        """Queue a channel-layer event for every consumer in the group."""
+        self.events += 1
+        self._add(self.pending.setdefault(group, []), event)
+        if group not in self.tasks:
+            self.tasks[group] = asyncio.create_task(self._run(group))
+
+    def stats(self):
+        return {'events': self.events, 'publishes': self.publishes}
+
+    def _add(self, events, event):
+        kind = event['type']
+        if kind in SNAPSHOT_TYPES:
+            events[:] = [e for e in events if e['type'] != kind]
+        elif kind == 'wb_ops' and events:
+            last = events[-1]
+            if last['type'] == 'wb_ops' and last['uid'] == event['uid']:
+                events[-1] = {**last, 'rev': event['rev'], 'ops': last['ops'] + event['ops']}
+                return
+        events.append(event)
+
+    async def _run(self, group):
+        channel_layer = get_channel_layer()
+        try:
+            while self.pending.get(group):
+                events = self.pending.pop(group)
+                for start in range(0, len(events), self.max_batch):
+                    frame = room_frame(events[start:start + self.max_batch])
+                    try:
+                        # Numbered first; the room server also tells whether
+                        # the binary form is worth building
+                        _, binary = await server.record_frame(group.replace('room_', '', 1), frame)
+                        with metrics.GROUP_SEND_SECONDS.time('room'):
+                            await channel_layer.group_send(group, room_message(group, frame, binary))
+                        self.publishes += 1
+                    except Exception as e:
+                        logger.warning("Error broadcasting to %s: %s", group, e)
+                await asyncio.sleep(self.window)
+        finally:
+            self.tasks.pop(group, None)
+
+
+room_outbox = RoomOutbox()
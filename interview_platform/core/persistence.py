@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import queue
+import threading
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from core.metrics import db_call
+from core.models import InterviewSession, RoomOp, RoomSnapshot
+from src.editor import apply_ops
+from src.whiteboard import Whiteboard
+
+logger = logging.getLogger(__name__)
+
+# A room is snapshotted (and its op log compacted) after this many ops, so
+# restoring it replays at most this many ops on top of its snapshot
+SNAPSHOT_EVERY = 200
+# Ops written to the database per transaction
+WRITE_BATCH = 500
+LINGER_SECONDS = 0.5
+
+
+class RoomStore:
+    """Durable copy of room state: an append-only op log plus snapshots.
+
+    The consumer records every editor and whiteboard op it applies; the
+    writes happen on a background thread so the event loop never waits on
+    the database. Every SNAPSHOT_EVERY ops a room's whole state is written
+    as a snapshot and the ops it covers are dropped. Before a process uses
+    its first room, ensure_warm() rebuilds the rooms of running sessions
+    from snapshot + log tail.
+    """
+
+    def __init__(self, snapshot_every=SNAPSHOT_EVERY):
+        self.snapshot_every = snapshot_every
+        self.since_snapshot = {}  # room id -> ops recorded since the last snapshot
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.warmed = False
+        self.warm_lock = None
+
+    def record(self, room_id, kind, rev, ops):
+        """Log an applied op. Returns True when the room is due a snapshot."""
+        self._put(('op', RoomOp(room_id=room_id, kind=kind, rev=rev, ops=ops)))
+        count = self.since_snapshot.get(room_id, 0) + 1
+        self.since_snapshot[room_id] = count
+        return count >= self.snapshot_every
+
+    def snapshot(self, room_id, state):
+        """Write the room's state (as returned by server.room_state) and compact its log."""
+        self.since_snapshot[room_id] = 0
+        self._put(('snapshot', room_id, state))
+
+    def forget(self, room_id):
+        """Drop everything stored for a room."""
+        self.since_snapshot.pop(room_id, None)
+        self._put(('forget', room_id))
+
+    def drain(self):
+        """Block until everything queued so far has been written."""
+        self.queue.join()
+
+    def load(self, room_ids):
+        """Rebuild {room id: state} from snapshots and the op log."""
+        states = {}
+        for snapshot in RoomSnapshot.objects.filter(room_id__in=room_ids):
+            states[snapshot.room_id] = {
+                'editor': {'text': snapshot.text, 'rev': snapshot.text_rev},
+                'whiteboard': {'ops': snapshot.wb_ops, 'rev': snapshot.wb_rev},
+            }
+
+        whiteboards = {}
+        ops = RoomOp.objects.filter(room_id__in=room_ids).order_by('room_id', 'kind', 'rev')
+        for op in ops.iterator():
+            state = states.setdefault(op.room_id, {
+                'editor': {'text': '', 'rev': 0},
+                'whiteboard': {'ops': [], 'rev': 0},
+            })
+            if op.kind == RoomOp.TEXT:
+                editor = state['editor']
+                if op.rev > editor['rev']:
+                    editor['text'] = apply_ops(editor['text'], op.ops)
+                    editor['rev'] = op.rev
+            elif op.rev > state['whiteboard']['rev']:
+                whiteboard = whiteboards.get(op.room_id)
+                if whiteboard is None:
+                    whiteboard = whiteboards[op.room_id] = Whiteboard()
+                    whiteboard.restore(state['whiteboard']['ops'], state['whiteboard']['rev'])
+                whiteboard.apply(op.ops)
+                state['whiteboard'] = {'ops': whiteboard.ops, 'rev': op.rev}
+        return states
+
+    def warm_start(self, server):
+        """Restore the rooms of sessions that haven't ended yet into the server."""
+        sessions = dict(InterviewSession.objects.filter(
+            end_time__gte=timezone.now()
+        ).order_by().values_list('id', 'end_time'))
+        states = self.load([str(session_id) for session_id in sessions])
+        for room_id, state in states.items():
+            server.restore_room(room_id, sessions[int(room_id)], state)
+        return list(states)
+
+    @db_call('room_store_warm_start')
+    def _warm_start(self, server):
+        return self.warm_start(server)
+
+    async def ensure_warm(self, server):
+        """warm_start() once per process, before its first room is used.
+
+        Called by the first WebSocket connection and room page rather than
+        at import, so a worker whose database is down still boots; a failed
+        attempt is logged and the next caller tries again. Callers wait for
+        it, so no room is created empty ahead of its restore.
+        """
+        if self.warmed:
+            return
+        if self.warm_lock is None:
+            self.warm_lock = asyncio.Lock()
+        async with self.warm_lock:
+            if self.warmed:
+                return
+            try:
+                restored = await self._warm_start(server)
+            except Exception:
+                logger.exception("Error restoring rooms")
+                return
+            self.warmed = True
+        logger.info("Restored %d room(s) from the room store", len(restored))
+
+    def _put(self, item):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='room-store', daemon=True)
+                self.thread.start()
+        self.queue.put(item)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.queue.get(timeout=LINGER_SECONDS))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Error persisting room state")
+            finally:
+                close_old_connections()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        with transaction.atomic():
+            ops = []
+            for item in batch:
+                if item[0] == 'op':
+                    ops.append(item[1])
+                    continue
+                # Keep the log in order around snapshots and deletes
+                RoomOp.objects.bulk_create(ops)
+                ops = []
+                if item[0] == 'snapshot':
+                    self._write_snapshot(item[1], item[2])
+                else:
+                    RoomOp.objects.filter(room_id=item[1]).delete()
+                    RoomSnapshot.objects.filter(room_id=item[1]).delete()
+            RoomOp.objects.bulk_create(ops)
+
+    def _write_snapshot(self, room_id, state):
+        editor, whiteboard = state['editor'], state['whiteboard']
+        RoomSnapshot.objects.update_or_create(room_id=room_id, defaults={
+            'text': editor['text'],
+            'text_rev': editor['rev'],
+            'wb_ops': whiteboard['ops'],
+            'wb_rev': whiteboard['rev'],
+            'updated_at': timezone.now(),
+        })
+        RoomOp.objects.filter(room_id=room_id, kind=RoomOp.TEXT, rev__lte=editor['rev']).delete()
+        RoomOp.objects.filter(room_id=room_id, kind=RoomOp.WHITEBOARD, rev__lte=whiteboard['rev']).delete()
+
+
+room_store = RoomStore()
@@ -5,4 +5,6 @@ from core import consumers  # WebSocket consumers
 websocket_urlpatterns = [
     #ws/ → WebSocket URL for the real-time editor and whiteboard.
     re_path(r'ws/$', consumers.WSConsumer.as_asgi()),
+    #ws/lobby/ → session list updates for the home page.
+    re_path(r'ws/lobby/$', consumers.LobbyConsumer.as_asgi()),
 ]
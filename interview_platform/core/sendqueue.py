@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 256
+# 'coalesce': replace the backlog with the room's latest state, and close the
+#             connection if that keeps happening (MAX_RESYNCS per window)
+# 'disconnect': close the connection as soon as the backlog overflows; the
+#             client reconnects and gets a fresh snapshot with its join reply
+POLICIES = ('coalesce', 'disconnect')
+DEFAULT_POLICY = 'coalesce'
+MAX_RESYNCS = 3
+RESYNC_WINDOW_SECONDS = 60
+# Close code sent to clients that can't keep up
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+# Frames made of only one of these carry whole state: a newer one replaces
+# an older one still waiting in the queue
+STATE_KINDS = {'txt_update', 'wb_buffer', 'timer_update', 'global_time'}
+
+
+class SendStats:
+    """Counters shared by every connection's queue."""
+
+    def __init__(self):
+        self.sent = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.disconnects = 0
+
+
+class SendQueue:
+    """Bounded outbound queue of one WebSocket connection.
+
+    Handlers push already encoded frames and return straight away; a writer
+    task sends them in order. A client on a slow link therefore only ever
+    delays itself: its backlog is capped at `limit` frames and handled by
+    `policy` when it overflows, instead of growing without bound or holding
+    up the room's other participants.
+
+    write(payload) sends one frame, resync() returns a frame with the room's
+    current state (or None) and close(code) closes the connection.
+    """
+
+    instances = weakref.WeakSet()
+    stats = SendStats()
+
+    def __init__(self, write, resync, close, limit=None, policy=None):
+        self.write = write
+        self.resync = resync
+        self.close = close
+        self.limit = limit or getattr(settings, 'WS_SEND_QUEUE_LIMIT', DEFAULT_LIMIT)
+        self.policy = policy or getattr(settings, 'WS_SLOW_CLIENT_POLICY', DEFAULT_POLICY)
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown slow client policy {self.policy!r}, expected one of {POLICIES}")
+        self.frames = deque()  # (payload, kinds)
+        self.ready = asyncio.Event()
+        self.needs_resync = False
+        self.closing = False
+        self.end_code = None
+        self.resync_times = deque()
+        self.task = None
+        SendQueue.instances.add(self)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, payload, kinds=()):
+        """Queue a frame (str or bytes); kinds are the event types it carries."""
+        if self.closing or self.end_code is not None:
+            return
+        kinds = frozenset(kinds)
+        if len(kinds) == 1 and kinds <= STATE_KINDS:
+            for i, (_, queued) in enumerate(self.frames):
+                if queued == kinds:
+                    del self.frames[i]
+                    SendQueue.stats.superseded += 1
+                    break
+        self.frames.append((payload, kinds))
+        if len(self.frames) > self.limit:
+            self._overflow()
+        self._wake()
+
+    def end(self, code):
+        """Close the connection with `code` once everything queued has been sent."""
+        if self.closing:
+            return
+        self.end_code = code
+        self._wake()
+
+    def _wake(self):
+        self.ready.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.closing = True
+        # Closed connections leave the socket count straight away, whenever
+        # the consumer itself is collected
+        SendQueue.instances.discard(self)
+        if self.task is not None:
+            self.task.cancel()
+        self.frames.clear()
+
+    def _overflow(self):
+        now = time.monotonic()
+        while self.resync_times and self.resync_times[0] < now - RESYNC_WINDOW_SECONDS:
+            self.resync_times.popleft()
+
+        if self.policy == 'disconnect' or len(self.resync_times) >= MAX_RESYNCS:
+            SendQueue.stats.dropped += len(self.frames)
+            SendQueue.stats.disconnects += 1
+            self.frames.clear()
+            self.closing = True
+            return
+
+        # Keep the (deduplicated) state frames and direct replies such as the
+        # join reply, the rest is covered by a snapshot of the room taken when
+        # the writer gets to it
+        kept = deque(frame for frame in self.frames if frame[1] <= STATE_KINDS)
+        SendQueue.stats.dropped += len(self.frames) - len(kept)
+        SendQueue.stats.resyncs += 1
+        self.frames = kept
+        self.needs_resync = True
+        self.resync_times.append(now)
+
+    async def _run(self):
+        try:
+            while True:
+                if self.closing:
+                    await self.close(SLOW_CLIENT_CLOSE_CODE)
+                    return
+                if self.needs_resync:
+                    self.needs_resync = False
+                    payload = await self.resync()
+                    if payload is not None:
+                        await self.write(payload)
+                        SendQueue.stats.sent += 1
+                    continue
+                if not self.frames:
+                    if self.end_code is not None:
+                        self.closing = True
+                        await self.close(self.end_code)
+                        return
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                payload, _ = self.frames.popleft()
+                await self.write(payload)
+                SendQueue.stats.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info("Error sending to client: %s", e)
+        finally:
+            self.task = None
+
+    @classmethod
+    def snapshot(cls):
+        """Current queue depths plus the shared counters, for monitoring."""
+        depths = [len(queue) for queue in cls.instances]
+        return {
+            'connections': len(depths),
+            'queued': sum(depths),
+            'max_depth': max(depths, default=0),
+            'sent': cls.stats.sent,
+            'superseded': cls.stats.superseded,
+            'dropped': cls.stats.dropped,
+            'resyncs': cls.stats.resyncs,
+            'disconnects': cls.stats.disconnects,
+        }
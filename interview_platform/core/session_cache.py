@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from core.metrics import db_call
+
+# How long a session's metadata is served from memory before it is re-read.
+# Saves in this process invalidate immediately; this bounds how stale another
+# worker's change can look.
+DEFAULT_TTL = 30
+MAX_ENTRIES = 10000
+
+
+class SessionMeta(namedtuple('SessionMeta', ['start_time', 'end_time', 'max_participants'])):
+    """The bits of an InterviewSession the WebSocket consumer needs."""
+    __slots__ = ()
+
+    def status(self, now=None):
+        now = now or timezone.now()
+        if now < self.start_time:
+            return "upcoming"
+        elif now <= self.end_time:
+            return "active"
+        return "expired"
+
+
+class SessionCache:
+    """Process-wide TTL cache of session metadata keyed by room id.
+
+    Consumers read it on the event loop while views save sessions in worker
+    threads, so entries are guarded by a lock. Rooms without a session are
+    cached too (as None) so unknown room ids don't hit the database every time.
+    """
+
+    def __init__(self, ttl=None, max_entries=MAX_ENTRIES):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'SESSION_CACHE_TTL', DEFAULT_TTL)
+        self.max_entries = max_entries
+        self.entries = {}  # room id -> (expires at, SessionMeta or None)
+        self.lock = threading.Lock()
+        # Bumped on every invalidation so a load that raced with a save
+        # doesn't put the old value back
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, room_id):
+        """Return (found, meta) without touching the database."""
+        key = str(room_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def store(self, room_id, meta, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if len(self.entries) >= self.max_entries:
+                self._prune()
+            self.entries[str(room_id)] = (time.monotonic() + self.ttl_for(meta), meta)
+
+    def ttl_for(self, meta):
+        return self.ttl
+
+    def invalidate(self, room_id):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(str(room_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, (expires, _) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+        # Still full: drop the oldest entries (dicts keep insertion order)
+        while len(self.entries) >= self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+    async def get(self, room_id):
+        """Metadata for the room's session, or None if it has none."""
+        found, meta = self.lookup(room_id)
+        if found:
+            return meta
+        generation = self.generation
+        meta = await self._load(room_id)
+        self.store(room_id, meta, generation)
+        return meta
+
+    @db_call('session_cache_load')
+    def _load(self, room_id):
+        from core.models import InterviewSession
+        try:
+            row = InterviewSession.objects.filter(id=room_id).values_list(
+                'start_time', 'end_time', 'max_participants'
+            ).first()
+        except ValueError:
+            # Not a session id (e.g. a scratch room)
+            return None
+        return SessionMeta(*row) if row else None
+
+
+session_cache = SessionCache()
@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import logging
+
+from django.utils import timezone
+
+from core import frames
+from core.clock import room_clock
+from core.metrics import db_call
+from core.models import InterviewSession
+from core.persistence import room_store
+from core.serializer import dumps
+from core.session_cache import session_cache
+from src.server import server
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long the sweeper sleeps before re-reading upcoming
+# transitions from the database (picks up sessions created by other workers)
+RESCAN_SECONDS = 60
+
+
+class SessionSweeper:
+    """Flips session status exactly when sessions start or end.
+
+    Keeps a heap of upcoming (start/end time, session id) entries and calls
+    InterviewSession.refresh_statuses() when the earliest one passes, which in
+    turn pushes session_activated / session_expired to the lobby. When a
+    session ends its room is torn down in this process: sockets get a
+    session_ended message and are closed, and the room's state, ticker and
+    cached metadata are dropped. Runs on the event loop of the first consumer
+    that starts it; the heap only holds sessions that haven't ended yet.
+    """
+
+    def __init__(self):
+        self.heap = []  # (when, session id)
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+
+    def start(self):
+        """Start the sweeper on the running loop (no-op once started)."""
+        if self.task is not None and not self.task.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def schedule(self, when, session_id):
+        """Wake up at `when`. Safe to call from sync views in other threads."""
+        if self.loop is None or self.loop.is_closed():
+            # Not running yet: the first scan picks the session up from the DB
+            return
+        self.loop.call_soon_threadsafe(self._push, when, session_id)
+
+    def _push(self, when, session_id):
+        heapq.heappush(self.heap, (when, session_id))
+        self.wakeup.set()
+
+    @db_call('sweeper_upcoming')
+    def _upcoming(self, now):
+        entries = []
+        for session_id, start_time, end_time in InterviewSession.objects.filter(
+            end_time__gte=now
+        ).order_by().values_list('id', 'start_time', 'end_time'):
+            if start_time > now:
+                entries.append((start_time, session_id))
+            entries.append((end_time, session_id))
+        return entries
+
+    @db_call('sweeper_sweep')
+    def _sweep(self, due, now):
+        """Refresh statuses, return the ids of the due sessions that have ended."""
+        InterviewSession.refresh_statuses()
+        # Re-read end times: a restarted timer may have moved them
+        return list(InterviewSession.objects.filter(
+            id__in=due, end_time__lte=now
+        ).order_by().values_list('id', flat=True))
+
+    async def teardown(self, room_id):
+        """Close a finished session's sockets and free its room in this process."""
+        message = {'type': 'session_ended', 'room': room_id}
+        text, data = dumps(message), frames.encode(message, room=room_id)
+        for consumer in room_clock.stop(room_id):
+            try:
+                await consumer.end_session(text, data)
+            except Exception as e:
+                logger.warning("Error closing socket of ended session: %s", e, extra={'room': room_id})
+        await server.close_room(room_id)
+        session_cache.invalidate(room_id)
+        room_store.forget(room_id)
+
+    async def _rescan(self):
+        self.heap = await self._upcoming(timezone.now())
+        heapq.heapify(self.heap)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_scan = loop.time()
+        while True:
+            try:
+                if loop.time() >= next_scan:
+                    await self._rescan()
+                    next_scan = loop.time() + RESCAN_SECONDS
+
+                now = timezone.now()
+                if self.heap and self.heap[0][0] <= now:
+                    due = set()
+                    while self.heap and self.heap[0][0] <= now:
+                        due.add(heapq.heappop(self.heap)[1])
+                    for session_id in await self._sweep(due, now):
+                        await self.teardown(str(session_id))
+                    continue
+
+                timeout = next_scan - loop.time()
+                if self.heap:
+                    timeout = min(timeout, (self.heap[0][0] - now).total_seconds())
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error in session sweeper")
+                await asyncio.sleep(1)
+
+
+session_sweeper = SessionSweeper()
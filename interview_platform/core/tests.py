@@ -1,3 +1,992 @@
-from django.test import TestCase
+import asyncio
+import itertools
+import json
+import threading
+import time
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import DatabaseError
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from core import frames
+from core.access_codes import access_code_index
+from core.clock import room_clock
+from core.consumers import LobbyConsumer, WSConsumer
+from core.mailer import MailQueue, mail_queue
+from core.sendqueue import MAX_RESYNCS, SLOW_CLIENT_CLOSE_CODE, SendQueue
+from core.models import EmailDelivery, InterviewSession, RoomOp, RoomSnapshot, SessionParticipant, User
+from core.outbox import RoomOutbox
+from core.persistence import RoomStore, room_store
+from core.serializer import dumps
+from core.session_cache import SessionMeta, session_cache
+from core.sweeper import SessionSweeper, session_sweeper
+from core.throttle import TokenBucket, client_ip
+from src.editor import Editor, OperationError, apply_ops, transform
+from src.room import EVENT_LOG_LIMIT
+from src.server import Server, server
+from src.whiteboard import Whiteboard, WhiteboardError, WhiteboardFull
+
+# Pages link static files without a collectstatic manifest
+PLAIN_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+class TransformTests(SimpleTestCase):
+    text = "abcdef"
+
+    def ops(self):
+        """Every single insert and delete on self.text."""
+        for p in range(len(self.text) + 1):
+            yield {'p': p, 'i': 'XY'}
+        for p in range(len(self.text)):
+            for d in range(1, len(self.text) - p + 1):
+                yield {'p': p, 'd': d}
+
+    def assertConverges(self, a, b):
+        a_past_b, b_past_a = transform(a, b)
+        left = apply_ops(apply_ops(self.text, b), a_past_b)
+        right = apply_ops(apply_ops(self.text, a), b_past_a)
+        self.assertEqual(left, right, f"{a} vs {b}")
+
+    def test_single_ops_converge(self):
+        for a, b in itertools.product(self.ops(), repeat=2):
+            self.assertConverges([a], [b])
+
+    def test_op_lists_converge(self):
+        self.assertConverges(
+            [{'p': 1, 'd': 2}, {'p': 1, 'i': 'new'}],
+            [{'p': 0, 'i': '>'}, {'p': 3, 'd': 3}],
+        )
+
+    def test_overlapping_deletes(self):
+        a_past_b, b_past_a = transform([{'p': 1, 'd': 3}], [{'p': 2, 'd': 3}])
+        self.assertEqual(a_past_b, [{'p': 1, 'd': 1}])
+        self.assertEqual(b_past_a, [{'p': 1, 'd': 1}])
+        self.assertEqual(apply_ops(apply_ops(self.text, [{'p': 2, 'd': 3}]), a_past_b), "af")
+
+    def test_same_delete_twice(self):
+        self.assertEqual(transform([{'p': 2, 'd': 2}], [{'p': 2, 'd': 2}]), ([], []))
+
+    def test_insert_inside_delete_is_kept(self):
+        self.assertConverges([{'p': 1, 'd': 4}], [{'p': 3, 'i': 'keep'}])
+        a_past_b, _ = transform([{'p': 1, 'd': 4}], [{'p': 3, 'i': 'keep'}])
+        self.assertEqual(apply_ops(apply_ops(self.text, [{'p': 3, 'i': 'keep'}]), a_past_b), "akeepf")
+
+    def test_editor_transforms_stale_ops(self):
+        editor = Editor()
+        editor.apply(0, [{'p': 0, 'i': self.text}])
+        editor.apply(1, [{'p': 0, 'd': 2}])
+        rev, ops = editor.apply(1, [{'p': 3, 'd': 2}])
+        self.assertEqual((rev, ops, editor.text), (3, [{'p': 1, 'd': 2}], "cf"))
+
+    def test_editor_rejects_unknown_revisions_and_bad_ops(self):
+        editor = Editor()
+        with self.assertRaises(OperationError):
+            editor.apply(1, [{'p': 0, 'i': 'x'}])
+        with self.assertRaises(OperationError):
+            editor.apply(0, [{'p': 1, 'i': 'x'}])
+        with self.assertRaises(OperationError):
+            editor.apply(0, [{'p': 0, 'd': -1}])
+        self.assertEqual(editor.snapshot(), {'text': '', 'rev': 0})
+
+
+class FrameTests(SimpleTestCase):
+    def test_round_trip(self):
+        message = {'type': 'txt_op', 'uid': 'ab12c', 'rev': 7, 'ops': [{'p': 0, 'i': 'é'}], 'seq': 42}
+        data = frames.encode(message, room='17')
+        self.assertEqual(data[2], frames.TYPE_CODES['txt_op'])
+        self.assertEqual(frames.decode(data), (message, '17', 42))
+
+    def test_untyped_message(self):
+        reply = {'join': 'ab12c', 'binary': True, 'epoch': 'e', 'seq': 0}
+        message, room, seq = frames.decode(frames.encode(reply))
+        self.assertEqual((message, room, seq), ({'join': 'ab12c', 'binary': True, 'epoch': 'e'}, '', 0))
+
+    def test_large_payload_is_compressed(self):
+        message = {'type': 'txt_snapshot', 'text': 'x' * 10000, 'rev': 3}
+        data = frames.encode(message, room='1')
+        self.assertTrue(data[1] & frames.FLAG_DEFLATE)
+        self.assertLess(len(data), 1000)
+        self.assertEqual(frames.decode(data)[0], message)
+
+    def test_bad_frames(self):
+        good = frames.encode({'type': 'wb_ops', 'ops': []}, room='1')
+        header = frames.HEADER.pack(frames.VERSION, frames.FLAG_DEFLATE, 0, 0, 0)
+        for data in (
+            b'\x01\x00',
+            b'\x02' + good[1:],
+            good[:2] + bytes([len(frames.TYPES)]) + good[3:],
+            header + b'not zlib',
+            header + zlib.compress(b' ' * (frames.MAX_PAYLOAD_BYTES + 1)),
+            frames.HEADER.pack(frames.VERSION, 0, 0, 0, 0) + b'[1, 2]',
+        ):
+            with self.assertRaises(frames.FrameError):
+                frames.decode(data)
+
+
+class ReplayTests(SimpleTestCase):
+    def setUp(self):
+        self.server = Server()
+        self.server.new_room('1')
+        self.epoch = self.server.rooms['1'].epoch
+
+    async def publish(self, count):
+        for i in range(count):
+            await self.server.record_frame('1', {'type': 'txt_op', 'rev': i})
+
+    async def test_frames_since_position(self):
+        await self.publish(5)
+        epoch, seq, missed = await self.server.replay('1', 2, self.epoch)
+        self.assertEqual((epoch, seq), (self.epoch, 5))
+        self.assertEqual([frame['seq'] for frame in missed], [3, 4, 5])
+
+    async def test_up_to_date(self):
+        await self.publish(3)
+        self.assertEqual(await self.server.replay('1', 3, self.epoch), (self.epoch, 3, []))
+
+    async def test_no_position_or_other_epoch(self):
+        await self.publish(3)
+        self.assertEqual(await self.server.replay('1'), (self.epoch, 3, None))
+        self.assertIsNone((await self.server.replay('1', 1, 'other'))[2])
+
+    async def test_position_ahead_of_log(self):
+        await self.publish(3)
+        self.assertIsNone((await self.server.replay('1', 4, self.epoch))[2])
+
+    async def test_dropped_frames(self):
+        await self.publish(EVENT_LOG_LIMIT + 10)
+        self.assertIsNone((await self.server.replay('1', 9, self.epoch))[2])
+        _, _, missed = await self.server.replay('1', 10, self.epoch)
+        self.assertEqual(len(missed), EVENT_LOG_LIMIT)
+
+    async def test_no_room(self):
+        self.assertEqual(await self.server.record_frame('2', {'type': 'txt_op'}), (0, False))
+        self.assertEqual(await self.server.replay('2', 0, self.epoch), (None, 0, None))
+
+
+class ThrottleTests(SimpleTestCase):
+    def test_refill(self):
+        bucket = TokenBucket(rate=0.5, burst=2)
+        with mock.patch('core.throttle.time.monotonic', return_value=100.0) as clock:
+            bucket.consume('ip')
+            bucket.consume('ip')
+            self.assertFalse(bucket.allowed('ip'))
+            self.assertTrue(bucket.allowed('other'))
+            clock.return_value = 101.0
+            self.assertFalse(bucket.allowed('ip'))
+            clock.return_value = 102.0
+            self.assertTrue(bucket.allowed('ip'))
+            clock.return_value = 1000.0
+            bucket.consume('ip')
+            self.assertTrue(bucket.allowed('ip'))
+        self.assertEqual(bucket.stats(), {'keys': 1, 'throttled': 2})
+
+    def test_client_ip_ignores_forwarded_entries_from_the_client(self):
+        request = RequestFactory().post('/', REMOTE_ADDR='1.1.1.1', HTTP_X_FORWARDED_FOR='6.6.6.6, 2.2.2.2, 10.0.0.1')
+        self.assertEqual(client_ip(request), '1.1.1.1')
+        with override_settings(TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(client_ip(request), '10.0.0.1')
+        with override_settings(TRUSTED_PROXY_COUNT=2):
+            self.assertEqual(client_ip(request), '2.2.2.2')
+        with override_settings(TRUSTED_PROXY_COUNT=5):
+            self.assertEqual(client_ip(request), '6.6.6.6')
+
+
+class WhiteboardTests(SimpleTestCase):
+    def stroke(self, points):
+        return {'t': 'stroke', 'pts': [1, 2] * points}
+
+    def test_full_board_rejects_until_cleared(self):
+        whiteboard = Whiteboard()
+        with mock.patch('src.whiteboard.MAX_BOARD_POINTS', 10):
+            whiteboard.apply([self.stroke(6)])
+            with self.assertRaises(WhiteboardFull):
+                whiteboard.apply([self.stroke(5)])
+            self.assertEqual((len(whiteboard.ops), whiteboard.points, whiteboard.revision), (1, 6, 1))
+            whiteboard.apply([{'t': 'clear'}, self.stroke(10)])
+        self.assertEqual((len(whiteboard.ops), whiteboard.points), (1, 10))
+
+    def test_bad_ops(self):
+        for ops in ({'t': 'clear'}, [{'t': 'erase'}], [{'t': 'stroke', 'pts': [1]}], [self.stroke(5001)]):
+            with self.assertRaises(WhiteboardError):
+                Whiteboard().apply(ops)
+
+
+class CacheInvalidationTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.session = InterviewSession.objects.create(
+            start_time=now,
+            end_time=now + timedelta(minutes=15),
+            created_by=User.objects.create(username='tests', email='tests@example.com'),
+        )
+        self.addCleanup(session_cache.clear)
+        self.addCleanup(access_code_index.clear)
+
+    def cache(self):
+        meta = SessionMeta(self.session.start_time, self.session.end_time, self.session.max_participants)
+        session_cache.store(self.session.id, meta)
+        self.assertEqual(async_to_sync(access_code_index.resolve)(self.session.access_code), self.session.id)
+        self.assertTrue(session_cache.lookup(self.session.id)[0])
+
+    def test_save_invalidates(self):
+        self.cache()
+        self.session.max_participants = 2
+        self.session.save()
+        self.assertEqual(session_cache.lookup(self.session.id), (False, None))
+
+    def test_delete_invalidates(self):
+        self.cache()
+        session_id, code = self.session.id, self.session.access_code
+        self.session.delete()
+        self.assertEqual(session_cache.lookup(session_id), (False, None))
+        self.assertEqual(access_code_index.lookup(code), (False, None))
+
+    def test_saves_keep_the_code_index_current(self):
+        self.cache()
+        old_code = self.session.access_code
+        self.session.access_code = 'NEWCODE1'
+        self.session.save()
+        self.assertEqual(access_code_index.lookup('NEWCODE1'), (True, self.session.id))
+        self.assertEqual(access_code_index.lookup(old_code), (False, None))
+
+    def test_wrong_codes_are_answered_without_a_query(self):
+        self.cache()
+        loads = access_code_index.stats()['loads']
+        with self.assertNumQueries(0):
+            for code in ('WRONG001', 'WRONG002', 'x' * 50, ''):
+                self.assertIsNone(async_to_sync(access_code_index.resolve)(code))
+        self.assertEqual(access_code_index.stats()['loads'], loads)
+
+    def test_unknown_code_reloads_once_the_refresh_is_due(self):
+        self.cache()
+        # Written by "another worker": the index hasn't seen it
+        InterviewSession.objects.filter(id=self.session.id).update(access_code='ELSEWHER')
+        with mock.patch.object(access_code_index, 'loaded_at', time.monotonic() - access_code_index.refresh):
+            with self.assertNumQueries(1):
+                self.assertEqual(async_to_sync(access_code_index.resolve)('ELSEWHER'), self.session.id)
+                self.assertIsNone(async_to_sync(access_code_index.resolve)('WRONG001'))
+
+
+class SendQueueTests(SimpleTestCase):
+    """A client that doesn't read: its writer is stuck on the first frame."""
+
+    async def make_queue(self, policy, limit=3):
+        self.written = []
+        self.closed = []
+        self.gate = asyncio.Event()
+
+        async def write(payload):
+            await self.gate.wait()
+            self.written.append(payload)
+
+        async def resync():
+            return 'snapshot'
+
+        async def close(code):
+            self.closed.append(code)
+
+        return SendQueue(write, resync, close, limit=limit, policy=policy)
+
+    async def flush(self, queue):
+        self.gate.set()
+        for _ in range(20):
+            await asyncio.sleep(0)
+        queue.stop()
+
+    async def test_overflow_under_coalesce_resyncs_from_the_latest_state(self):
+        queue = await self.make_queue('coalesce')
+        queue.push('join reply')
+        await asyncio.sleep(0)  # the writer takes it and waits on the client
+        queue.push('tick 1', ('global_time',))
+        for n in range(3):
+            queue.push(f'op {n}', ('txt_op',))
+        # The ops went and a snapshot covers them; a newer tick replaces the queued one
+        queue.push('tick 2', ('global_time',))
+        self.assertEqual([payload for payload, _ in queue.frames], ['tick 2'])
+        await self.flush(queue)
+        self.assertEqual(self.written, ['join reply', 'snapshot', 'tick 2'])
+        self.assertEqual(self.closed, [])
+
+    async def test_repeated_overflow_under_coalesce_disconnects(self):
+        queue = await self.make_queue('coalesce')
+        queue.push('join reply')
+        await asyncio.sleep(0)
+        for n in range((MAX_RESYNCS + 1) * 4):
+            queue.push(f'op {n}', ('txt_op',))
+        await self.flush(queue)
+        self.assertEqual(self.closed, [SLOW_CLIENT_CLOSE_CODE])
+        self.assertNotIn('snapshot', self.written)
+
+    async def test_overflow_under_disconnect_closes_with_4008(self):
+        queue = await self.make_queue('disconnect')
+        queue.push('join reply')
+        await asyncio.sleep(0)
+        for n in range(4):
+            queue.push(f'op {n}', ('txt_op',))
+        self.assertEqual(len(queue), 0)
+        await self.flush(queue)
+        self.assertEqual(self.written, ['join reply'])
+        self.assertEqual(self.closed, [SLOW_CLIENT_CLOSE_CODE])
+
+    async def test_within_the_limit_frames_go_out_in_order(self):
+        queue = await self.make_queue('disconnect')
+        for n in range(3):
+            queue.push(f'op {n}', ('txt_op',))
+        await self.flush(queue)
+        self.assertEqual(self.written, ['op 0', 'op 1', 'op 2'])
+        self.assertEqual(self.closed, [])
+
+
+class OutboxTests(SimpleTestCase):
+    group = 'room_outbox-tests'
+
+    async def listen(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(self.group, channel)
+        self.addCleanup(async_to_sync(layer.group_discard), self.group, channel)
+        return layer, channel
+
+    async def receive(self, layer, channel):
+        message = await asyncio.wait_for(layer.receive(channel), 1)
+        return json.loads(message['text'])
+
+    async def test_events_sent_together_leave_in_one_frame_in_order(self):
+        layer, channel = await self.listen()
+        outbox = RoomOutbox(window_ms=50)
+        await outbox.send(self.group, {'type': 'txt_op', 'uid': 1, 'rev': 1, 'ops': []})
+        await outbox.send(self.group, {'type': 'txt_op', 'uid': 2, 'rev': 2, 'ops': []})
+        await outbox.send(self.group, {'type': 'timer_update', 'end_time': 'soon'})
+        frame = await self.receive(layer, channel)
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual([(e['type'], e.get('rev')) for e in frame['events']], [
+            ('txt_op', 1), ('txt_op', 2), ('timer_update', None),
+        ])
+
+    async def test_events_within_the_window_wait_for_the_next_publish(self):
+        layer, channel = await self.listen()
+        outbox = RoomOutbox(window_ms=50)
+        await outbox.send(self.group, {'type': 'txt_op', 'uid': 1, 'rev': 1, 'ops': []})
+        first = await self.receive(layer, channel)
+        # Published: the rest of the window's events go out together
+        for rev in (2, 3):
+            await outbox.send(self.group, {'type': 'txt_op', 'uid': 1, 'rev': rev, 'ops': []})
+        second = await self.receive(layer, channel)
+        self.assertEqual(first['rev'], 1)
+        self.assertEqual([e['rev'] for e in second['events']], [2, 3])
+        self.assertEqual(outbox.stats(), {'events': 3, 'publishes': 2})
+
+    async def test_only_the_latest_snapshot_is_published(self):
+        layer, channel = await self.listen()
+        outbox = RoomOutbox(window_ms=50)
+        await outbox.send(self.group, {'type': 'txt_update', 'data': 'old'})
+        await outbox.send(self.group, {'type': 'txt_op', 'uid': 1, 'rev': 1, 'ops': []})
+        await outbox.send(self.group, {'type': 'txt_update', 'data': 'new'})
+        frame = await self.receive(layer, channel)
+        self.assertEqual(frame['events'], [
+            {'type': 'txt_op', 'uid': 1, 'rev': 1, 'ops': []},
+            {'type': 'txt_update', 'data': 'new'},
+        ])
+
+    async def test_back_to_back_strokes_of_one_user_are_merged(self):
+        layer, channel = await self.listen()
+        outbox = RoomOutbox(window_ms=50)
+        for uid, rev, stroke in ((1, 1, 'a'), (1, 2, 'b'), (2, 3, 'c'), (1, 4, 'd')):
+            await outbox.send(self.group, {'type': 'wb_ops', 'uid': uid, 'rev': rev, 'ops': [stroke]})
+        frame = await self.receive(layer, channel)
+        # Another user's strokes in between keep theirs apart
+        self.assertEqual(frame['events'], [
+            {'type': 'wb_ops', 'uid': 1, 'rev': 2, 'ops': ['a', 'b']},
+            {'type': 'wb_ops', 'uid': 2, 'rev': 3, 'ops': ['c']},
+            {'type': 'wb_ops', 'uid': 1, 'rev': 4, 'ops': ['d']},
+        ])
+
+
+class SlowConsumer(WSConsumer):
+    """A client whose link takes a while to take each frame."""
+
+    async def write_frame(self, payload):
+        await asyncio.sleep(0.05)
+        await super().write_frame(payload)
+
+
+class ConsumerTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.session = InterviewSession.objects.create(
+            start_time=now,
+            end_time=now + timedelta(minutes=15),
+            created_by=User.objects.create(username='tests', email='tests@example.com'),
+        )
+        self.room = str(self.session.id)
+        self.addCleanup(session_cache.clear)
+        # Ids come back once a test's rows are rolled back: start from an empty room
+        self.addCleanup(async_to_sync(self.close_room))
+
+    async def close_room(self):
+        room_clock.stop(self.room)
+        await server.close_room(self.room)
+
+    async def connect(self, consumer=WSConsumer, user=None):
+        communicator = WebsocketCommunicator(consumer.as_asgi(), '/ws/')
+        communicator.scope['user'] = user or AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator):
+        # Skipping the room clock's ticks
+        while True:
+            message = await communicator.receive_json_from()
+            if message.get('type') != 'global_time':
+                return message
+
+    async def join(self, communicator, room=None, **extra):
+        await communicator.send_json_to({'join': room or self.room, **extra})
+        return await self.receive(communicator)
+
+    async def assertClosed(self, communicator, code):
+        # Whatever was queued ahead of the close goes out first
+        while True:
+            output = await communicator.receive_output()
+            if output['type'] == 'websocket.close':
+                break
+        self.assertEqual(output['code'], code)
+        await communicator.disconnect()
+
+    async def test_join_replies_with_the_room_state(self):
+        first = await self.connect()
+        joined = await self.join(first)
+        self.assertEqual(joined['editor'], {'text': '', 'rev': 0})
+        self.assertEqual(joined['whiteboard'], {'ops': [], 'rev': 0})
+        self.assertEqual(joined['seq'], 0)
+        self.assertIsNotNone(joined['epoch'])
+
+        await server.apply_text(self.room, 0, [{'p': 0, 'i': 'print(1)'}])
+        second = await self.connect()
+        reply = await self.join(second)
+        self.assertEqual(reply['editor'], {'text': 'print(1)', 'rev': 1})
+        # Each connection gets its own id to recognise its ops by
+        self.assertNotEqual(reply['join'], joined['join'])
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_resume_replays_what_the_client_missed(self):
+        watcher = await self.connect()
+        reply = await self.join(watcher)
+        await watcher.disconnect()
+
+        writer = await self.connect()
+        await self.join(writer)
+        await writer.send_json_to({'type': 'txt_update', 'data': 'missed'})
+        frame = await self.receive(writer)
+        self.assertEqual(frame['seq'], reply['seq'] + 1)
+
+        watcher = await self.connect()
+        resumed = await self.join(watcher, resume={'seq': reply['seq'], 'epoch': reply['epoch']})
+        self.assertTrue(resumed['resumed'])
+        self.assertEqual(resumed['seq'], frame['seq'])
+        self.assertEqual(resumed['events'], [frame])
+        self.assertNotIn('editor', resumed)
+
+        # From another epoch the log can't tell: a full snapshot instead
+        stale = await self.connect()
+        reply = await self.join(stale, resume={'seq': 0, 'epoch': 'gone'})
+        self.assertNotIn('resumed', reply)
+        self.assertEqual(reply['editor'], {'text': '', 'rev': 0})
+        for communicator in (writer, watcher, stale):
+            await communicator.disconnect()
+
+    async def test_rejected_op_resyncs_the_sender(self):
+        communicator = await self.connect()
+        await self.join(communicator)
+        await communicator.send_json_to({'type': 'txt_op', 'rev': 0, 'ops': [{'p': 5, 'i': 'x'}]})
+        self.assertEqual(await self.receive(communicator), {'type': 'txt_snapshot', 'text': '', 'rev': 0})
+        await communicator.disconnect()
+
+    async def test_participant_is_present_until_their_last_connection_closes(self):
+        user = await User.objects.acreate(username='candidate', email='candidate@example.com')
+        await SessionParticipant.objects.acreate(session=self.session, user=user, is_present=False)
+        participant = SessionParticipant.objects.filter(user=user)
+        connections = []
+        for _ in range(2):
+            communicator = await self.connect(user=user)
+            await self.join(communicator)
+            connections.append(communicator)
+        self.assertTrue((await participant.aget()).is_present)
+        await connections[0].disconnect()
+        self.assertTrue((await participant.aget()).is_present)
+        await connections[1].disconnect()
+        self.assertFalse((await participant.aget()).is_present)
+
+    async def test_unknown_room_closes_with_4004(self):
+        communicator = await self.connect()
+        reply = await self.join(communicator, room='999999')
+        self.assertEqual(reply, {'type': 'room_not_found', 'room': '999999'})
+        await self.assertClosed(communicator, 4004)
+
+    async def test_full_room_closes_with_4009(self):
+        self.session.max_participants = 1
+        await self.session.asave()
+        first = await self.connect()
+        await self.join(first)
+        second = await self.connect()
+        reply = await self.join(second)
+        self.assertEqual(reply, {'type': 'room_full', 'max_participants': 1})
+        await self.assertClosed(second, 4009)
+        await first.disconnect()
+
+    @override_settings(STORAGES=PLAIN_STORAGES)
+    async def test_room_page_loads_while_the_room_is_full(self):
+        # A reload while the participant's previous socket is still open
+        self.session.max_participants = 1
+        await self.session.asave()
+        communicator = await self.connect()
+        await self.join(communicator)
+        response = await self.async_client.get(f'/room/{self.room}/')
+        self.assertEqual(response.status_code, 200)
+        await communicator.disconnect()
+
+    async def test_ended_session_closes_with_4010(self):
+        self.session.end_time = timezone.now() - timedelta(minutes=1)
+        await self.session.asave()
+        communicator = await self.connect()
+        reply = await self.join(communicator)
+        self.assertEqual(reply, {'type': 'session_ended', 'room': self.room})
+        await self.assertClosed(communicator, 4010)
+
+    async def flood(self, frames):
+        layer = get_channel_layer()
+        for n in range(frames):
+            await layer.group_send(f'room_{self.room}', {
+                'type': 'room_message',
+                'text': dumps({'type': 'txt_op', 'uid': 0, 'rev': n, 'ops': []}),
+                'bytes': None,
+                'kinds': ['txt_op'],
+            })
+
+    @override_settings(WS_SEND_QUEUE_LIMIT=2, WS_SLOW_CLIENT_POLICY='coalesce')
+    async def test_slow_client_is_resynced_under_coalesce(self):
+        communicator = await self.connect(SlowConsumer)
+        await self.join(communicator)
+        await server.apply_text(self.room, 0, [{'p': 0, 'i': 'latest'}])
+        await self.flood(5)
+        frame = await self.receive(communicator)
+        self.assertEqual(frame['type'], 'batch')
+        self.assertEqual(frame['events'][0], {'type': 'txt_snapshot', 'text': 'latest', 'rev': 1})
+        self.assertEqual(frame['events'][1]['type'], 'wb_snapshot')
+        await communicator.disconnect()
+
+    @override_settings(WS_SEND_QUEUE_LIMIT=2, WS_SLOW_CLIENT_POLICY='disconnect')
+    async def test_slow_client_closes_with_4008_under_disconnect(self):
+        communicator = await self.connect(SlowConsumer)
+        await self.join(communicator)
+        await self.flood(5)
+        await self.assertClosed(communicator, 4008)
+
+
+class GatedBackend(EmailBackend):
+    """locmem backend that holds every send until the test opens the gate."""
+    gate = threading.Event()
+
+    def send_messages(self, messages):
+        self.gate.wait(5)
+        return super().send_messages(messages)
+
+
+class FlakyBackend(EmailBackend):
+    """locmem backend whose first `failures` sends raise."""
+    failures = 0
+    calls = 0
+
+    def send_messages(self, messages):
+        FlakyBackend.calls += 1
+        if FlakyBackend.calls <= FlakyBackend.failures:
+            raise ConnectionError(f"attempt {FlakyBackend.calls} refused")
+        return super().send_messages(messages)
+
+
+class MailQueueTests(TransactionTestCase):
+    # The worker thread writes the delivery rows, so they have to be committed
+
+    def setUp(self):
+        FlakyBackend.calls = 0
+        self.queue = MailQueue(backoff=0.01)
+        sleep = mock.patch('core.mailer.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def message(self, to):
+        return EmailMessage('Interview Session', 'Access code', 'noreply@example.com', [to])
+
+    @override_settings(EMAIL_BACKEND='core.tests.GatedBackend')
+    def test_create_session_returns_before_sending(self):
+        GatedBackend.gate.clear()
+        self.addCleanup(GatedBackend.gate.set)
+        response = self.client.post('/create_session/', {
+            'title': 'Panel',
+            'candidate_emails': 'one@example.com, two@example.com',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.addCleanup(server.remove_room, str(InterviewSession.objects.get().id))
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(EmailDelivery.objects.filter(status=EmailDelivery.QUEUED).count(), 3)
+
+        GatedBackend.gate.set()
+        mail_queue.drain()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['admin@example.com', 'one@example.com', 'two@example.com'])
+        self.assertEqual(EmailDelivery.objects.filter(status=EmailDelivery.SENT, attempts=1).count(), 3)
+
+    @override_settings(EMAIL_BACKEND='core.tests.FlakyBackend')
+    def test_failed_sends_are_retried_with_backoff(self):
+        FlakyBackend.failures = 2
+        delivery, = self.queue.send([self.message('one@example.com')])
+        self.queue.drain()
+        delivery.refresh_from_db()
+        self.assertEqual((delivery.status, delivery.attempts), (EmailDelivery.SENT, 3))
+        self.assertIsNotNone(delivery.sent_at)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [0.01, 0.02])
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_BACKEND='core.tests.FlakyBackend')
+    def test_retries_stop_after_the_last_attempt(self):
+        FlakyBackend.failures = 100
+        deliveries = self.queue.send([self.message('one@example.com'), self.message('two@example.com')])
+        self.queue.drain()
+        self.assertEqual(FlakyBackend.calls, 2 * self.queue.max_attempts)
+        self.assertEqual([c.args[0] for c in self.sleep.call_args_list], [0.01, 0.02, 0.04])
+        for delivery in deliveries:
+            delivery.refresh_from_db()
+            self.assertEqual((delivery.status, delivery.attempts), (EmailDelivery.FAILED, 4))
+            self.assertIn('refused', delivery.last_error)
+        self.assertEqual(mail.outbox, [])
+
+
+class MetricsTests(TestCase):
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret\u00e9').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'ws_sockets', response.content)
+
+    def test_stopped_queues_leave_the_socket_count(self):
+        async def open_and_close():
+            queue = SendQueue(mock.AsyncMock(), mock.AsyncMock(), mock.AsyncMock())
+            self.assertIn(queue, SendQueue.instances)
+            queue.stop()
+            # Still referenced here, but no longer counted
+            self.assertNotIn(queue, SendQueue.instances)
+        async_to_sync(open_and_close)()
+
+
+class SweeperTests(TransactionTestCase):
+    # The room store writes from its own thread, so rows have to be committed
+
+    def setUp(self):
+        now = timezone.now()
+        self.session = InterviewSession.objects.create(
+            start_time=now - timedelta(minutes=20),
+            end_time=now - timedelta(minutes=5),
+            created_by=User.objects.create(username='tests', email='tests@example.com'),
+        )
+        # Still flagged active: nothing has noticed it ended yet
+        InterviewSession.objects.filter(id=self.session.id).update(is_active=True)
+        self.room = str(self.session.id)
+        self.addCleanup(session_cache.clear)
+        self.addCleanup(server.remove_room, self.room)
+
+    async def test_ended_session_is_swept_and_its_room_torn_down(self):
+        server.new_room(self.room, self.session.end_time)
+        server.new_user(self.room)
+        session_cache.store(self.session.id, SessionMeta(self.session.start_time, self.session.end_time, 10))
+        room_store.record(self.room, RoomOp.TEXT, 1, [{'p': 0, 'i': 'x'}])
+        room_store.snapshot(self.room, await server.room_state(self.room))
+        await asyncio.to_thread(room_store.drain)
+        self.assertTrue(await RoomOp.objects.filter(room_id=self.room).aexists())
+
+        sweeper = SessionSweeper()
+        ended = await sweeper._sweep({self.session.id}, timezone.now())
+        self.assertEqual(ended, [self.session.id])
+        self.assertFalse((await InterviewSession.objects.aget(id=self.session.id)).is_active)
+        # A socket in the room; its ticker would drop it from an ended room
+        # as soon as it runs, so the teardown follows straight away
+        consumer = mock.Mock(end_session=mock.AsyncMock())
+        room_clock.join(self.room, consumer)
+        await sweeper.teardown(self.room)
+
+        text, data = consumer.end_session.await_args.args
+        self.assertEqual(json.loads(text), {'type': 'session_ended', 'room': self.room})
+        self.assertEqual(frames.decode(data)[0], {'type': 'session_ended', 'room': self.room})
+        self.assertNotIn(self.room, room_clock.tasks)
+        self.assertIsNone(server.get_room(self.room))
+        self.assertEqual(session_cache.lookup(self.room), (False, None))
+        await asyncio.to_thread(room_store.drain)
+        self.assertFalse(await RoomOp.objects.filter(room_id=self.room).aexists())
+        self.assertFalse(await RoomSnapshot.objects.filter(room_id=self.room).aexists())
+
+    async def test_restarted_timer_keeps_the_room(self):
+        # start_timer moved the end after the session came due
+        await InterviewSession.objects.filter(id=self.session.id).aupdate(
+            end_time=timezone.now() + timedelta(minutes=10)
+        )
+        ended = await SessionSweeper()._sweep({self.session.id}, timezone.now())
+        self.assertEqual(ended, [])
+
+
+class StatusRefreshTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        creator = User.objects.create(username='tests', email='tests@example.com')
+
+        def session(start, end, is_active):
+            session = InterviewSession.objects.create(
+                start_time=now + timedelta(minutes=start),
+                end_time=now + timedelta(minutes=end),
+                created_by=creator,
+            )
+            # The flag as whatever last looked at it left it
+            InterviewSession.objects.filter(id=session.id).update(is_active=is_active)
+            return session.id
+
+        self.ended = session(-30, -15, True)
+        self.started = session(-5, 10, False)
+        self.running = session(-5, 10, True)
+        self.upcoming = session(10, 25, False)
+        self.past = session(-60, -45, False)
+
+    def statuses(self):
+        return dict(InterviewSession.objects.values_list('id', 'is_active'))
+
+    def assertRefreshed(self, notify):
+        self.assertEqual(self.statuses(), {
+            self.ended: False,
+            self.started: True,
+            self.running: True,
+            self.upcoming: False,
+            self.past: False,
+        })
+        self.assertEqual(
+            [(call.args[0], [s.id for s in call.args[1]]) for call in notify.call_args_list],
+            [('session_expired', [self.ended]), ('session_activated', [self.started])],
+        )
+
+    def test_refresh_flips_only_stale_sessions(self):
+        with mock.patch('core.lobby.notify_lobby') as notify:
+            # One SELECT and one UPDATE per kind of transition
+            with self.assertNumQueries(4):
+                InterviewSession.refresh_statuses()
+            self.assertRefreshed(notify)
+
+            notify.reset_mock()
+            with self.assertNumQueries(2):
+                InterviewSession.refresh_statuses()
+            notify.assert_not_called()
+
+    def test_async_refresh_matches(self):
+        with mock.patch('core.lobby.anotify_lobby') as notify:
+            with self.assertNumQueries(4):
+                async_to_sync(InterviewSession.arefresh_statuses)()
+            self.assertRefreshed(notify)
+
+    def test_query_count_does_not_grow_with_past_sessions(self):
+        creator = User.objects.get(username='tests')
+        now = timezone.now()
+        for days in range(1, 21):
+            InterviewSession.objects.create(
+                start_time=now - timedelta(days=days),
+                end_time=now - timedelta(days=days) + timedelta(minutes=15),
+                created_by=creator,
+            )
+        with mock.patch('core.lobby.notify_lobby'):
+            with self.assertNumQueries(4):
+                InterviewSession.refresh_statuses()
+
+
+class LobbyTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.session = InterviewSession.objects.create(
+            title='Started just now',
+            start_time=now - timedelta(minutes=1),
+            end_time=now + timedelta(minutes=14),
+            created_by=User.objects.create(username='tests', email='tests@example.com'),
+        )
+        self.session.is_active = False
+        InterviewSession.objects.filter(id=self.session.id).update(is_active=False)
+        # Only the status change under test talks to the lobby
+        sweeper = mock.patch.object(session_sweeper, 'start')
+        sweeper.start()
+        self.addCleanup(sweeper.stop)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(LobbyConsumer.as_asgi(), '/ws/lobby/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def assertAnnounced(self, communicator, event):
+        message = await communicator.receive_json_from()
+        self.assertEqual((message['event'], message['id']), (event, self.session.id))
+        self.assertIn('Started just now', message['html'])
+
+    async def test_update_status_tells_the_lobby(self):
+        communicator = await self.connect()
+        self.assertTrue(await sync_to_async(self.session.update_status)())
+        await self.assertAnnounced(communicator, 'session_activated')
+        # Nothing changed the second time round: nothing to say
+        await sync_to_async(self.session.update_status)()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_async_update_status_tells_the_lobby(self):
+        communicator = await self.connect()
+        self.assertTrue(await self.session.aupdate_status())
+        await self.assertAnnounced(communicator, 'session_activated')
+
+        self.session.end_time = timezone.now() - timedelta(seconds=1)
+        self.assertFalse(await self.session.aupdate_status())
+        await self.assertAnnounced(communicator, 'session_expired')
+        await communicator.disconnect()
+
+
+@override_settings(STORAGES=PLAIN_STORAGES)
+class AsyncViewTests(TestCase):
+    """The async views run on the async ORM: a sync query would raise
+    SynchronousOnlyOperation (and room_view would send everyone home)."""
+
+    def setUp(self):
+        now = timezone.now()
+        self.creator = User.objects.create(username='tests', email='creator@example.com')
+        self.active = InterviewSession.objects.create(
+            title='Running now',
+            start_time=now - timedelta(minutes=1),
+            end_time=now + timedelta(minutes=14),
+            created_by=self.creator,
+        )
+        self.expired = InterviewSession.objects.create(
+            title='Over already',
+            start_time=now - timedelta(minutes=30),
+            end_time=now - timedelta(minutes=15),
+            created_by=self.creator,
+        )
+        self.addCleanup(access_code_index.clear)
+        self.addCleanup(server.remove_room, str(self.active.id))
+        lobby = mock.patch('core.lobby.anotify_lobby')
+        lobby.start()
+        self.addCleanup(lobby.stop)
+
+    async def test_home_lists_sessions(self):
+        for path in ('/', '/?ajax=1'):
+            response = await self.async_client.get(path)
+            self.assertContains(response, 'Running now')
+            self.assertContains(response, 'Over already')
+
+    async def test_room_renders_an_active_session(self):
+        response = await self.async_client.get(f'/room/{self.active.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['session'].id, self.active.id)
+
+    async def test_room_activates_a_session_that_just_started(self):
+        await InterviewSession.objects.filter(id=self.active.id).aupdate(is_active=False)
+        response = await self.async_client.get(f'/room/{self.active.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue((await InterviewSession.objects.aget(id=self.active.id)).is_active)
+
+    async def test_room_sends_expired_and_unknown_sessions_home(self):
+        for room in (self.expired.id, 999999):
+            response = await self.async_client.get(f'/room/{room}/')
+            self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    async def test_join_session(self):
+        code = self.active.access_code
+        response = await self.async_client.post('/join_session/', {'access_code': code})
+        # The confirmation page shows the creator, fetched with the session
+        self.assertContains(response, 'creator@example.com')
+        response = await self.async_client.post('/join_session/', {'access_code': code, 'confirm': '1'})
+        self.assertRedirects(response, f'/room/{self.active.id}/', fetch_redirect_response=False)
+
+        response = await self.async_client.post('/join_session/', {'access_code': self.expired.access_code})
+        self.assertContains(response, 'This session has expired')
+        response = await self.async_client.post('/join_session/', {'access_code': 'WRONG001'})
+        self.assertContains(response, 'Invalid access code')
+
+
+class ParticipantTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.session = InterviewSession.objects.create(
+            start_time=now,
+            end_time=now + timedelta(minutes=15),
+            created_by=User.objects.create(username='admin', email='admin@example.com'),
+        )
+        User.objects.create(username='alice', email='alice@old.example.com')
+
+    def test_shared_local_parts_get_distinct_usernames(self):
+        emails = ['alice@a.example.com', 'alice@b.example.com', 'bob@example.com', 'alice@a.example.com']
+        with self.assertNumQueries(4):
+            users = SessionParticipant.add_all(self.session, emails)
+        self.assertEqual([user.username for user in users], ['alice2', 'alice3', 'bob'])
+        self.assertEqual(self.session.participants.count(), 3)
+
+    def test_existing_users_are_reused(self):
+        users = SessionParticipant.add_all(self.session, ['alice@old.example.com'])
+        self.assertEqual(users[0].username, 'alice')
+        self.assertEqual(User.objects.filter(username__startswith='alice').count(), 1)
+
+    def test_create_session_with_a_taken_username(self):
+        response = self.client.post('/create_session/', {
+            'title': 'Panel',
+            'candidate_emails': 'admin@elsewhere.example.com, alice@new.example.com',
+        })
+        self.assertEqual(response.status_code, 302)
+        session = InterviewSession.objects.get(title='Panel')
+        self.addCleanup(server.remove_room, str(session.id))
+        self.assertEqual(
+            sorted(session.participants.values_list('user__username', flat=True)),
+            ['admin2', 'alice2'],
+        )
+
+
+class WarmStartTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.session = InterviewSession.objects.create(
+            start_time=now,
+            end_time=now + timedelta(minutes=15),
+            created_by=User.objects.create(username='tests', email='tests@example.com'),
+        )
+        RoomSnapshot.objects.create(room_id=str(self.session.id), text='restored', text_rev=3)
+        self.store = RoomStore()
+        self.server = Server()
+
+    def test_rooms_are_restored_on_first_use_only(self):
+        with mock.patch.object(self.store, 'warm_start', wraps=self.store.warm_start) as warm_start:
+            async_to_sync(self.store.ensure_warm)(self.server)
+            async_to_sync(self.store.ensure_warm)(self.server)
+        self.assertEqual(warm_start.call_count, 1)
+        self.assertEqual(self.server.get_room(str(self.session.id)).editor.text, 'restored')
+
+    def test_database_errors_are_logged_and_retried(self):
+        with mock.patch.object(self.store, 'warm_start', side_effect=DatabaseError('down')):
+            with self.assertLogs('core.persistence', 'ERROR'):
+                async_to_sync(self.store.ensure_warm)(self.server)
+        self.assertFalse(self.store.warmed)
+        async_to_sync(self.store.ensure_warm)(self.server)
+        self.assertTrue(self.store.warmed)
+        self.assertIsNotNone(self.server.get_room(str(self.session.id)))
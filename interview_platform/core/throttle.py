@@ -0,0 +1,78 @@
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_BURST = 10
+DEFAULT_RATE = 0.1  # tokens per second
+MAX_KEYS = 10000
+
+
+class TokenBucket:
+    """Per-key token buckets holding up to `burst` tokens, refilled at `rate`/s.
+
+    Callers check allowed() before doing the work and consume() when it
+    should count against the key, e.g. only for failed attempts.
+    """
+
+    def __init__(self, rate=None, burst=None, max_keys=MAX_KEYS):
+        self.rate = rate if rate is not None else getattr(settings, 'JOIN_THROTTLE_RATE', DEFAULT_RATE)
+        self.burst = burst if burst is not None else getattr(settings, 'JOIN_THROTTLE_BURST', DEFAULT_BURST)
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> (tokens, as of)
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def _level(self, key, now):
+        entry = self.buckets.get(key)
+        if entry is None:
+            return self.burst
+        tokens, since = entry
+        return min(self.burst, tokens + (now - since) * self.rate)
+
+    def allowed(self, key):
+        """True while `key` has a whole token left; counts refusals."""
+        with self.lock:
+            if self._level(key, time.monotonic()) >= 1:
+                return True
+            self.throttled += 1
+            return False
+
+    def consume(self, key, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            if key not in self.buckets and len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            self.buckets[key] = (max(self._level(key, now) - amount, 0), now)
+
+    def _prune(self, now):
+        # Full buckets are the same as no bucket
+        for key in [key for key in self.buckets if self._level(key, now) >= self.burst]:
+            del self.buckets[key]
+        # Still too many: drop the oldest (dicts keep insertion order)
+        while len(self.buckets) >= self.max_keys:
+            del self.buckets[next(iter(self.buckets))]
+
+    def stats(self):
+        with self.lock:
+            return {'keys': len(self.buckets), 'throttled': self.throttled}
+
+
+def client_ip(request):
+    """The client address to throttle on, one the client can't choose itself.
+
+    Behind TRUSTED_PROXY_COUNT proxies that each append the address they
+    were connected from to X-Forwarded-For, the client is that many entries
+    from the right; anything further left came from the client. (REMOTE_ADDR
+    is no help there: daphne --proxy-headers sets it to the leftmost entry.)
+    Without trusted proxies it is the socket peer.
+    """
+    proxies = getattr(settings, 'TRUSTED_PROXY_COUNT', 0)
+    forwarded = [addr.strip() for addr in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if addr.strip()]
+    if proxies and forwarded:
+        return forwarded[-min(proxies, len(forwarded))]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+# Wrong access codes per client IP (core.views.join_session)
+join_throttle = TokenBucket()
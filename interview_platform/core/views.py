@@ -1,14 +1,26 @@
 import requests
+import hmac
 import json
-import os
+import logging
 from django.conf import settings
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import render, redirect
 from core.models import InterviewSession, User, SessionParticipant
 from django.utils import timezone
-from django.http import JsonResponse
-from django.core.mail import send_mail
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.core.mail import EmailMessage
 from django.contrib import messages
+from django.db import transaction
 from src.server import server
+from core import metrics
+from core.access_codes import access_code_index
+from core.lobby import notify_lobby
+from core.mailer import mail_queue
+from core.persistence import room_store
+from core.sweeper import session_sweeper
+from core.throttle import client_ip, join_throttle
+
+logger = logging.getLogger(__name__)
+
 # ✅ Use credentials from settings.py (which now loads from .env)
 try:
     EMAILJS_USER_ID = settings.EMAILJS_USER_ID
@@ -17,30 +29,26 @@ try:
     EMAILJS_ENABLED = all([EMAILJS_USER_ID, EMAILJS_SERVICE_ID, EMAILJS_TEMPLATE_ID])
 except AttributeError:
     EMAILJS_ENABLED = False
-    print("EmailJS settings not found. Email notifications will be disabled.")
+    logger.warning("EmailJS settings not found. Email notifications will be disabled.")
 
-def home_view(request):
+# home_view, room_view and join_session are async: under Daphne they run on
+# the event loop next to the WebSocket consumers, on the async ORM, instead of
+# each tying up a thread. Querysets are evaluated before rendering, templates
+# can't query the database from here.
+
+async def home_view(request):
     """View for the home page, showing active and expired sessions."""
-    # Get all sessions
-    all_sessions = InterviewSession.objects.all().order_by('-start_time')
-    
-    active_sessions = []
-    expired_sessions = []
-    
-    # Categorize sessions as active or expired
-    for session in all_sessions:
-        # Force update the session status
-        session.update_status()
-        
-        if session.is_expired():
-            session.is_active = False
-            session.save()
-            expired_sessions.append(session)
-        elif session.is_active:
-            active_sessions.append(session)
+    now = timezone.now()
+    await InterviewSession.arefresh_statuses(now)
     
-    # Limit expired sessions to the 5 most recent
-    expired_sessions = expired_sessions[:5]
+    # Only fetch what the page shows: the active sessions and the 5 most
+    # recently expired ones (both served by indexes, see InterviewSession.Meta)
+    active_sessions = [session async for session in InterviewSession.objects.filter(
+        is_active=True, start_time__lte=now, end_time__gte=now
+    ).order_by('-start_time')]
+    expired_sessions = [session async for session in InterviewSession.objects.filter(
+        end_time__lt=now
+    ).order_by('-end_time')[:5]]
     
     # If this is an AJAX request, render just the sessions partial
     if request.GET.get('ajax') == '1':
@@ -54,39 +62,36 @@ def home_view(request):
         'expired_sessions': expired_sessions
     })
 
-def room_view(request, id):
+async def room_view(request, id):
     """View for the interview room with shared editor and whiteboard."""
-    print(f"Accessing room with ID: {id} (type: {type(id)})")
+    logger.debug("Accessing room", extra={'room': id})
     
     try:
         # Try to get the session by ID
-        session = InterviewSession.objects.get(id=id)
-        print(f"Found session: {session.title}")
+        session = await InterviewSession.objects.aget(id=id)
         
         # Check if session has expired
         if session.is_expired():
-            print(f"Session {id} has expired")
+            logger.debug("Session has expired", extra={'room': id})
             messages.error(request, "This session has expired and is no longer available.")
             return redirect('home')
         
         # Check if session is active
         if not session.is_active:
-            # Update is_active based on current time
-            now = timezone.now()
-            if session.start_time <= now <= session.end_time:
-                session.is_active = True
-                session.save()
-                print("Session activated")
+            # Update is_active based on current time (tells the lobby)
+            if await session.aupdate_status():
+                logger.info("Session activated", extra={'room': id})
             else:
-                print("Session not active and outside time window")
+                logger.debug("Session not active and outside time window", extra={'room': id})
                 return redirect('home')
         
         # Check if a WebSocket room exists for this session, create one if not
-        ws_room = server.get_room(id)
-        if ws_room is None:
-            print(f"Creating new WebSocket room for session {id}")
-            room_id = server.new_room(str(id))
-            print(f"Created WebSocket room with ID: {room_id}")
+        # (after a restart, once running sessions' rooms have been restored).
+        # Capacity is left to the WebSocket join: counted here, the page's
+        # own socket (or the one it is replacing on a reload) would be in the
+        # way of the participant it belongs to
+        await room_store.ensure_warm(server)
+        await server.open_room(str(id), session.end_time)
         
         # Render the room template with session info
         return render(request, 'core/room.html', {
@@ -95,25 +100,21 @@ def room_view(request, id):
         })
     except InterviewSession.DoesNotExist:
         # If session doesn't exist, redirect to home
-        print(f"No session found with ID: {id}")
+        logger.debug("No session found", extra={'room': id})
         return redirect('home')
-    except Exception as e:
+    except Exception:
         # Catch any other errors
-        print(f"Error accessing room: {str(e)}")
+        logger.exception("Error accessing room", extra={'room': id})
         return redirect('home')
 
-def send_access_code(session_id):
-    session = get_object_or_404(InterviewSession, id=session_id)
-    
-    # Get participant emails
-    participant_emails = list(session.participants.all().values_list('user__email', flat=True))
-    all_recipients = [session.created_by.email] + participant_emails
-    
-    # Send email using Django's email system
-    send_mail(
-        subject=f"Interview Session: {session.title}",
-        message=f"""
-        Hi {session.created_by.username},
+def send_access_code(session, users):
+    """Queue the access code email for each user; sent in the background."""
+    subject = f"Interview Session: {session.title}"
+    messages_to_send = [
+        EmailMessage(
+            subject=subject,
+            body=f"""
+        Hi {user.username},
         
         Your interview session "{session.title}" has been created.
         Access code: {session.access_code}
@@ -121,11 +122,12 @@ def send_access_code(session_id):
         
         This session will expire after 15 minutes.
         """,
-        from_email="noreply@yourplatform.com",
-        recipient_list=all_recipients,
-        fail_silently=False,
-    )
-    print(f"✅ Email sent to {all_recipients}")
+            from_email="noreply@yourplatform.com",
+            to=[user.email],
+        )
+        for user in users if user.email
+    ]
+    mail_queue.send(messages_to_send, session=session)
 
 def create_session(request):
     """View to create a new interview session."""
@@ -135,67 +137,82 @@ def create_session(request):
         candidate_emails = request.POST.get("candidate_emails", "").split(",")
         candidate_emails = [email.strip() for email in candidate_emails if email.strip()]
         
-        # Create or get admin user
-        admin_user, created = User.objects.get_or_create(
-            email="admin@example.com",
-            defaults={'username': 'admin'}
-        )
-        
-        # Set session start time to now
-        start_time = timezone.now()
-        
-        # Create the session
-        session = InterviewSession.objects.create(
-            title=title,
-            description=description,
-            start_time=start_time,
-            end_time=start_time + timezone.timedelta(minutes=15),  # 15 minute session
-            created_by=admin_user
-        )
-        
-        # Create a room in the WebSocket server with the same ID as the session
-        room_id = server.new_room(str(session.id))
-        print(f"Created WebSocket room with ID: {room_id}")
-        
-        # Add participants
-        for email in candidate_emails:
-            participant, created = User.objects.get_or_create(
-                email=email,
-                defaults={'username': email.split('@')[0]}
+        # Session and participants are created together or not at all
+        with transaction.atomic():
+            # Create or get admin user
+            admin_user, created = User.objects.get_or_create(
+                email="admin@example.com",
+                defaults={'username': 'admin'}
             )
-            SessionParticipant.objects.create(
-                session=session,
-                user=participant
+            
+            # Set session start time to now
+            start_time = timezone.now()
+            
+            # Create the session
+            session = InterviewSession.objects.create(
+                title=title,
+                description=description,
+                start_time=start_time,
+                end_time=start_time + timezone.timedelta(minutes=15),  # 15 minute session
+                created_by=admin_user
             )
+            
+            # Add participants (same number of queries for any panel size)
+            participants = SessionParticipant.add_all(session, candidate_emails)
+            
+            # Email the access code without waiting on the mail server
+            # (queued once the transaction commits)
+            send_access_code(session, [admin_user] + participants)
+        
+        # Create a room in the WebSocket server with the same ID as the session
+        room_id = server.new_room(str(session.id), session.end_time)
+        logger.info("Created WebSocket room", extra={'room': room_id})
         
-        # Send email notification
-        send_access_code(session.id)
+        # Tell open home pages, and expire the session on time
+        notify_lobby('session_created', [session])
+        session_sweeper.schedule(session.end_time, session.id)
         
         messages.success(request, f"Session '{title}' created successfully! Access code: {session.access_code}")
         return redirect('home')
     
     return render(request, 'core/create_session.html')
 
-def join_session(request):
+async def join_session(request):
     """View to join an interview session using an access code."""
     if request.method == "POST":
         access_code = request.POST.get("access_code")
         confirm = request.POST.get("confirm")
-        print(f"Attempting to join with access code: {access_code}, confirm={confirm}")
+        logger.debug("Attempting to join with an access code", extra={'confirm': confirm})
         
-        # Check if confirm_join.html exists
-        template_path = os.path.join(settings.BASE_DIR, 'core', 'templates', 'core', 'confirm_join.html')
-        if not os.path.exists(template_path):
-            print(f"WARNING: Template file {template_path} does not exist!")
+        # Clients that keep getting codes wrong are turned away before any
+        # lookup (only wrong codes use up their tokens)
+        client = client_ip(request)
+        if not join_throttle.allowed(client):
+            logger.debug("Join throttled", extra={'client': client})
+            return render(request, "core/home.html", {
+                "error": "Too many invalid access codes. Please wait a minute and try again.",
+                "access_code": access_code
+            }, status=429)
         
-        # Try to find the session with this access code
+        # Try to find the session with this access code; unknown codes are
+        # answered from memory (see core/access_codes.py)
         try:
-            session = InterviewSession.objects.get(access_code=access_code)
-            print(f"Found session: {session.id} - {session.title}")
+            session_id = await access_code_index.resolve(access_code)
+            if session_id is None:
+                raise InterviewSession.DoesNotExist
+            try:
+                # created_by is shown on the confirmation page; the code is
+                # matched again in case it changed since it was indexed
+                session = await InterviewSession.objects.select_related('created_by').aget(
+                    id=session_id, access_code=access_code
+                )
+            except InterviewSession.DoesNotExist:
+                access_code_index.discard(access_code)
+                raise
             
             # Check if session has expired
             if session.is_expired():
-                print(f"Session {session.id} has expired")
+                logger.debug("Session has expired", extra={'room': session.id})
                 return render(request, "core/home.html", {
                     "error": "This session has expired and is no longer available.",
                     "access_code": access_code
@@ -203,14 +220,11 @@ def join_session(request):
             
             # Check if session is active
             if not session.is_active:
-                # Update is_active based on current time
-                now = timezone.now()
-                if session.start_time <= now <= session.end_time:
-                    session.is_active = True
-                    session.save()
-                    print("Session activated")
+                # Update is_active based on current time (tells the lobby)
+                if await session.aupdate_status():
+                    logger.info("Session activated", extra={'room': session.id})
                 else:
-                    print("Session not active and outside time window")
+                    logger.debug("Session not active and outside time window", extra={'room': session.id})
                     return render(request, "core/home.html", {
                         "error": "This session is not active yet or has expired.",
                         "access_code": access_code
@@ -218,24 +232,33 @@ def join_session(request):
             
             # If not confirmed yet, show confirmation page
             if not confirm or confirm != "1":
-                print("Showing confirmation page")
                 return render(request, "core/confirm_join.html", {
                     "session": session,
                     "access_code": access_code
                 })
             
             # Redirect to the room view with the session ID
-            print(f"Confirmed! Redirecting to room/{session.id}/")
+            logger.debug("Join confirmed", extra={'room': session.id})
             return redirect('room', id=session.id)
             
         except InterviewSession.DoesNotExist:
-            print(f"No session found with access code: {access_code}")
-            # List all access codes in the database for debugging
-            all_codes = InterviewSession.objects.values_list('access_code', flat=True)
-            print(f"Available access codes: {list(all_codes)}")
+            logger.info("No session found for an access code")
+            join_throttle.consume(client)
             return render(request, "core/home.html", {
                 "error": "Invalid access code. Please try again.",
                 "access_code": access_code
             })
     
-    return redirect('home')
\ No newline at end of file
+    return redirect('home')
+
+def metrics_view(request):
+    """Process metrics in the Prometheus text format (see core/metrics.py)."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        # Only open without a token while developing
+        if not settings.DEBUG:
+            return HttpResponseForbidden()
+    elif not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+        # Constant time, so response times don't give the token away
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -19,7 +19,6 @@ except ImportError:
     # For local development without dj_database_url
     dj_database_url = None
 from django.core.management.utils import get_random_secret_key
-import time
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,14 +48,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.view_metrics',
     'django.middleware.security.SecurityMiddleware',
+    # Static files are answered before sessions, CSRF, auth... get involved
+    'core.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
 ]
 
 ROOT_URLCONF = 'interview_platform.urls'
@@ -72,7 +73,6 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
-                'interview_platform.context_processors.add_timestamp',
             ],
         },
     },
@@ -81,10 +81,71 @@ TEMPLATES = [
 WSGI_APPLICATION = 'interview_platform.wsgi.application'
 # ASGI Application for WebSockets
 ASGI_APPLICATION = 'interview_platform.asgi.application'
-# Channel Layers using in-memory backend for development
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+# Channel Layers: Redis when REDIS_URL is set (required to run several Daphne
+# workers, room state is then shared through Redis too - see src/server.py),
+# in-memory backend for development otherwise
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+# Seconds the WebSocket consumers keep a session's end time / capacity in
+# memory (core/session_cache.py); saves invalidate it right away
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', 30))
+# join_session resolves access codes from an in-memory index of every
+# session's code, reloaded at most every ACCESS_CODE_REFRESH seconds to pick
+# up sessions other workers created (core/access_codes.py). A client IP may
+# get JOIN_THROTTLE_BURST codes wrong in a row, then one more every
+# 1 / JOIN_THROTTLE_RATE seconds (core/throttle.py)
+ACCESS_CODE_REFRESH = int(os.environ.get('ACCESS_CODE_REFRESH', 10))
+JOIN_THROTTLE_BURST = int(os.environ.get('JOIN_THROTTLE_BURST', 10))
+JOIN_THROTTLE_RATE = float(os.environ.get('JOIN_THROTTLE_RATE', 0.1))
+# Reverse proxies in front of the app that append to X-Forwarded-For; the
+# client IP the throttle keys on is read from behind them (0: the socket peer)
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+# Room broadcasts are coalesced into at most one publish per window, with up
+# to WS_COALESCE_MAX_BATCH events per frame (core/outbox.py)
+WS_COALESCE_WINDOW_MS = int(os.environ.get('WS_COALESCE_WINDOW_MS', 16))
+WS_COALESCE_MAX_BATCH = int(os.environ.get('WS_COALESCE_MAX_BATCH', 64))
+# Frames queued per connection before a slow client is resynced from the
+# room's latest state ('coalesce') or dropped ('disconnect'), see
+# core/sendqueue.py
+WS_SEND_QUEUE_LIMIT = int(os.environ.get('WS_SEND_QUEUE_LIMIT', 256))
+WS_SLOW_CLIENT_POLICY = os.environ.get('WS_SLOW_CLIENT_POLICY', 'coalesce')
+# /metrics (Prometheus text format) needs "Authorization: Bearer <token>";
+# without a token it is only served when DEBUG is on
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Logs go to stdout, one JSON object per line (LOG_FORMAT=text for plain lines)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'core.logs.JsonFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': os.environ.get('LOG_FORMAT', 'json'),
+        },
+    },
+    'root': {'handlers': ['console'], 'level': 'WARNING'},
+    'loggers': {
+        'core': {'level': LOG_LEVEL},
+        'interview_platform': {'level': LOG_LEVEL},
     },
 }
 # Database
@@ -145,7 +206,6 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [
     BASE_DIR / STATIC_URL,
 ]
-print(BASE_DIR / STATIC_URL)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -166,8 +226,19 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 # EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 
-# Add whitenoise for static files
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# collectstatic writes every static file under a content-hashed name
+# (js/room.<hash>.js, listed in staticfiles.json) plus gzip copies, and brotli
+# ones when the Brotli package is installed; {% static %} links the hashed
+# name. WhiteNoise serves hashed files as cacheable forever (immutable), so
+# browsers only fetch a script again once its content changes.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage',
+    },
+}
 
 # Add these settings for CSRF protection
 CSRF_TRUSTED_ORIGINS = [
@@ -190,7 +261,3 @@ if not DEBUG:
     SECURE_HSTS_SECONDS = 31536000  # 1 year
     SECURE_HSTS_PRELOAD = True
     SECURE_HSTS_INCLUDE_SUBDOMAINS = True
-
-def add_timestamp(request):
-    """Add current timestamp to context for cache-busting."""
-    return {'CURRENT_TIMESTAMP': int(time.time())}
@@ -26,6 +26,7 @@ urlpatterns = [
     path('room/<str:id>/', room_view, name='room'),
     path('create_session/', create_session, name="create_session"),
     path('join_session/', join_session, name="join_session"),
+    path('metrics', metrics_view, name="metrics"),
 ]
 
 urlpatterns += staticfiles_urlpatterns()
@@ -1,9 +1,153 @@
+# Operational transform engine for the shared code editor.
+#
+# An operation is a dict, either an insert {'p': pos, 'i': "text"} or a
+# delete {'p': pos, 'd': count}. Clients send a list of operations (applied
+# in order) together with the revision they were made against; the editor
+# transforms them past everything applied since, applies them, and hands
+# back the transformed list so only that delta has to be broadcast.
+
+HISTORY_LIMIT = 1000
+
+
+class OperationError(ValueError):
+	pass
+
+
+def _shift(op, p):
+	return dict(op, p=p)
+
+
+def _transform_one(a, b, b_first):
+	"""Transform single ops a and b (made against the same text) past each other.
+
+	Returns (a', b') as lists: a' applies after b, b' applies after a.
+	b_first decides which insert goes first when both insert at one position.
+	"""
+	if 'i' in a and 'i' in b:
+		if a['p'] < b['p'] or (a['p'] == b['p'] and not b_first):
+			return [a], [_shift(b, b['p'] + len(a['i']))]
+		return [_shift(a, a['p'] + len(b['i']))], [b]
+
+	if 'i' in a:
+		b_past_a, a_past_b = _transform_one(b, a, not b_first)
+		return a_past_b, b_past_a
+
+	if 'i' in b:
+		# a is a delete, b an insert
+		if b['p'] <= a['p']:
+			return [_shift(a, a['p'] + len(b['i']))], [b]
+		if b['p'] >= a['p'] + a['d']:
+			return [a], [_shift(b, b['p'] - a['d'])]
+		# Insert landed inside the deleted range: keep it, delete around it
+		before = b['p'] - a['p']
+		after = a['d'] - before
+		return (
+			[{'p': a['p'], 'd': before}, {'p': a['p'] + len(b['i']), 'd': after}],
+			[_shift(b, a['p'])],
+		)
+
+	# Both deletes
+	return _delete_past_delete(a, b), _delete_past_delete(b, a)
+
+
+def _delete_past_delete(a, b):
+	a_end = a['p'] + a['d']
+	b_end = b['p'] + b['d']
+	overlap = max(0, min(a_end, b_end) - max(a['p'], b['p']))
+	count = a['d'] - overlap
+	if count == 0:
+		return []
+	removed_before = max(0, min(b_end, a['p']) - b['p'])
+	return [{'p': a['p'] - removed_before, 'd': count}]
+
+
+def transform(ops, against, against_first=True):
+	"""Transform two concurrent op lists past each other.
+
+	Returns (ops', against') where ops' applies after `against` and
+	against' applies after `ops`.
+	"""
+	if not ops or not against:
+		return ops, against
+	if len(ops) > 1:
+		head, against = transform(ops[:1], against, against_first)
+		tail, against = transform(ops[1:], against, against_first)
+		return head + tail, against
+	if len(against) > 1:
+		ops, head = transform(ops, against[:1], against_first)
+		ops, tail = transform(ops, against[1:], against_first)
+		return ops, head + tail
+	return _transform_one(ops[0], against[0], against_first)
+
+
+def validate(ops):
+	"""Check the shape of a client supplied op list."""
+	if not isinstance(ops, list):
+		raise OperationError("ops must be a list")
+	for op in ops:
+		if not isinstance(op, dict) or not isinstance(op.get('p'), int) or op['p'] < 0:
+			raise OperationError(f"bad op: {op!r}")
+		if 'i' in op:
+			if not isinstance(op['i'], str):
+				raise OperationError(f"bad insert: {op!r}")
+		elif not isinstance(op.get('d'), int) or op['d'] < 0:
+			raise OperationError(f"bad delete: {op!r}")
+
+
+def apply_ops(text, ops):
+	for op in ops:
+		p = op['p']
+		if p > len(text):
+			raise OperationError(f"op position {p} past end of document ({len(text)})")
+		if 'i' in op:
+			text = text[:p] + op['i'] + text[p:]
+		else:
+			if p + op['d'] > len(text):
+				raise OperationError(f"delete past end of document: {op!r}")
+			text = text[:p] + text[p + op['d']:]
+	return text
+
+
 class Editor:
 	def __init__(self):
 		self.text = ""
+		self.revision = 0
+		# Ops applied at revisions history_start+1 .. revision
+		self.history = []
+		self.history_start = 0
 
 	def get_text(self):
 		return self.text
-	
+
 	def set_text(self, text):
-		self.text = text
\ No newline at end of file
+		"""Replace the whole document (resets the op history)."""
+		self.text = text
+		self.revision += 1
+		self.history = []
+		self.history_start = self.revision
+
+	def apply(self, base_revision, ops):
+		"""Apply client ops made against base_revision.
+
+		Returns (revision, transformed_ops). Raises OperationError when the ops
+		are malformed or too old to transform; the client should resync from
+		a snapshot.
+		"""
+		validate(ops)
+		if base_revision < self.history_start or base_revision > self.revision:
+			raise OperationError(f"revision {base_revision} not available")
+
+		for applied in self.history[base_revision - self.history_start:]:
+			ops, _ = transform(ops, applied)
+
+		self.text = apply_ops(self.text, ops)
+		self.revision += 1
+		self.history.append(ops)
+		if len(self.history) > HISTORY_LIMIT:
+			drop = len(self.history) - HISTORY_LIMIT
+			del self.history[:drop]
+			self.history_start += drop
+		return self.revision, ops
+
+	def snapshot(self):
+		return {'text': self.text, 'rev': self.revision}
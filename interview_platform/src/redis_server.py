@@ -0,0 +1,422 @@
+# Room registry kept in Redis so several Daphne workers can serve one room.
+#
+# Key layout, per room (prefix "intervu:room:<id>"):
+#   :meta   hash  end_time, text, rev, hist_start, wb_rev, wb_points, epoch, seq
+#   :hist   list  JSON editor op lists for revisions hist_start+1 .. rev
+#   :wb     list  JSON whiteboard ops since the last clear
+#   :users  set   connected user ids
+#   :binary set   the connected user ids that take binary frames
+#   :log    zset  the last EVENT_LOG_LIMIT published frames (JSON), scored by seq
+#   :lock   lock  held while an op is transformed and applied
+# and "intervu:users", a hash of user id -> room id.
+#
+# Room keys expire at the session end time, so Redis evicts finished rooms.
+
+import json
+from datetime import datetime
+
+import redis
+import redis.asyncio
+
+from src.editor import Editor, HISTORY_LIMIT
+from src.room import EVENT_LOG_LIMIT, Room, new_epoch
+from src.server import Server
+from src.user import User
+from src.whiteboard import Whiteboard, grow
+
+KEY_PREFIX = "intervu"
+# How long rooms without a known session end time are kept
+DEFAULT_TTL = 24 * 60 * 60
+LOCK_TIMEOUT = 5
+
+# Takes the room's next sequence number and logs the frame under it in one
+# step, so a frame is in the log as soon as its number is handed out. The
+# frame's JSON gets "seq" spliced in up front (frames are never empty).
+# Rooms that are gone aren't brought back; the log expires with the room.
+# Returns {seq, number of connections taking binary frames}.
+RECORD_FRAME = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+	return {0, 0}
+end
+local seq = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+redis.call('ZADD', KEYS[2], seq, '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2))
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then
+	redis.call('PEXPIRE', KEYS[2], ttl)
+end
+return {seq, redis.call('SCARD', KEYS[3])}
+"""
+
+# Adds ARGV[2] to an account's connection count in the room's presence hash,
+# dropping the field at zero; the hash expires with the room. Returns the new
+# count, 0 for a room that is gone.
+TRACK_PRESENCE = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+	return 0
+end
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if count <= 0 then
+	redis.call('HDEL', KEYS[1], ARGV[1])
+	return 0
+end
+local ttl = redis.call('PTTL', KEYS[2])
+if ttl > 0 then
+	redis.call('PEXPIRE', KEYS[1], ttl)
+end
+return count
+"""
+
+
+def _decode(value, default=""):
+	if value is None:
+		return default
+	return value.decode() if isinstance(value, bytes) else value
+
+
+class RedisServer(Server):
+	def __init__(self, url):
+		super().__init__()
+		self.url = url
+		self.redis = redis.Redis.from_url(url)
+		self._aredis = None
+		self.users_key = f"{KEY_PREFIX}:users"
+		self._record_frame = None
+		self._track_presence = None
+
+	@property
+	def aredis(self):
+		# Created on first use so it binds to the running event loop
+		if self._aredis is None:
+			self._aredis = redis.asyncio.Redis.from_url(self.url)
+		return self._aredis
+
+	def _key(self, room_id, part):
+		return f"{KEY_PREFIX}:room:{room_id}:{part}"
+
+	def _room_keys(self, room_id):
+		return [self._key(room_id, part) for part in ('meta', 'hist', 'wb', 'users', 'binary', 'log', 'present')]
+
+	def _expire(self, pipe, room_id, end_time):
+		for key in self._room_keys(room_id):
+			if end_time:
+				pipe.expireat(key, end_time)
+			else:
+				pipe.expire(key, DEFAULT_TTL)
+
+	def _end_time(self, meta):
+		value = _decode(meta.get(b'end_time'))
+		return datetime.fromisoformat(value) if value else None
+
+	def _create(self, pipe, room_id, end_time):
+		pipe.hset(self._key(room_id, 'meta'), mapping={
+			'end_time': end_time.isoformat() if end_time else '',
+			'text': '',
+			'rev': 0,
+			'hist_start': 0,
+			'wb_rev': 0,
+			'wb_points': 0,
+			'epoch': new_epoch(),
+			'seq': 0,
+		})
+		self._expire(pipe, room_id, end_time)
+
+	# Sync API used by sync views and startup
+
+	def new_room(self, room_id=None, end_time=None):
+		room = Room(room_id, end_time)
+		pipe = self.redis.pipeline()
+		self._create(pipe, room.id, end_time)
+		pipe.execute()
+		return room.id
+
+	def ensure_room(self, room_id, end_time=None):
+		if self.redis.exists(self._key(room_id, 'meta')):
+			return room_id
+		return self.new_room(room_id, end_time)
+
+	def get_room(self, id):
+		"""Load a copy of a room; changes to it are not written back."""
+		meta = self.redis.hgetall(self._key(id, 'meta'))
+		if not meta:
+			return None
+		room = Room(id, self._end_time(meta))
+		room.editor.text = _decode(meta.get(b'text'))
+		room.editor.revision = int(meta.get(b'rev', 0))
+		room.editor.history_start = int(meta.get(b'hist_start', 0))
+		room.editor.history = [json.loads(ops) for ops in self.redis.lrange(self._key(id, 'hist'), 0, -1)]
+		room.whiteboard.restore(
+			[json.loads(op) for op in self.redis.lrange(self._key(id, 'wb'), 0, -1)],
+			int(meta.get(b'wb_rev', 0)),
+		)
+		for user_id in self.redis.smembers(self._key(id, 'users')):
+			user = User()
+			user.id = _decode(user_id)
+			room.add_user(user)
+		return room
+
+	def set_room_end_time(self, id, end_time):
+		if not self.redis.exists(self._key(id, 'meta')):
+			return
+		pipe = self.redis.pipeline()
+		pipe.hset(self._key(id, 'meta'), 'end_time', end_time.isoformat())
+		self._expire(pipe, id, end_time)
+		pipe.execute()
+
+	def remove_room(self, id):
+		users = self.redis.smembers(self._key(id, 'users'))
+		pipe = self.redis.pipeline()
+		if users:
+			pipe.hdel(self.users_key, *users)
+		pipe.delete(*self._room_keys(id))
+		pipe.execute()
+
+	def evict_expired(self, now=None):
+		# Room keys carry an expiry, Redis drops them on its own
+		return []
+
+	def restore_room(self, room_id, end_time, state):
+		# Only fill in rooms Redis has lost (e.g. after a flush or a restart
+		# without persistence), the live copy wins otherwise
+		if self.redis.exists(self._key(room_id, 'meta')):
+			return
+		editor, whiteboard = state['editor'], state['whiteboard']
+		board = Whiteboard()
+		board.restore(whiteboard['ops'], whiteboard['rev'])
+		pipe = self.redis.pipeline()
+		pipe.hset(self._key(room_id, 'meta'), mapping={
+			'end_time': end_time.isoformat() if end_time else '',
+			'text': editor['text'],
+			'rev': editor['rev'],
+			'hist_start': editor['rev'],
+			'wb_rev': whiteboard['rev'],
+			'wb_points': board.points,
+			'epoch': new_epoch(),
+			'seq': 0,
+		})
+		if whiteboard['ops']:
+			pipe.rpush(self._key(room_id, 'wb'), *[json.dumps(op) for op in whiteboard['ops']])
+		self._expire(pipe, room_id, end_time)
+		pipe.execute()
+
+	def new_user(self, room, binary=False):
+		user = User()
+		pipe = self.redis.pipeline()
+		pipe.sadd(self._key(room, 'users'), user.id)
+		if binary:
+			pipe.sadd(self._key(room, 'binary'), user.id)
+		pipe.hset(self.users_key, user.id, room)
+		pipe.execute()
+		return user.id
+
+	def remove_user(self, id):
+		room_id = self.redis.hget(self.users_key, id) if id is not None else None
+		if room_id is not None:
+			pipe = self.redis.pipeline()
+			pipe.srem(self._key(_decode(room_id), 'users'), id)
+			pipe.srem(self._key(_decode(room_id), 'binary'), id)
+			pipe.hdel(self.users_key, id)
+			pipe.execute()
+
+	# Async API used by the WebSocket consumer and async views
+
+	async def open_room(self, room_id, end_time=None):
+		if await self.aredis.exists(self._key(room_id, 'meta')):
+			return room_id
+		pipe = self.aredis.pipeline()
+		self._create(pipe, room_id, end_time)
+		await pipe.execute()
+		return room_id
+
+	async def join_room(self, room_id, limit=None, end_time=None, binary=False):
+		r = self.aredis
+		meta_key = self._key(room_id, 'meta')
+		users_key = self._key(room_id, 'users')
+		user = User()
+		async with r.lock(self._key(room_id, 'lock'), timeout=LOCK_TIMEOUT):
+			# Joins take the room lock, so no other worker can admit someone
+			# between the count and the add
+			if limit is not None and await r.scard(users_key) >= limit:
+				return None
+			# A room first seen over a socket (e.g. after a flush) gets defaults
+			pipe = r.pipeline()
+			pipe.hsetnx(meta_key, 'end_time', end_time.isoformat() if end_time else '')
+			pipe.hsetnx(meta_key, 'rev', 0)
+			pipe.hsetnx(meta_key, 'epoch', new_epoch())
+			pipe.hget(meta_key, 'end_time')
+			pipe.sadd(users_key, user.id)
+			pipe.hset(self.users_key, user.id, room_id)
+			if binary:
+				pipe.sadd(self._key(room_id, 'binary'), user.id)
+			end_time = (await pipe.execute())[3]
+			pipe = r.pipeline()
+			self._expire(pipe, room_id, self._end_time({b'end_time': end_time}))
+			await pipe.execute()
+		return user.id
+
+	async def leave_room(self, user_id):
+		if user_id is None:
+			return
+		r = self.aredis
+		room_id = await r.hget(self.users_key, user_id)
+		if room_id is not None:
+			pipe = r.pipeline()
+			pipe.srem(self._key(_decode(room_id), 'users'), user_id)
+			pipe.srem(self._key(_decode(room_id), 'binary'), user_id)
+			pipe.hdel(self.users_key, user_id)
+			await pipe.execute()
+
+	async def apply_text(self, room_id, base_revision, ops):
+		r = self.aredis
+		meta_key = self._key(room_id, 'meta')
+		hist_key = self._key(room_id, 'hist')
+		async with r.lock(self._key(room_id, 'lock'), timeout=LOCK_TIMEOUT):
+			meta = await r.hgetall(meta_key)
+			if not meta:
+				return None
+
+			# Rebuild just enough of the editor to transform and apply the ops
+			editor = Editor()
+			editor.text = _decode(meta.get(b'text'))
+			editor.revision = int(meta.get(b'rev', 0))
+			hist_start = int(meta.get(b'hist_start', 0))
+			editor.history_start = hist_start
+			if isinstance(base_revision, int) and hist_start <= base_revision <= editor.revision:
+				editor.history_start = base_revision
+				editor.history = [
+					json.loads(applied)
+					for applied in await r.lrange(hist_key, base_revision - hist_start, -1)
+				]
+			revision, ops = editor.apply(base_revision, ops)
+
+			pipe = r.pipeline()
+			pipe.hset(meta_key, mapping={
+				'text': editor.text,
+				'rev': revision,
+				'hist_start': max(hist_start, revision - HISTORY_LIMIT),
+			})
+			pipe.rpush(hist_key, json.dumps(ops))
+			pipe.ltrim(hist_key, -HISTORY_LIMIT, -1)
+			self._expire(pipe, room_id, self._end_time(meta))
+			await pipe.execute()
+		return revision, ops
+
+	async def text_snapshot(self, room_id):
+		text, rev = await self.aredis.hmget(self._key(room_id, 'meta'), 'text', 'rev')
+		if rev is None:
+			return None
+		return {'text': _decode(text), 'rev': int(rev)}
+
+	async def room_state(self, room_id):
+		pipe = self.aredis.pipeline()
+		pipe.hmget(self._key(room_id, 'meta'), 'text', 'rev', 'wb_rev')
+		pipe.lrange(self._key(room_id, 'wb'), 0, -1)
+		(text, rev, wb_rev), wb_ops = await pipe.execute()
+		if rev is None:
+			return None
+		return {
+			'editor': {'text': _decode(text), 'rev': int(rev)},
+			'whiteboard': {'ops': [json.loads(op) for op in wb_ops], 'rev': int(wb_rev or 0)},
+		}
+
+	async def apply_whiteboard(self, room_id, ops):
+		r = self.aredis
+		meta_key = self._key(room_id, 'meta')
+		wb_key = self._key(room_id, 'wb')
+		async with r.lock(self._key(room_id, 'lock'), timeout=LOCK_TIMEOUT):
+			pipe = r.pipeline()
+			pipe.hgetall(meta_key)
+			pipe.llen(wb_key)
+			meta, count = await pipe.execute()
+			if not meta:
+				return None
+
+			# Apply to an empty board: afterwards its ops are exactly what has
+			# to be appended to the stored log (after wiping it on a clear)
+			whiteboard = Whiteboard()
+			whiteboard.revision = int(meta.get(b'wb_rev', 0))
+			revision, ops = whiteboard.apply(ops)
+			# The stored board's size is what the cap applies to
+			_, points = grow(ops, count, int(meta.get(b'wb_points', 0)))
+
+			pipe = r.pipeline()
+			if any(op['t'] == 'clear' for op in ops):
+				pipe.delete(wb_key)
+			if whiteboard.ops:
+				pipe.rpush(wb_key, *[json.dumps(op) for op in whiteboard.ops])
+			pipe.hset(meta_key, mapping={'wb_rev': revision, 'wb_points': points})
+			self._expire(pipe, room_id, self._end_time(meta))
+			await pipe.execute()
+		return revision, ops
+
+	async def whiteboard_snapshot(self, room_id):
+		pipe = self.aredis.pipeline()
+		pipe.exists(self._key(room_id, 'meta'))
+		pipe.hget(self._key(room_id, 'meta'), 'wb_rev')
+		pipe.lrange(self._key(room_id, 'wb'), 0, -1)
+		exists, rev, ops = await pipe.execute()
+		if not exists:
+			return None
+		return {'ops': [json.loads(op) for op in ops], 'rev': int(rev or 0)}
+
+	async def update_end_time(self, room_id, end_time):
+		r = self.aredis
+		if not await r.exists(self._key(room_id, 'meta')):
+			return
+		pipe = r.pipeline()
+		pipe.hset(self._key(room_id, 'meta'), 'end_time', end_time.isoformat())
+		self._expire(pipe, room_id, end_time)
+		await pipe.execute()
+
+	async def close_room(self, room_id):
+		r = self.aredis
+		users = await r.smembers(self._key(room_id, 'users'))
+		pipe = r.pipeline()
+		if users:
+			pipe.hdel(self.users_key, *users)
+		pipe.delete(*self._room_keys(room_id))
+		await pipe.execute()
+
+	async def room_is_open(self, room_id, now):
+		value = await self.aredis.hget(self._key(room_id, 'meta'), 'end_time')
+		if value is None:
+			return False
+		value = _decode(value)
+		return not value or datetime.fromisoformat(value) >= now
+
+	async def record_frame(self, room_id, frame):
+		if self._record_frame is None:
+			self._record_frame = self.aredis.register_script(RECORD_FRAME)
+		seq, binary = await self._record_frame(
+			keys=[self._key(room_id, 'meta'), self._key(room_id, 'log'), self._key(room_id, 'binary')],
+			args=[json.dumps(frame), EVENT_LOG_LIMIT],
+		)
+		if seq:
+			frame['seq'] = seq
+		return seq, binary > 0
+
+	async def replay(self, room_id, seq=None, epoch=None):
+		pipe = self.aredis.pipeline()
+		pipe.hmget(self._key(room_id, 'meta'), 'epoch', 'seq')
+		if seq is not None:
+			pipe.zrange(self._key(room_id, 'log'), 0, 0, withscores=True)
+			pipe.zrangebyscore(self._key(room_id, 'log'), f"({seq}", '+inf')
+		results = await pipe.execute()
+		current_epoch, current = results[0]
+		if current_epoch is None:
+			return None, 0, None
+		current_epoch, current = _decode(current_epoch), int(current or 0)
+		frames = None
+		if seq is not None and epoch == current_epoch and seq <= current:
+			oldest = int(results[1][0][1]) if results[1] else current + 1
+			if seq + 1 >= oldest:
+				frames = [json.loads(frame) for frame in results[2]]
+		return current_epoch, current, frames
+
+	async def track_presence(self, room_id, account, change):
+		if self._track_presence is None:
+			self._track_presence = self.aredis.register_script(TRACK_PRESENCE)
+		return await self._track_presence(
+			keys=[self._key(room_id, 'present'), self._key(room_id, 'meta')],
+			args=[account, change],
+		)
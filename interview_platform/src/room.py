@@ -1,17 +1,38 @@
 import uuid
+from collections import deque
 from src.editor import Editor
 from src.whiteboard import Whiteboard
-from src.user import User
+
+# Published frames a room keeps for reconnecting clients to catch up from
+EVENT_LOG_LIMIT = 256
+
+
+def new_epoch():
+	"""Id of one incarnation of a room's event log: sequence numbers restart
+	with it, so a client's position in an older one means nothing."""
+	return uuid.uuid4().hex[:8]
+
 
 class Room:
-	def __init__(self, room_id=None):
+	__slots__ = ('id', 'users', 'binary', 'present', 'editor', 'whiteboard', 'end_time', 'epoch', 'seq', 'events')
+
+	def __init__(self, room_id=None, end_time=None):
 		self.id = room_id if room_id else str(uuid.uuid4())[:8]
-		self.users = []
+		self.users = {}  # user id -> User
+		self.binary = set()  # ids of the users that take binary frames
+		self.present = {}  # account pk -> that account's connections to the room
 		self.editor = Editor()
 		self.whiteboard = Whiteboard()
-		self.end_time = None  # Will store the session end time
+		self.end_time = end_time  # Will store the session end time
+		self.epoch = new_epoch()
+		self.seq = 0  # sequence number of the last published frame
+		self.events = deque(maxlen=EVENT_LOG_LIMIT)  # (seq, frame), oldest first
+
+	def add_user(self, user, binary=False):
+		self.users[user.id] = user
+		if binary:
+			self.binary.add(user.id)
 
 	def remove_user(self, id):
-		for user in self.users:
-			if user.id == id:
-				self.users.remove(user)
\ No newline at end of file
+		self.users.pop(id, None)
+		self.binary.discard(id)
@@ -1,40 +1,234 @@
+import heapq
+import os
+import threading
+from datetime import datetime, timezone
 from src.room import Room
 from src.user import User
 
 class Server:
 	def __init__(self):
-		self.rooms = []
-		self.user_rooms = {}
+		self.rooms = {}  # room id -> Room
+		self.user_rooms = {}  # user id -> room id
+		# (end_time, room id) heap used to evict rooms once their session ends.
+		# Entries go stale when a room's end time changes; they are skipped on pop.
+		self.expiry = []
+		# Rooms are created and dropped on the event loop, but also from the
+		# threads sync views (create_session) and the room store's warm
+		# start run in: changes to the room and user maps and the expiry heap
+		# hold this lock. It is never held across an await or any I/O
+		# (RedisServer keeps none of them in memory).
+		self.lock = threading.RLock()
 	
-	def new_user(self, room):
+	def new_user(self, room, binary=False):
 		user = User()
-		self.get_room(room).users.append(user)
-		self.user_rooms[user.id] = room
+		with self.lock:
+			self.get_room(room).add_user(user, binary)
+			self.user_rooms[user.id] = room
 		return user.id
 	
 	def remove_user(self, id):
 		# Only try to remove if the user exists
-		if id is not None and id in self.user_rooms:
-			self.get_room(self.user_rooms[id]).remove_user(id)
-			del self.user_rooms[id]
+		with self.lock:
+			room_id = self.user_rooms.pop(id, None)
+			if room_id is not None:
+				room = self.rooms.get(room_id)
+				if room is not None:
+					room.remove_user(id)
 	
-	def new_room(self, room_id=None):
-		"""Create a new room with an optional specific ID."""
-		room = Room(room_id)
-		self.rooms.append(room)
-		print(f"Created new room with ID: {room.id}")
+	def new_room(self, room_id=None, end_time=None):
+		"""Create a new room with an optional specific ID and session end time."""
+		room = Room(room_id, end_time)
+		with self.lock:
+			self.evict_expired()
+			self.rooms[room.id] = room
+			if end_time is not None:
+				heapq.heappush(self.expiry, (end_time, room.id))
 		return room.id
 
 	def get_room(self, id):
-		print(f"Looking for room with ID: {id}")
-		for room in self.rooms:
-			if room.id == id:
-				print(f"Found room with ID: {id}")
-				return room
-		print(f"Room with ID {id} not found")
-		return None
+		return self.rooms.get(id)
+
+	def ensure_room(self, room_id, end_time=None):
+		"""Create the room unless it already exists. Returns the room id."""
+		with self.lock:
+			if room_id in self.rooms:
+				return room_id
+			return self.new_room(room_id, end_time)
+
+	def set_room_end_time(self, id, end_time):
+		"""Move a room's expiry, e.g. when the session timer is restarted."""
+		with self.lock:
+			room = self.rooms.get(id)
+			if room is not None:
+				room.end_time = end_time
+				heapq.heappush(self.expiry, (end_time, id))
+
+	def remove_room(self, id):
+		with self.lock:
+			room = self.rooms.pop(id, None)
+			if room is not None:
+				for user_id in room.users:
+					self.user_rooms.pop(user_id, None)
+		return room
+
+	def evict_expired(self, now=None):
+		"""Drop rooms whose session has ended. Returns the evicted room ids."""
+		now = now or datetime.now(timezone.utc)
+		evicted = []
+		with self.lock:
+			while self.expiry and self.expiry[0][0] < now:
+				end_time, room_id = heapq.heappop(self.expiry)
+				room = self.rooms.get(room_id)
+				if room is not None and room.end_time == end_time:
+					self.remove_room(room_id)
+					evicted.append(room_id)
+		return evicted
 	
 	def get_room_from_user(self, id):
 		return self.get_room(self.user_rooms[id])
 
-server = Server()
\ No newline at end of file
+	def restore_room(self, room_id, end_time, state):
+		"""Recreate a room from persisted state (see core/persistence.py).
+
+		Rooms that already exist are left alone. Ops older than the restored
+		revision can't be transformed against, clients resync from a snapshot.
+		"""
+		with self.lock:
+			if room_id in self.rooms:
+				return
+			self.new_room(room_id, end_time)
+			room = self.rooms[room_id]
+			room.editor.text = state['editor']['text']
+			room.editor.revision = room.editor.history_start = state['editor']['rev']
+			room.whiteboard.restore(state['whiteboard']['ops'], state['whiteboard']['rev'])
+
+	# Async API used by the WebSocket consumer and async views. These are
+	# trivial here, but let RedisServer share room state between worker
+	# processes.
+
+	async def open_room(self, room_id, end_time=None):
+		"""ensure_room() for async views."""
+		return self.ensure_room(room_id, end_time)
+
+	async def join_room(self, room_id, limit=None, end_time=None, binary=False):
+		"""Register a connection with a room, creating the room if needed.
+
+		A room created here gets the session's end time, so it is evicted
+		like one opened by the room view. With a limit the connection is only
+		admitted while the room has fewer connections than that; checking and
+		taking the place is one step, so concurrent joins can't overfill it.
+		`binary` notes that the connection takes binary frames (see
+		record_frame()). Returns the user id, None if full.
+		"""
+		with self.lock:
+			self.ensure_room(room_id, end_time)
+			if limit is not None and len(self.rooms[room_id].users) >= limit:
+				return None
+			return self.new_user(room_id, binary)
+
+	async def leave_room(self, user_id):
+		self.remove_user(user_id)
+
+	async def apply_text(self, room_id, base_revision, ops):
+		"""Apply editor ops to a room. Returns (revision, ops) or None without a room."""
+		room = self.rooms.get(room_id)
+		if room is None:
+			return None
+		return room.editor.apply(base_revision, ops)
+
+	async def text_snapshot(self, room_id):
+		room = self.rooms.get(room_id)
+		return room.editor.snapshot() if room else None
+
+	async def room_state(self, room_id):
+		"""Copy of the room's editor and whiteboard state, or None without a room."""
+		room = self.rooms.get(room_id)
+		if room is None:
+			return None
+		whiteboard = room.whiteboard.snapshot()
+		return {
+			'editor': room.editor.snapshot(),
+			'whiteboard': {'ops': list(whiteboard['ops']), 'rev': whiteboard['rev']},
+		}
+
+	async def apply_whiteboard(self, room_id, ops):
+		"""Append whiteboard ops to a room. Returns (revision, ops) or None without a room."""
+		room = self.rooms.get(room_id)
+		if room is None:
+			return None
+		return room.whiteboard.apply(ops)
+
+	async def whiteboard_snapshot(self, room_id):
+		room = self.rooms.get(room_id)
+		return room.whiteboard.snapshot() if room else None
+
+	async def update_end_time(self, room_id, end_time):
+		self.set_room_end_time(room_id, end_time)
+
+	async def close_room(self, room_id):
+		"""Drop a room and its users, e.g. once its session has ended."""
+		self.remove_room(room_id)
+
+	async def room_is_open(self, room_id, now):
+		"""True while the room exists and its session has not ended."""
+		room = self.rooms.get(room_id)
+		return room is not None and (room.end_time is None or room.end_time >= now)
+
+	async def record_frame(self, room_id, frame):
+		"""Stamp a frame published to the room with its next sequence number.
+
+		Sets frame['seq'] and keeps the frame for replay(). Returns (number,
+		whether any connection in the room takes binary frames), (0, False)
+		and nothing kept without a room.
+		"""
+		room = self.rooms.get(room_id)
+		if room is None:
+			return 0, False
+		room.seq += 1
+		frame['seq'] = room.seq
+		room.events.append((room.seq, frame))
+		return room.seq, bool(room.binary)
+
+	async def replay(self, room_id, seq=None, epoch=None):
+		"""Where the room's event log stands, and what a client missed.
+
+		Returns (epoch, seq, frames): frames are the ones published after
+		`seq` of `epoch`, or None when that can't be told from the log (no
+		position given, another epoch, or frames already dropped).
+		"""
+		room = self.rooms.get(room_id)
+		if room is None:
+			return None, 0, None
+		frames = None
+		if seq is not None and epoch == room.epoch and seq <= room.seq:
+			oldest = room.events[0][0] if room.events else room.seq + 1
+			if seq + 1 >= oldest:
+				frames = [frame for number, frame in room.events if number > seq]
+		return room.epoch, room.seq, frames
+
+	async def track_presence(self, room_id, account, change):
+		"""Add `change` (1 or -1) to an account's connections to the room.
+
+		Counts connections on every worker, so the account's participant row
+		is only marked absent when its last connection anywhere closes.
+		Returns the new count, 0 without a room.
+		"""
+		room = self.rooms.get(room_id)
+		if room is None:
+			return 0
+		count = room.present.get(account, 0) + change
+		if count > 0:
+			room.present[account] = count
+		else:
+			room.present.pop(account, None)
+		return max(count, 0)
+
+
+def create_server(redis_url=None):
+	"""In-process registry by default, Redis-backed when a URL is given."""
+	if redis_url:
+		from src.redis_server import RedisServer
+		return RedisServer(redis_url)
+	return Server()
+
+server = create_server(os.environ.get('REDIS_URL'))
@@ -1,5 +1,7 @@
 import uuid
 
 class User:
+	__slots__ = ('id',)
+
 	def __init__(self):
-		self.id = str(uuid.uuid4())[:5]
\ No newline at end of file
+		self.id = str(uuid.uuid4())[:5]
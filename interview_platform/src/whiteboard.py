@@ -1,9 +1,104 @@
+# Whiteboard state as an append-only log of vector ops.
+#
+# Ops are either a stroke {'t': 'stroke', 'pts': [x0, y0, x1, y1, ...],
+# 'color': '#f00', 'width': 10} or {'t': 'clear'}. A clear wipes everything
+# drawn before it, so the log only needs to hold ops since the last clear to
+# be replayable by a reconnecting client.
+
+MAX_STROKE_POINTS = 5000
+# Most strokes and points a board holds between clears. The log is sent whole
+# to everyone who joins and goes into every snapshot, so a batch that would
+# grow it past either is rejected until someone clears the board.
+MAX_BOARD_OPS = 10000
+MAX_BOARD_POINTS = 200000
+
+
+class WhiteboardError(ValueError):
+	pass
+
+
+class WhiteboardFull(WhiteboardError):
+	pass
+
+
+def _clean_op(op):
+	if not isinstance(op, dict):
+		raise WhiteboardError(f"bad whiteboard op: {op!r}")
+	if op.get('t') == 'clear':
+		return {'t': 'clear'}
+	if op.get('t') != 'stroke':
+		raise WhiteboardError(f"unknown whiteboard op: {op.get('t')!r}")
+
+	pts = op.get('pts')
+	if not isinstance(pts, list) or not pts or len(pts) % 2:
+		raise WhiteboardError("stroke points must be a flat [x, y, ...] list")
+	if len(pts) > MAX_STROKE_POINTS * 2:
+		raise WhiteboardError(f"stroke has more than {MAX_STROKE_POINTS} points")
+	if not all(isinstance(v, (int, float)) for v in pts):
+		raise WhiteboardError("stroke points must be numbers")
+
+	color = op.get('color', '#f00')
+	width = op.get('width', 10)
+	if not isinstance(color, str) or len(color) > 32:
+		raise WhiteboardError(f"bad stroke color: {color!r}")
+	if not isinstance(width, (int, float)) or not 0 < width <= 100:
+		raise WhiteboardError(f"bad stroke width: {width!r}")
+	return {'t': 'stroke', 'pts': [round(v) for v in pts], 'color': color, 'width': width}
+
+
+def grow(ops, count=0, points=0):
+	"""Size (strokes, points) of a board of that size once cleaned `ops` are applied.
+
+	Raises WhiteboardFull when it would go past MAX_BOARD_OPS or
+	MAX_BOARD_POINTS.
+	"""
+	for op in ops:
+		if op['t'] == 'clear':
+			count = points = 0
+		else:
+			count += 1
+			points += len(op['pts']) // 2
+	if count > MAX_BOARD_OPS or points > MAX_BOARD_POINTS:
+		raise WhiteboardFull("the whiteboard is full, clear it to keep drawing")
+	return count, points
+
+
 class Whiteboard:
 	def __init__(self):
-		self.state = ""
+		self.ops = []
+		self.revision = 0
+		self.points = 0  # stroke points in self.ops
 
 	def get_state(self):
-		return self.state
-	
+		return self.ops
+
 	def set_state(self, state):
-		self.state = state
\ No newline at end of file
+		self.restore(state, self.revision + 1)
+
+	def restore(self, ops, revision):
+		"""Take over a stored log (e.g. persisted state) as is."""
+		self.ops = list(ops)
+		self.revision = revision
+		self.points = sum(len(op['pts']) // 2 for op in self.ops if op['t'] == 'stroke')
+
+	def apply(self, ops):
+		"""Append a batch of ops to the log.
+
+		Returns (revision, cleaned_ops); the cleaned ops are what should be
+		relayed to the other participants. Nothing is applied when the batch
+		is rejected (WhiteboardError, WhiteboardFull if the board is full).
+		"""
+		if not isinstance(ops, list):
+			raise WhiteboardError("ops must be a list")
+		ops = [_clean_op(op) for op in ops]
+		_, self.points = grow(ops, len(self.ops), self.points)
+		for op in ops:
+			if op['t'] == 'clear':
+				self.ops = []
+			else:
+				self.ops.append(op)
+		self.revision += 1
+		return self.revision, ops
+
+	def snapshot(self):
+		return {'ops': self.ops, 'rev': self.revision}
@@ -0,0 +1,225 @@
+// editor.js - operational transform client for the shared editor
+//
+// Mirrors src/editor.py. An op is {p: pos, i: "text"} (insert) or
+// {p: pos, d: count} (delete); changes are sent as lists of ops made against
+// the last revision the server acknowledged. At most one list is in flight,
+// further local edits are buffered until the server acks it.
+
+function otShift(op, p) {
+	return Object.assign({}, op, { p: p });
+}
+
+function otDeletePastDelete(a, b) {
+	const aEnd = a.p + a.d;
+	const bEnd = b.p + b.d;
+	const overlap = Math.max(0, Math.min(aEnd, bEnd) - Math.max(a.p, b.p));
+	const count = a.d - overlap;
+	if (count === 0) {
+		return [];
+	}
+	const removedBefore = Math.max(0, Math.min(bEnd, a.p) - b.p);
+	return [{ p: a.p - removedBefore, d: count }];
+}
+
+// Returns [a', b'] where a' applies after b and b' applies after a
+function otTransformOne(a, b, bFirst) {
+	if ('i' in a && 'i' in b) {
+		if (a.p < b.p || (a.p === b.p && !bFirst)) {
+			return [[a], [otShift(b, b.p + a.i.length)]];
+		}
+		return [[otShift(a, a.p + b.i.length)], [b]];
+	}
+
+	if ('i' in a) {
+		const swapped = otTransformOne(b, a, !bFirst);
+		return [swapped[1], swapped[0]];
+	}
+
+	if ('i' in b) {
+		if (b.p <= a.p) {
+			return [[otShift(a, a.p + b.i.length)], [b]];
+		}
+		if (b.p >= a.p + a.d) {
+			return [[a], [otShift(b, b.p - a.d)]];
+		}
+		const before = b.p - a.p;
+		const after = a.d - before;
+		return [
+			[{ p: a.p, d: before }, { p: a.p + b.i.length, d: after }],
+			[otShift(b, a.p)]
+		];
+	}
+
+	return [otDeletePastDelete(a, b), otDeletePastDelete(b, a)];
+}
+
+function otTransform(ops, against, againstFirst) {
+	if (!ops.length || !against.length) {
+		return [ops, against];
+	}
+	if (ops.length > 1) {
+		const head = otTransform(ops.slice(0, 1), against, againstFirst);
+		const tail = otTransform(ops.slice(1), head[1], againstFirst);
+		return [head[0].concat(tail[0]), tail[1]];
+	}
+	if (against.length > 1) {
+		const head = otTransform(ops, against.slice(0, 1), againstFirst);
+		const tail = otTransform(head[0], against.slice(1), againstFirst);
+		return [tail[0], head[1].concat(tail[1])];
+	}
+	return otTransformOne(ops[0], against[0], againstFirst);
+}
+
+function otApply(text, ops) {
+	for (const op of ops) {
+		if ('i' in op) {
+			text = text.slice(0, op.p) + op.i + text.slice(op.p);
+		} else {
+			text = text.slice(0, op.p) + text.slice(op.p + op.d);
+		}
+	}
+	return text;
+}
+
+// Move a caret position past a list of ops
+function otTransformIndex(index, ops) {
+	for (const op of ops) {
+		if ('i' in op) {
+			if (op.p < index) {
+				index += op.i.length;
+			}
+		} else if (op.p < index) {
+			index -= Math.min(op.d, index - op.p);
+		}
+	}
+	return index;
+}
+
+// Smallest delete + insert turning oldText into newText
+function otDiff(oldText, newText) {
+	let start = 0;
+	const minLength = Math.min(oldText.length, newText.length);
+	while (start < minLength && oldText[start] === newText[start]) {
+		start++;
+	}
+	let oldEnd = oldText.length;
+	let newEnd = newText.length;
+	while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]) {
+		oldEnd--;
+		newEnd--;
+	}
+	const ops = [];
+	if (oldEnd > start) {
+		ops.push({ p: start, d: oldEnd - start });
+	}
+	if (newEnd > start) {
+		ops.push({ p: start, i: newText.slice(start, newEnd) });
+	}
+	return ops;
+}
+
+/** Shared editor client bound to a textarea
+  *
+  * element (HTMLTextAreaElement) the editor textarea
+  * sendOps (function) called with (rev, ops) to push a change to the server
+  *
+*/
+function SharedEditor(element, sendOps) {
+	this.element = element;
+	this.sendOps = sendOps;
+	this.rev = 0;
+	this.shadow = element.value;
+	this.inflight = null;
+	this.buffer = null;
+	this.paused = false;
+
+	const that = this;
+	this.element.addEventListener('input', function() {
+		that.onLocalChange();
+	});
+}
+
+SharedEditor.prototype.onLocalChange = function() {
+	const ops = otDiff(this.shadow, this.element.value);
+	this.shadow = this.element.value;
+	if (!ops.length) {
+		return;
+	}
+	if (this.inflight) {
+		this.buffer = (this.buffer || []).concat(ops);
+	} else {
+		this.inflight = ops;
+		if (!this.paused) {
+			this.sendOps(this.rev, ops);
+		}
+	}
+};
+
+// Server confirmed our in-flight ops as revision rev
+SharedEditor.prototype.onAck = function(rev) {
+	if (rev <= this.rev) {
+		// Already covered by a snapshot that replaced our in-flight ops
+		return;
+	}
+	this.rev = rev;
+	this.inflight = this.buffer;
+	this.buffer = null;
+	if (this.inflight && !this.paused) {
+		this.sendOps(this.rev, this.inflight);
+	}
+};
+
+// While a reconnect replays the ops we missed nothing is sent; whatever is
+// still in flight afterwards never made it to the server and goes again
+SharedEditor.prototype.pause = function() {
+	this.paused = true;
+};
+
+SharedEditor.prototype.resume = function() {
+	this.paused = false;
+	if (this.inflight) {
+		this.sendOps(this.rev, this.inflight);
+	}
+};
+
+// Another participant's ops, already ordered by the server
+SharedEditor.prototype.onRemoteOps = function(rev, ops) {
+	if (rev <= this.rev) {
+		// Already included in the snapshot we started from
+		return;
+	}
+	if (this.inflight) {
+		const t = otTransform(this.inflight, ops, true);
+		this.inflight = t[0];
+		ops = t[1];
+	}
+	if (this.buffer) {
+		const t = otTransform(this.buffer, ops, true);
+		this.buffer = t[0];
+		ops = t[1];
+	}
+	this.rev = rev;
+	this.applyToElement(ops);
+};
+
+SharedEditor.prototype.onSnapshot = function(text, rev) {
+	this.rev = rev;
+	this.inflight = null;
+	this.buffer = null;
+	this.element.value = text;
+	this.shadow = text;
+};
+
+SharedEditor.prototype.applyToElement = function(ops) {
+	const el = this.element;
+	const focused = document.activeElement === el;
+	const start = otTransformIndex(el.selectionStart, ops);
+	const end = otTransformIndex(el.selectionEnd, ops);
+	this.shadow = otApply(this.shadow, ops);
+	el.value = this.shadow;
+	if (focused) {
+		el.setSelectionRange(start, end);
+	}
+};
+
+window.SharedEditor = SharedEditor;
@@ -0,0 +1,68 @@
+// frames.js - binary WebSocket frames (mirror of core/frames.py)
+//
+// 8 byte header: version, flags (1 = deflate), message type, room id length,
+// uint32 sequence (the message's seq, 0 for none); then the room id and the
+// payload. The payload is the message without its type and seq as JSON.
+
+const FRAME_VERSION = 1;
+const FRAME_DEFLATE = 1;
+const FRAME_TYPES = [
+	null, 'txt_snapshot', 'txt_op', 'wb_snapshot', 'wb_ops', 'batch',
+	'txt_update', 'wb_buffer', 'timer_update', 'global_time'
+];
+
+// Binary frames need DecompressionStream to inflate compressed payloads
+function binaryFramesSupported() {
+	return typeof DecompressionStream !== 'undefined' && typeof TextDecoder !== 'undefined';
+}
+
+// Encode a message as an (uncompressed) binary frame
+function encodeFrame(message, room) {
+	const encoder = new TextEncoder();
+	let code = FRAME_TYPES.indexOf(message.type);
+	let payload;
+	if (code > 0) {
+		const rest = Object.assign({}, message);
+		delete rest.type;
+		payload = encoder.encode(JSON.stringify(rest));
+	} else {
+		code = 0;
+		payload = encoder.encode(JSON.stringify(message));
+	}
+	const roomBytes = encoder.encode(room || '');
+	const frame = new Uint8Array(8 + roomBytes.length + payload.length);
+	const view = new DataView(frame.buffer);
+	view.setUint8(0, FRAME_VERSION);
+	view.setUint8(1, 0);
+	view.setUint8(2, code);
+	view.setUint8(3, roomBytes.length);
+	view.setUint32(4, 0);
+	frame.set(roomBytes, 8);
+	frame.set(payload, 8 + roomBytes.length);
+	return frame.buffer;
+}
+
+// Decode a binary frame (ArrayBuffer) into a message; returns a Promise
+async function decodeFrame(buffer) {
+	const view = new DataView(buffer);
+	if (view.getUint8(0) !== FRAME_VERSION) {
+		throw new Error("Unsupported frame version " + view.getUint8(0));
+	}
+	const flags = view.getUint8(1);
+	const type = FRAME_TYPES[view.getUint8(2)];
+	const seq = view.getUint32(4);
+	let payload = new Uint8Array(buffer, 8 + view.getUint8(3));
+	if (flags & FRAME_DEFLATE) {
+		const stream = new Blob([payload]).stream().pipeThrough(new DecompressionStream('deflate'));
+		payload = new Uint8Array(await new Response(stream).arrayBuffer());
+	}
+
+	const message = JSON.parse(new TextDecoder().decode(payload));
+	if (type) {
+		message.type = type;
+	}
+	if (seq) {
+		message.seq = seq;
+	}
+	return message;
+}
@@ -5,14 +5,26 @@ console.log("Loading room.js version 3.0.0");
 window.socket = null;
 window.uid = "";
 window.wb = null;
+window.sharedEditor = null;
+window.wbRev = 0;
 window.timerInterval = null;
 window.sessionEndTime = null;
 window.serverTimestamp = null;
 window.sessionEndTimestamp = null;
+window.binaryFrames = false;
+// Position in the room's numbered frames, sent back on reconnect so the
+// server only replays what was missed
+window.roomSeq = 0;
+window.roomEpoch = null;
+// Ids of this page's connections: replayed ops may carry an earlier one
+window.ownUids = new Set();
+// Incoming messages are handled strictly in order, binary ones decode async
+window.inbox = Promise.resolve();
 
 // Initialize the room connection
 function initRoom(roomId) {
 	console.log("Initializing room with ID:", roomId);
+	window.roomName = roomId;
 	
 	// Connect to WebSocket - handle both HTTP and HTTPS
 	const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
@@ -20,34 +32,47 @@ function initRoom(roomId) {
 		`${protocol}//${window.location.host}/ws/`
 	);
 	
+	window.socket.binaryType = 'arraybuffer';
+	window.binaryFrames = false;
+	
 	// Make socket globally available
 	window.roomSocket = window.socket;
 	
 	window.socket.onopen = function(e) {
 		console.log("WebSocket connection established");
-		// Join the room
-		window.socket.send(JSON.stringify({
-			'join': roomId
-		}));
+		// Join the room, asking for binary frames if this browser can inflate
+		// them, and to resume from the last frame seen after a reconnect
+		const join = {
+			'join': roomId,
+			'binary': binaryFramesSupported()
+		};
+		if (window.roomEpoch) {
+			join.resume = { seq: window.roomSeq, epoch: window.roomEpoch };
+		}
+		window.socket.send(JSON.stringify(join));
 		
 		// Initialize whiteboard immediately after socket is connected
 		initWhiteboard();
 		
 		// Request timer state
-		window.socket.send(JSON.stringify({
+		sendMessage({
 			'type': 'get_timer'
-		}));
+		});
 		
-		// Set up the text change handler
-		if (document.getElementById('editor')) {
-			document.getElementById('editor').addEventListener('keyup', function() {
-				onTextChange();
-			});
+		// Set up the shared editor (only once, it survives reconnects)
+		const editor = document.getElementById('editor');
+		if (editor && !window.sharedEditor) {
+			window.sharedEditor = new SharedEditor(editor, sendTextOps);
 		}
 	};
 	
 	window.socket.onclose = function(e) {
 		console.log("WebSocket connection closed");
+		// No such session, turned away from a full room or the session is
+		// over: reconnecting would just be refused again
+		if (e.code === 4004 || e.code === 4009 || e.code === 4010) {
+			return;
+		}
 		// Don't redirect on close - just try to reconnect
 		setTimeout(function() {
 			console.log("Attempting to reconnect...");
@@ -61,36 +86,141 @@ function initRoom(roomId) {
 
 	// Process websocket message
 	window.socket.onmessage = function(event) {
-		try {
-			const data = JSON.parse(event.data);
-			
-			// Only redirect if explicitly told to exit
-			if (data.exit === 1) { 
-				console.log("Server requested exit");
-				window.location.href = '/'; 
+		window.inbox = window.inbox.then(function() {
+			if (event.data instanceof ArrayBuffer) {
+				return decodeFrame(event.data);
 			}
+			return JSON.parse(event.data);
+		}).then(handleMessage).catch(function(error) {
+			console.error("Error processing WebSocket message:", error);
+		});
+	};
+}
+
+// Send a message to the room, as a binary frame once the server agreed to
+function sendMessage(message) {
+	if (window.binaryFrames) {
+		window.socket.send(encodeFrame(message, window.roomName));
+	} else {
+		window.socket.send(JSON.stringify(message));
+	}
+}
+
+// Handle one message from the room
+function handleMessage(data) {
+	// Room frames are numbered (the join reply carries the current number)
+	if (data.seq > window.roomSeq) {
+		window.roomSeq = data.seq;
+	}
+
+	// Several room events coalesced by the server into one frame, in order
+	if (data.type == "batch") {
+		data.events.forEach(handleMessage);
+		return;
+	}
+
+	// Only redirect if explicitly told to exit
+	if (data.exit === 1) { 
+		console.log("Server requested exit");
+		window.location.href = '/'; 
+	}
+
+	if (data.type == "room_not_found") {
+		alert('This session does not exist.');
+		window.location.href = '/';
+		return;
+	}
+
+	if (data.type == "room_full") {
+		alert('This room is full (' + data.max_participants + ' participants).');
+		window.location.href = '/';
+		return;
+	}
+
+	if (data.type == "session_ended") {
+		clearInterval(window.timerInterval);
+		// The countdown may have said so already
+		if (window.remainingSeconds > 0) {
+			alert('This session has ended.');
+		}
+		window.location.href = '/';
+		return;
+	}
 
-			if (data.join) {
-				window.uid = data.join;
-				console.log("Joined as user " + window.uid);
-			} else if (data.type == "txt_update") {
-				if (document.getElementById("editor")) {
-					document.getElementById("editor").value = data.data;
-				}
-			} else if (data.type == "wb_buffer") {
-				if (window.wb) {
-					window.wb.setCanvasData(data.data);
-				}
-			} else if (data.type == "timer_update") {
-				// Update the timer with the server's time
-				updateTimerFromServer(data.end_time);
-			} else if (data.type === 'global_time') {
-				handleGlobalTime(data.timestamp);
+	if (data.join) {
+		window.uid = data.join;
+		window.ownUids.add(data.join);
+		window.binaryFrames = !!data.binary;
+		console.log("Joined as user " + window.uid + (window.binaryFrames ? " (binary frames)" : ""));
+		// A new log (first join, or the room was recreated) starts over
+		if (data.epoch !== window.roomEpoch) {
+			window.roomEpoch = data.epoch;
+			window.roomSeq = data.seq || 0;
+		}
+		if (data.resumed) {
+			// Just what happened while we were away, in order
+			console.log("Resumed, replaying " + data.events.length + " frame(s)");
+			if (window.sharedEditor) {
+				window.sharedEditor.pause();
 			}
-		} catch (error) {
-			console.error("Error processing WebSocket message:", error);
+			data.events.forEach(handleMessage);
+			if (window.sharedEditor) {
+				window.sharedEditor.resume();
+			}
+			return;
 		}
-	};
+		// The room's current state comes with the join reply
+		if (data.editor) {
+			applyTextSnapshot(data.editor);
+		}
+		if (data.whiteboard) {
+			applyWhiteboardSnapshot(data.whiteboard);
+		}
+	} else if (data.type == "txt_snapshot") {
+		applyTextSnapshot(data);
+	} else if (data.type == "txt_op") {
+		if (window.sharedEditor) {
+			if (window.ownUids.has(data.uid)) {
+				window.sharedEditor.onAck(data.rev);
+			} else {
+				window.sharedEditor.onRemoteOps(data.rev, data.ops);
+			}
+		}
+	} else if (data.type == "wb_snapshot") {
+		// Sent back when our strokes were rejected: they are undone
+		applyWhiteboardSnapshot(data);
+		if (data.error) {
+			console.warn("Whiteboard strokes rejected:", data.error);
+			alert('Your drawing could not be saved: ' + data.error + '.');
+		}
+	} else if (data.type == "wb_ops") {
+		// Our own strokes are already on the canvas
+		if (data.rev > window.wbRev && !window.ownUids.has(data.uid) && window.wb) {
+			window.wb.renderOps(data.ops);
+		}
+		window.wbRev = Math.max(window.wbRev, data.rev);
+	} else if (data.type == "timer_update") {
+		// Update the timer with the server's time
+		updateTimerFromServer(data.end_time);
+	} else if (data.type === 'global_time') {
+		handleGlobalTime(data.timestamp);
+	}
+}
+
+// Replace the editor content with the server's document ({text, rev})
+function applyTextSnapshot(snapshot) {
+	if (window.sharedEditor) {
+		window.sharedEditor.onSnapshot(snapshot.text, snapshot.rev);
+	}
+}
+
+// Redraw the whiteboard from the server's op log ({ops, rev})
+function applyWhiteboardSnapshot(snapshot) {
+	window.wbRev = snapshot.rev;
+	if (window.wb) {
+		window.wb.clean();
+		window.wb.renderOps(snapshot.ops);
+	}
 }
 
 // Initialize the whiteboard
@@ -103,20 +233,15 @@ function initWhiteboard() {
 	}
 	
 	try {
-		// Create the whiteboard object with inline callback
+		// Create the whiteboard object with inline callback. Strokes persist
+		// (no clean timeout) since the server keeps the board's op log.
 		window.wb = new Whiteboard("whiteboard", function(buff, opt) {
 			// This is the onDraw callback
 			if (window.wb) {
 				window.wb.draw(buff, opt);
-				if (window.socket && window.socket.readyState === WebSocket.OPEN) {
-					window.socket.send(JSON.stringify({ 
-						id: window.uid, 
-						type: "wb_buffer", 
-						data: window.wb.getCanvasData() 
-					}));
-				}
+				sendWhiteboardOps([window.wb.strokeOp(buff, opt)]);
 			}
-		});
+		}, { timeout: 0 });
 		
 		console.log("Whiteboard initialized successfully");
 	} catch (error) {
@@ -124,24 +249,29 @@ function initWhiteboard() {
 	}
 }
 
-// Function to handle text changes in the editor
-function onTextChange() {
-	const editor = document.getElementById("editor");
-	if (!editor) {
-		console.error("Editor element not found");
-		return;
+// Send whiteboard stroke/clear ops to the room
+function sendWhiteboardOps(ops) {
+	if (window.socket && window.socket.readyState === WebSocket.OPEN) {
+		sendMessage({
+			type: "wb_ops",
+			ops: ops
+		});
 	}
-	
+}
+
+// Send editor ops made against revision rev
+function sendTextOps(rev, ops) {
 	if (!window.socket || window.socket.readyState !== WebSocket.OPEN) {
 		console.error("Cannot send text update: WebSocket not open");
 		return;
 	}
 	
 	try {
-		window.socket.send(JSON.stringify({
-			'type': 'txt_update',
-			'data': editor.value
-		}));
+		sendMessage({
+			'type': 'txt_op',
+			'rev': rev,
+			'ops': ops
+		});
 	} catch (error) {
 		console.error("Error sending text update:", error);
 	}
@@ -208,7 +338,9 @@ function startSessionTimer(seconds) {
 
 // Make startSessionTimer available globally
 window.startSessionTimer = startSessionTimer;
-window.onTextChange = onTextChange;
+window.sendTextOps = sendTextOps;
+window.sendWhiteboardOps = sendWhiteboardOps;
+window.sendMessage = sendMessage;
 window.updateTimerDisplay = updateTimerDisplay;
 window.updateTimerFromServer = updateTimerFromServer;
 
@@ -136,6 +136,36 @@ Whiteboard.prototype.setCanvasData = function(imageData) {
 	img.src = imageData;
 }
 
+// Compact vector form of a finished stroke, as stored in the server op log
+Whiteboard.prototype.strokeOp = function(buffer, drawOptions) {
+    const pts = [];
+    for (let pos of buffer) {
+        pts.push(Math.round(pos[0]), Math.round(pos[1]));
+    }
+    return {
+        t: 'stroke',
+        pts: pts,
+        color: drawOptions.strokeStyle,
+        width: Number(drawOptions.lineWidth)
+    };
+};
+
+// Replay stroke/clear ops received from the server
+Whiteboard.prototype.renderOps = function(ops) {
+    for (let op of ops) {
+        if (op.t === 'clear') {
+            this.clean();
+        } else if (op.t === 'stroke') {
+            const buffer = [];
+            for (let i = 0; i + 1 < op.pts.length; i += 2) {
+                buffer.push([op.pts[i], op.pts[i + 1]]);
+            }
+            this.draw(buffer, {strokeStyle: op.color, lineWidth: op.width, timeout: 0});
+        }
+    }
+    this.setCanvasOptions(this.options);
+};
+
 Whiteboard.prototype.render = function(buffer, offsetX, offsetY) {
     if (buffer.length === 0) {
         return;